@@ -16,41 +16,54 @@ def mkdir(fn):
        import subprocess
        subprocess.call(["mkdir","-p",fn])
 
-def OneBrickClassify(brickname):
-    print(brickname)
-    global NAME_FOR_RUN
-    global RS
-    global REAL_BRICKS_FN
+# only the end of a log is read, kenobi logs "All done!" as its last line
+TAIL_BYTES=64*1024
+DONE_MARKER=b"decals_sim:All done!"
+
+def log_is_done(log_fn):
+    """True if the last TAIL_BYTES of log_fn contain DONE_MARKER, None if no log"""
+    try:
+        f = open(log_fn, 'rb')
+    except (IOError, OSError):
+        return None
+    with f:
+        size = os.fstat(f.fileno()).st_size
+        f.seek(max(size - TAIL_BYTES, 0))
+        return DONE_MARKER in f.read()
 
+def OneBrickClassify(brickname):
+    """Returns (brickname, status): 1 finished, 2 unfinished, -1 no log"""
     log_dir = os.environ['obiwan_out']+'/output/logs/%s/%s/log.%s'%(brickname[:3],RS,brickname)
-    if os.path.isfile(log_dir) is False:
-        f1 = open('./%s/UnfinishedBricks.txt'%NAME_FOR_RUN, 'a')
-        f1.write(str(brickname)+'\n')
-        f1.close()
-        return -1
-    flag = False
-    if "decals_sim:All done!" in open(log_dir).read():
-        f2 = open('./%s/FinishedBricks.txt'%NAME_FOR_RUN, 'a')
-        f2.write(str(brickname)+'\n')
-        f2.close()
-        return 1
-    f4 = open('./%s/UnfinishedBricks.txt'%NAME_FOR_RUN, 'a')
-    f4.write(str(brickname)+'\n')
-    f4.close()
-    return 2
+    done = log_is_done(log_dir)
+    if done is None:
+        return brickname, -1
+    if done:
+        return brickname, 1
+    return brickname, 2
+
+def write_list(fn, bricks):
+    """Atomic rewrite of a brick list"""
+    tmp_fn = fn + '.tmp'
+    with open(tmp_fn, 'w') as f:
+        for brickname in bricks:
+            f.write(str(brickname)+'\n')
+    os.rename(tmp_fn, fn)
 
-def BrickClassify():
+def BrickClassify(threads=64):
+    """Classify the bricks of REAL_BRICKS_FN from a thread pool (the time goes
+    into file system latency, not python) and write both lists from here"""
     import numpy as np
-    import multiprocessing as mp
-    N=16
-    p = mp.Pool(N)
-    global NAME_FOR_RUN
-    f1 = open('./%s/FinishedBricks.txt'%NAME_FOR_RUN, 'w')
-    f1.close
-    f2 = open('./%s/UnfinishedBricks.txt'%NAME_FOR_RUN, 'w')
-    f2.close()
-    bricks = np.loadtxt('./real_brick_lists/%s'%REAL_BRICKS_FN, dtype=np.str)
-    p.map(OneBrickClassify,bricks)
+    from multiprocessing.pool import ThreadPool
+    bricks = np.loadtxt('./real_brick_lists/%s'%REAL_BRICKS_FN, dtype=str, ndmin=1)
+    p = ThreadPool(threads)
+    status = p.map(OneBrickClassify, bricks, chunksize=64)
+    p.close()
+    finished = [b for b,s in status if s == 1]
+    unfinished = [b for b,s in status if s != 1]
+    write_list('./%s/FinishedBricks.txt'%NAME_FOR_RUN, finished)
+    write_list('./%s/UnfinishedBricks.txt'%NAME_FOR_RUN, unfinished)
+    print('%d finished, %d unfinished (%d without log)' %
+          (len(finished), len(unfinished), sum(s == -1 for b,s in status)))
 
 def get_parser():
     import argparse
@@ -58,6 +71,7 @@ def get_parser():
     parser.add_argument('--name_for_run', type=str, required=True, help='name of production run')#currently: elg_like_run,elg_ngc_run
     parser.add_argument('--rs', type=str, required=True, help='e.g. rs0, more_rs0,rs200')
     parser.add_argument('--real_bricks_fn', type=str, required=True, help='bricks processed in this run')
+    parser.add_argument('--threads', type=int, default=64, help='concurrent log reads')
     return parser
 if __name__ == '__main__':
     parser= get_parser()
@@ -69,4 +83,4 @@ if __name__ == '__main__':
     RS = args.rs
     REAL_BRICKS_FN = args.real_bricks_fn   
     mkdir(NAME_FOR_RUN) 
-    BrickClassify()
+    BrickClassify(threads=args.threads)
@@ -0,0 +1,222 @@
+"""
+Streaming version of SV_collect_mpi.py + SV_stack.py
+
+Matches the simcat of each brick to its tractor catalog (as SV_brick_match
+does) and appends the matched rows to a single FITS table as bricks finish,
+so memory use is bounded by the write buffer (--buffer_rows) instead of the
+whole catalog. The rows of a brick are contiguous; the BRICKS extension of
+the output gives, for each brick, its first row and number of rows, which
+read_bricks() uses to read back just some bricks.
+
+usage:
+python SV_stream_collect.py --name_for_run dr8_SV --rs_type rs0 --start_id 0 --n_obj 200 \
+    --name_for_randoms SV_dr8 --bricklist FinishedBricks.txt --threads 32
+"""
+import os
+import argparse
+import numpy as np
+import fitsio
+from scipy.spatial import cKDTree
+
+# simcat columns copied into the output, as named by SV_brick_match
+SIM_COLUMNS = [('gflux', 'sim_gflux'), ('rflux', 'sim_rflux'), ('zflux', 'sim_zflux'),
+               ('redshift', 'sim_redshift'), ('rhalf', 'sim_rhalf'),
+               ('e1', 'sim_e1'), ('e2', 'sim_e2'), ('x', 'sim_bx'), ('y', 'sim_by'),
+               ('detected', 'detected'), ('n', 'sim_sersic_n')]
+
+def radec_to_plane(ra, dec, ra0, dec0):
+    """gnomonic projection about (ra0,dec0); returns x,y in degrees"""
+    ra, dec = np.radians(ra), np.radians(dec)
+    ra0, dec0 = np.radians(ra0), np.radians(dec0)
+    cosc = (np.sin(dec0) * np.sin(dec) +
+            np.cos(dec0) * np.cos(dec) * np.cos(ra - ra0))
+    x = np.cos(dec) * np.sin(ra - ra0) / cosc
+    y = (np.cos(dec0) * np.sin(dec) -
+         np.sin(dec0) * np.cos(dec) * np.cos(ra - ra0)) / cosc
+    return np.degrees(x), np.degrees(y)
+
+def match_nearest(ra1, dec1, ra2, dec2):
+    """for each (ra1,dec1), index of and distance [deg] to the nearest (ra2,dec2),
+    with a KD-tree on the tangent plane of the brick (fine at brick scales)"""
+    ra0 = np.degrees(np.arctan2(np.mean(np.sin(np.radians(ra1))),
+                                np.mean(np.cos(np.radians(ra1)))))
+    dec0 = np.mean(dec1)
+    xy1 = np.vstack(radec_to_plane(ra1, dec1, ra0, dec0)).T
+    xy2 = np.vstack(radec_to_plane(ra2, dec2, ra0, dec0)).T
+    d, idx = cKDTree(xy2).query(xy1)
+    return idx, d
+
+def brick_match(brickname, rs_type, startid, nobj, angle=1.5/3600):
+    """SV_brick_match as a numpy structured array, one row per simulated source
+    (None if the brick has no tractor sources)"""
+    topdir_tractor = os.environ['obiwan_out']+'/output/'
+    sim_topdir = os.environ['obiwan_out']+'/divided_randoms/'
+    fn_tractor = os.path.join(topdir_tractor,'tractor',brickname[:3],brickname,rs_type,'tractor-%s.fits' %brickname)
+    fn_sim = os.path.join(topdir_tractor,'obiwan',brickname[:3],brickname,rs_type,'simcat-elg-%s.fits' %brickname)
+    fn_original_sim = sim_topdir+'/brick_'+brickname+'.fits'
+
+    tractor = fitsio.read(fn_tractor)
+    sim = fitsio.read(fn_sim)
+    with fitsio.FITS(fn_original_sim) as f:
+        original_sim = f[1][startid:startid+nobj]
+    if len(tractor) == 0 or len(sim) == 0:
+        print('%s: %d tractor sources, %d sims -- skipping' % (brickname, len(tractor), len(sim)))
+        return None
+
+    idx1, d1 = match_nearest(sim['ra'], sim['dec'], tractor['ra'], tractor['dec'])
+    idx2, _ = match_nearest(sim['ra'], sim['dec'], original_sim['ra'], original_sim['dec'])
+
+    values = dict(redshift=original_sim['redshift'][idx2], detected=(d1 <= angle))
+    dtype = tractor.dtype.descr
+    for col, name in SIM_COLUMNS:
+        if not col in values:
+            values[col] = sim[col]
+        dtype.append((name, values[col].dtype.str))
+    out = np.zeros(len(sim), dtype=dtype)
+    for name in tractor.dtype.names:
+        out[name] = tractor[name][idx1]
+    for col, name in SIM_COLUMNS:
+        out[name] = values[col]
+    return out
+
+def _conform(arr, dtype):
+    """arr with the columns (and types) of dtype; missing columns are zero"""
+    out = np.zeros(len(arr), dtype=dtype)
+    for name in dtype.names:
+        if name in arr.dtype.names:
+            out[name] = arr[name]
+    return out
+
+
+class StreamingWriter(object):
+    """
+    Appends per-brick structured arrays to the CATALOG table of fn,
+    writing every buffer_rows rows, and the BRICKS index on close()
+
+    The file is written as fn.tmp and renamed to fn by close().
+    """
+
+    def __init__(self, fn, buffer_rows=1000000):
+        self.fn = fn
+        self.tmpfn = fn + '.tmp'
+        self.buffer_rows = buffer_rows
+        self.fits = None
+        self.dtype = None
+        self.buf = []
+        self.nbuf = 0
+        self.nrows = 0
+        self.bricks = []
+
+    def add(self, brickname, arr):
+        if self.dtype is None:
+            self.dtype = arr.dtype
+        elif arr.dtype != self.dtype:
+            print('%s: columns differ from the first brick, conforming' % brickname)
+            arr = _conform(arr, self.dtype)
+        self.bricks.append((brickname, self.nrows + self.nbuf, len(arr)))
+        self.buf.append(arr)
+        self.nbuf += len(arr)
+        if self.nbuf >= self.buffer_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.buf:
+            return
+        data = np.concatenate(self.buf)
+        if self.fits is None:
+            self.fits = fitsio.FITS(self.tmpfn, 'rw', clobber=True)
+            self.fits.write(data, extname='CATALOG')
+        else:
+            self.fits['CATALOG'].append(data)
+        self.nrows += len(data)
+        self.buf = []
+        self.nbuf = 0
+
+    def close(self):
+        self.flush()
+        index = np.zeros(len(self.bricks), dtype=[('brickname', 'S8'),
+                                                  ('row0', 'i8'), ('nrows', 'i8')])
+        for i, b in enumerate(self.bricks):
+            index[i] = b
+        if self.fits is None:
+            self.fits = fitsio.FITS(self.tmpfn, 'rw', clobber=True)
+        self.fits.write(index, extname='BRICKS')
+        self.fits.close()
+        os.rename(self.tmpfn, self.fn)
+        print('Wrote %d rows of %d bricks to %s' % (self.nrows, len(self.bricks), self.fn))
+
+
+def read_bricks(fn, bricknames):
+    """rows of the given bricks from a StreamingWriter file"""
+    with fitsio.FITS(fn) as f:
+        index = f['BRICKS'].read()
+        names = np.char.strip(index['brickname'].astype(str))
+        rows = [np.arange(r0, r0 + nr)
+                for name, r0, nr in zip(names, index['row0'], index['nrows'])
+                if name in set(bricknames)]
+        if not rows:
+            return None
+        return f['CATALOG'].read(rows=np.concatenate(rows))
+
+def bounded_imap(pool, func, tasks, window):
+    """pool.imap, but with at most window tasks running or finished and not
+    yet consumed, so that results cannot pile up ahead of the writer"""
+    from collections import deque
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(func, (task,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def _match_one(X):
+    brickname, rs_type, startid, nobj = X
+    try:
+        return brickname, brick_match(brickname, rs_type, startid, nobj)
+    except (IOError, OSError) as e:
+        print('%s: %s' % (brickname, e))
+        return brickname, None
+
+def get_parser():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,description='Streaming collection of production run data')
+    parser.add_argument('--name_for_run',type=str, required=True,help='production run directory (specified in DRONE_ENV.sh)')
+    parser.add_argument('--n_obj',type=int,required = True,help='#of randoms injected')
+    parser.add_argument('--start_id',type=int,required = True, help='startid in run')
+    parser.add_argument('--rs_type',type=str,required = True,help='rs0 rs201 rs202')
+    parser.add_argument('--name_for_randoms',type=str,required=True,help='dir name for original randoms')
+    parser.add_argument('--bricklist',type=str,required=True,help='file with one brickname per line')
+    parser.add_argument('--threads',type=int,default=1,help='bricks matched in parallel')
+    parser.add_argument('--buffer_rows',type=int,default=1000000,help='rows buffered in memory between writes')
+    parser.add_argument('--out',type=str,default=None,help='output file, default $obiwan_out/subset/sim_<name_for_run>.fits')
+    return parser
+
+def main(args=None):
+    args = get_parser().parse_args(args=args)
+    out = args.out
+    if out is None:
+        out = os.path.join(os.environ['obiwan_out'],'subset','sim_%s.fits' % args.name_for_run)
+    bricknames = np.sort(np.loadtxt(args.bricklist, dtype=str, ndmin=1))
+    print('%d bricks' % len(bricknames))
+
+    writer = StreamingWriter(out, buffer_rows=args.buffer_rows)
+    tasks = [(b, args.rs_type, args.start_id, args.n_obj) for b in bricknames]
+    if args.threads > 1:
+        from multiprocessing import Pool
+        pool = Pool(args.threads)
+        results = bounded_imap(pool, _match_one, tasks, 4 * args.threads)
+    else:
+        pool = None
+        results = map(_match_one, tasks)
+    for n, (brickname, arr) in enumerate(results):
+        if arr is not None:
+            writer.add(brickname, arr)
+        if (n+1) % 1000 == 0:
+            print('%d of %d bricks done' % (n+1, len(tasks)))
+    writer.close()
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+from __future__ import print_function
+'''
+Predicting the cost of fitting blobs, to hand the most expensive ones
+out first in stage_fitblobs (so that one big blob does not run alone
+at the end while the other cores sit idle), and to report how well the
+prediction did.
+
+The model is a power law in the number of sources, the number of
+images overlapping the blob and the total number of blob pixels in
+those images:
+
+    log(cpu_blob) = c0 + c1 log(nsrcs) + c2 log(nimages) + c3 log(totalpix)
+
+fit to the cpu_blob, ninblob, blob_nimages and blob_totalpix columns of
+past all-models files:
+
+    python -m legacypipe.blobcost blob-cost.json metrics/*/all-models-*.fits
+
+and used with runbrick --blob-cost-model blob-cost.json.
+'''
+import json
+import numpy as np
+
+import logging
+logger = logging.getLogger('legacypipe.blobcost')
+def info(*args):
+    from legacypipe.utils import log_info
+    log_info(logger, args)
+def debug(*args):
+    from legacypipe.utils import log_debug
+    log_debug(logger, args)
+
+class BlobCostModel(object):
+    '''
+    Predicted CPU seconds of fitting a blob.  Without coefficients, the
+    prediction is the blob's pixel count (the historical ordering).
+
+    Subclasses can override predict(); stage_fitblobs accepts any object
+    with this method.
+    '''
+    def __init__(self, coeffs=None):
+        self.coeffs = coeffs
+
+    def predict(self, nsrcs, nimages, totalpix, npix):
+        '''
+        Vectorized over blobs; returns an array of predicted costs.
+        '''
+        if self.coeffs is None:
+            return np.asarray(npix, np.float64)
+        c0,c1,c2,c3 = self.coeffs
+        return np.exp(c0 + c1 * np.log(np.maximum(nsrcs, 1)) +
+                      c2 * np.log(np.maximum(nimages, 1)) +
+                      c3 * np.log(np.maximum(totalpix, 1)))
+
+    @classmethod
+    def fit(cls, T):
+        '''
+        Least-squares fit of the coefficients on table *T* (one row per
+        blob, with cpu_blob, ninblob, blob_nimages, blob_totalpix).
+        '''
+        I = np.flatnonzero((T.cpu_blob > 0) * (T.ninblob > 0) *
+                           (T.blob_nimages > 0) * (T.blob_totalpix > 0))
+        A = np.vstack([np.ones(len(I)),
+                       np.log(T.ninblob[I]),
+                       np.log(T.blob_nimages[I]),
+                       np.log(T.blob_totalpix[I])]).T
+        b = np.log(T.cpu_blob[I])
+        coeffs,_,_,_ = np.linalg.lstsq(A, b, rcond=None)
+        model = cls(coeffs=[float(c) for c in coeffs])
+        resid = b - A.dot(coeffs)
+        info('Fit blob cost model to', len(I), 'blobs: coefficients',
+             model.coeffs, 'rms log residual %.2f' % np.sqrt(np.mean(resid**2)))
+        return model
+
+    @classmethod
+    def read(cls, fn):
+        with open(fn) as f:
+            return cls(coeffs=json.load(f)['coeffs'])
+
+    def write(self, fn):
+        with open(fn, 'w') as f:
+            json.dump(dict(coeffs=self.coeffs), f)
+
+def get_blob_cost_model(model):
+    '''
+    *model*: None (pixel count), a json filename (BlobCostModel.write)
+    or an object with a predict() method.
+    '''
+    if model is None:
+        return BlobCostModel()
+    if isinstance(model, str):
+        return BlobCostModel.read(model)
+    return model
+
+def read_blob_table(fns):
+    '''
+    One row per blob from the given all-models files.
+    '''
+    from astrometry.util.fits import fits_table, merge_tables
+    TT = []
+    for fn in fns:
+        T = fits_table(fn, columns=['brickname', 'blob', 'cpu_blob', 'ninblob',
+                                    'blob_nimages', 'blob_totalpix'])
+        if T is None or len(T) == 0:
+            continue
+        _,I = np.unique(T.blob, return_index=True)
+        TT.append(T[I])
+    return merge_tables(TT)
+
+def blob_features(blobslices, blobsrcs, blobs, targetwcs, tims):
+    '''
+    Returns (nsrcs, nimages, totalpix, npix) arrays, one entry per blob:
+    number of sources, of tims overlapping the blob's bounding box,
+    estimated number of blob pixels summed over those tims, and of blob
+    pixels in the brick.
+    '''
+    nb = len(blobslices)
+    nsrcs = np.array([len(s) for s in blobsrcs])
+    npix = np.bincount(blobs[blobs >= 0], minlength=nb)[:nb]
+    bx0 = np.array([sx.start for sy,sx in blobslices])
+    bx1 = np.array([sx.stop  for sy,sx in blobslices])
+    by0 = np.array([sy.start for sy,sx in blobslices])
+    by1 = np.array([sy.stop  for sy,sx in blobslices])
+    # same bounding-box corners as _blob_iter
+    rr,dd = targetwcs.pixelxy2radec(np.hstack([bx0, bx0, bx1, bx1]),
+                                    np.hstack([by0, by1, by1, by0]))
+    nimages = np.zeros(nb, int)
+    totalpix = np.zeros(nb)
+    for tim in tims:
+        h,w = tim.shape
+        _,x,y = tim.subwcs.radec2pixelxy(rr, dd)
+        x = np.reshape(x, (4, nb))
+        y = np.reshape(y, (4, nb))
+        sx0,sx1 = x.min(axis=0), x.max(axis=0)
+        sy0,sy1 = y.min(axis=0), y.max(axis=0)
+        overlap = np.logical_not((sx1 < 0) | (sy1 < 0) | (sx0 > w) | (sy0 > h))
+        area = np.maximum((sx1 - sx0) * (sy1 - sy0), 1.)
+        inside = ((np.clip(sx1, 0, w) - np.clip(sx0, 0, w)) *
+                  (np.clip(sy1, 0, h) - np.clip(sy0, 0, h)))
+        nimages += overlap
+        totalpix += overlap * npix * np.clip(inside / area, 0., 1.)
+    return nsrcs, nimages, totalpix, npix
+
+def makespan(costs, nworkers):
+    '''
+    Finishing time of running *costs*, in order, on *nworkers* workers
+    that each take the next task when free.
+    '''
+    import heapq
+    free = [0.] * max(nworkers, 1)
+    for c in costs:
+        t = heapq.heappop(free)
+        heapq.heappush(free, t + c)
+    return max(free)
+
+def timing_table(iblobs, features, predicted, R):
+    '''
+    Per-blob predicted and actual (cpu_blob; -1 if not fit) costs, from
+    the one_blob results *R* (dicts with 'iblob' and 'result').
+    '''
+    from astrometry.util.fits import fits_table
+    nsrcs, nimages, totalpix, npix = features
+    actual = np.zeros(len(npix), np.float32) - 1.
+    for r in R:
+        res = r['result']
+        if res is None or len(res) == 0:
+            continue
+        actual[r['iblob']] = res.cpu_blob[0]
+    T = fits_table()
+    T.iblob = np.array(iblobs).astype(np.int32)
+    T.nsrcs = nsrcs[iblobs].astype(np.int32)
+    T.nimages = nimages[iblobs].astype(np.int16)
+    T.totalpix = totalpix[iblobs].astype(np.float32)
+    T.npix = npix[iblobs].astype(np.int32)
+    T.cpu_predicted = predicted[iblobs].astype(np.float32)
+    T.cpu_blob = actual[iblobs]
+    return T
+
+def report_timing(T, nworkers):
+    '''
+    Logs predicted-vs-actual totals and tail latency for a timing table
+    in execution order.
+    '''
+    I = np.flatnonzero(T.cpu_blob >= 0)
+    if len(I) == 0:
+        return
+    pred = T.cpu_predicted[I]
+    act = T.cpu_blob[I]
+    # scale of the predictions, if the model is not in seconds
+    scale = act.sum() / max(pred.sum(), 1e-12)
+    info('Blob costs: %i blobs, %.1f CPU s, predicted %.1f (x%.3g); largest %.1f s, predicted %.1f' %
+         (len(I), act.sum(), pred.sum(), scale, act.max(), pred.max() * scale))
+    if len(I) > 2:
+        ok = (pred > 0) * (act > 0)
+        if np.sum(ok) > 2:
+            rho = np.corrcoef(np.log(pred[ok]), np.log(act[ok]))[0,1]
+            info('Blob costs: log predicted vs actual correlation %.2f' % rho)
+    info('Blob costs: with %i workers, expected wall time %.1f s (predicted order), %.1f s if perfectly ordered, ideal %.1f s' %
+         (nworkers, makespan(act, nworkers),
+          makespan(np.sort(act)[::-1], nworkers), act.sum() / max(nworkers, 1)))
+
+if __name__ == '__main__':
+    import sys
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Fit a blob cost model (for runbrick --blob-cost-model) to past all-models files')
+    parser.add_argument('out', help='Output json filename')
+    parser.add_argument('files', nargs='+', help='all-models-*.fits files')
+    opt = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stdout)
+    T = read_blob_table(opt.files)
+    model = BlobCostModel.fit(T)
+    model.write(opt.out)
+    print('Wrote', opt.out)
@@ -0,0 +1,167 @@
+from __future__ import print_function
+'''
+Append-only checkpoint journal for stage_fitblobs.
+
+Each one_blob result is appended as it arrives, as one framed record:
+
+    magic (4 bytes) | payload length (uint64) | crc32 of payload (uint32) | payload
+
+where the payload is the pickled result dict.  Writing a result costs
+the same whatever the number of results before it, and a journal cut
+short by a killed job is read up to its last complete record.
+
+Older checkpoint files (a single pickled list, as written by
+runbrick._write_checkpoint and farm.py) are still read, and are
+rewritten as a journal before appending to them.
+'''
+import os
+import struct
+import time
+import zlib
+import pickle
+
+import logging
+logger = logging.getLogger('legacypipe.checkpoint')
+def info(*args):
+    from legacypipe.utils import log_info
+    log_info(logger, args)
+def debug(*args):
+    from legacypipe.utils import log_debug
+    log_debug(logger, args)
+
+RECORD_MAGIC = b'LPCK'
+RECORD_HEADER = struct.Struct('<4sQI')
+
+def _is_journal(fn):
+    with open(fn, 'rb') as f:
+        return f.read(len(RECORD_MAGIC)) == RECORD_MAGIC
+
+def _read_records(fn):
+    # yields (result, end offset of its record)
+    if not _is_journal(fn):
+        from astrometry.util.file import unpickle_from_file
+        for r in unpickle_from_file(fn):
+            yield r, None
+        return
+    with open(fn, 'rb') as f:
+        offset = 0
+        while True:
+            hdr = f.read(RECORD_HEADER.size)
+            if len(hdr) == 0:
+                break
+            if len(hdr) < RECORD_HEADER.size:
+                info('Checkpoint journal', fn, 'has a truncated record header at byte', offset)
+                break
+            magic,n,crc = RECORD_HEADER.unpack(hdr)
+            if magic != RECORD_MAGIC:
+                info('Checkpoint journal', fn, 'has a bad record at byte', offset)
+                break
+            payload = f.read(n)
+            if len(payload) < n:
+                info('Checkpoint journal', fn, 'has a truncated record at byte', offset)
+                break
+            if zlib.crc32(payload) & 0xffffffff != crc:
+                info('Checkpoint journal', fn, 'has a record with a bad checksum at byte', offset)
+                break
+            offset += RECORD_HEADER.size + n
+            yield pickle.loads(payload), offset
+
+class CheckpointJournal(object):
+    '''
+    Append-only checkpoint file of one_blob results.
+
+    Usage:
+        journal = CheckpointJournal(fn)
+        R = [r for r in journal.read() if ...]   # resume
+        journal.open(keep=R)
+        for r in results:
+            journal.append(r)
+        journal.close()
+
+    *fsync_period*: seconds between fsync() calls; records are flushed
+    to the OS after each append regardless.
+    '''
+    def __init__(self, fn, fsync_period=60.):
+        self.fn = fn
+        self.fsync_period = fsync_period
+        self.f = None
+        self.good_size = 0
+        self.nread = 0
+        self.is_journal = False
+        self.last_sync = time.time()
+        self.nwritten = 0
+
+    def read(self):
+        '''
+        Yields the checkpointed results, remembering how much of the
+        file is valid.
+        '''
+        self.good_size = 0
+        self.nread = 0
+        self.is_journal = (os.path.exists(self.fn) and _is_journal(self.fn))
+        if not os.path.exists(self.fn):
+            return
+        for r,offset in _read_records(self.fn):
+            if offset is not None:
+                self.good_size = offset
+            self.nread += 1
+            yield r
+
+    def open(self, keep=None):
+        '''
+        Opens the journal for appending.  A truncated tail left by a
+        killed job is cut off.  If some checkpointed results were
+        rejected (*keep* is the list of those accepted) or the file is
+        in the old single-pickle format, it is rewritten with *keep*.
+        '''
+        from astrometry.util.file import trymakedirs
+        d = os.path.dirname(self.fn)
+        if len(d) and not os.path.exists(d):
+            trymakedirs(d)
+        rewrite = (keep is not None and
+                   (not self.is_journal or
+                    len(keep) != self.nread))
+        if rewrite:
+            tmpfn = self.fn + '.tmp'
+            with open(tmpfn, 'wb') as f:
+                for r in keep:
+                    f.write(self._frame(r))
+            os.rename(tmpfn, self.fn)
+            debug('Rewrote checkpoint journal', self.fn, 'with', len(keep), 'results')
+        elif os.path.exists(self.fn) and self.is_journal:
+            if os.path.getsize(self.fn) != self.good_size:
+                info('Cutting checkpoint journal', self.fn, 'to', self.good_size, 'bytes')
+                with open(self.fn, 'r+b') as f:
+                    f.truncate(self.good_size)
+        else:
+            # no checkpoint (or unreadable) -- start afresh
+            open(self.fn, 'wb').close()
+        self.f = open(self.fn, 'ab')
+        self.last_sync = time.time()
+
+    @staticmethod
+    def _frame(r):
+        payload = pickle.dumps(r, protocol=pickle.HIGHEST_PROTOCOL)
+        return (RECORD_HEADER.pack(RECORD_MAGIC, len(payload),
+                                   zlib.crc32(payload) & 0xffffffff) + payload)
+
+    def append(self, r):
+        '''
+        Appends one result; cost is independent of the journal length.
+        '''
+        self.f.write(self._frame(r))
+        self.f.flush()
+        self.nwritten += 1
+        now = time.time()
+        if now - self.last_sync >= self.fsync_period:
+            os.fsync(self.f.fileno())
+            self.last_sync = now
+
+    def close(self):
+        if self.f is None:
+            return
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
+        self.f = None
+        debug('Appended', self.nwritten, 'results to checkpoint journal', self.fn)
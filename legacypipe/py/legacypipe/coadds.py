@@ -4,7 +4,7 @@ import fitsio
 from astrometry.util.fits import fits_table
 from astrometry.util.resample import resample_with_wcs, OverlapError
 from legacypipe.bits import DQ_BITS
-from legacypipe.survey import tim_get_resamp
+from legacypipe.survey import tim_get_resamp, tim_resample
 
 import logging
 logger = logging.getLogger('legacypipe.coadds')
@@ -137,7 +137,11 @@ def make_coadds(tims, bands, targetwcs,
                 callback=None, callback_args=None,
                 plots=False, ps=None,
                 lanczos=True, mp=None,
-                satur_val=10.):
+                satur_val=10., stream=False):
+    # With stream=True, the bands are resampled one after another and
+    # each band's maps are released once the callback has seen them
+    # (and its aperture photometry is done); only the images
+    # (C.coimgs, C.comods, C.coresids) are kept for the caller.
     from astrometry.util.ttime import Time
     t0 = Time()
 
@@ -191,8 +195,10 @@ def make_coadds(tims, bands, targetwcs,
         tim.sbscale = (targetwcs.pixel_scale() / tim.subwcs.pixel_scale())**2
 
     # We create one iterator per band to do the tim resampling.  These all run in
-    # parallel when multi-processing.
-    imaps = []
+    # parallel when multi-processing -- unless streaming, where each band's
+    # iterator is only started when we get to that band, so that results
+    # for the other bands do not queue up in memory.
+    bandargs = []
     for band in bands:
         args = []
         for itim,tim in enumerate(tims):
@@ -203,13 +209,21 @@ def make_coadds(tims, bands, targetwcs,
             else:
                 mo = mods[itim]
             args.append((itim,tim,mo,lanczos,targetwcs,sbscale))
+        bandargs.append(args)
+    def _resample_band(args):
         if mp is not None:
-            imaps.append(mp.imap_unordered(_resample_one, args))
-        else:
-            imaps.append(map(_resample_one, args))
+            return mp.imap_unordered(_resample_one, args)
+        return map(_resample_one, args)
+    if stream:
+        imaps = (_resample_band(args) for args in bandargs)
+    else:
+        imaps = [_resample_band(args) for args in bandargs]
+    del bandargs
 
     # Args for aperture photometry
     apargs = []
+    # When streaming, aperture photometry results, band by band
+    apresults = []
 
     if xy:
         # To save the memory of 2 x float64 maps, we instead do arg min/max maps
@@ -238,12 +252,13 @@ def make_coadds(tims, bands, targetwcs,
         if detmaps:
             # detection map inverse-variance (depth map)
             psfdetiv = np.zeros((H,W), np.float32)
-            C.psfdetivs.append(psfdetiv)
             kwargs.update(psfdetiv=psfdetiv)
             # galaxy detection map inverse-variance (galdepth map)
             galdetiv = np.zeros((H,W), np.float32)
-            C.galdetivs.append(galdetiv)
             kwargs.update(galdetiv=galdetiv)
+            if not stream:
+                C.psfdetivs.append(psfdetiv)
+                C.galdetivs.append(galdetiv)
 
         if mods is not None:
             # model image
@@ -260,9 +275,11 @@ def make_coadds(tims, bands, targetwcs,
                 comod  = np.zeros((H,W), np.float32)
             # number of exposures
             con    = np.zeros((H,W), np.int16)
-            # inverse-variance
-            coiv   = np.zeros((H,W), np.float32)
-            kwargs.update(coimg=coimg, coiv=coiv)
+            kwargs.update(coimg=coimg)
+            if apertures is not None:
+                # inverse-variance
+                coiv   = np.zeros((H,W), np.float32)
+                kwargs.update(coiv=coiv)
 
         # Note that we have 'congood' as well as 'nobs':
         # * 'congood' is used for the 'nexp' *image*.
@@ -302,7 +319,8 @@ def make_coadds(tims, bands, targetwcs,
 
         if max:
             maximg = np.zeros((H,W), np.float32)
-            C.maximgs.append(maximg)
+            if not stream:
+                C.maximgs.append(maximg)
 
         for R in timiter:
             if R is None:
@@ -397,9 +415,12 @@ def make_coadds(tims, bands, targetwcs,
                 ps.savefig()
                 allresids.append((tim.time.toYear(), tim.name, rgbimg,rgbmod,thisres))
 
+            # Accumulate through the bounding box of this tim in the brick
+            win = _CoaddWindow(Yo, Xo)
+
             # invvar-weighted image
-            cowimg[Yo,Xo] += iv * im
-            cow   [Yo,Xo] += iv
+            win.update(cowimg, iv * im)
+            win.update(cow, iv)
 
             if unweighted:
                 if dq is None:
@@ -419,27 +440,24 @@ def make_coadds(tims, bands, targetwcs,
                         okbits |= DQ_BITS[bitname]
                     goodpix = ((dq & ~okbits) == 0)
 
-                coimg[Yo,Xo] += goodpix * im
-                con  [Yo,Xo] += goodpix
-                coiv [Yo,Xo] += goodpix * 1./(tim.sig1 * tim.sbscale)**2  # ...ish
+                win.update(coimg, goodpix * im)
+                win.update(con, goodpix)
+                if apertures is not None:
+                    win.update(coiv, goodpix * 1./(tim.sig1 * tim.sbscale)**2)  # ...ish
 
             if xy:
                 if dq is not None:
-                    ormask [Yo,Xo] |= dq
-                    andmask[Yo,Xo] &= dq
+                    win.update(ormask, dq, np.bitwise_or)
+                    win.update(andmask, dq, np.bitwise_and)
                 # raw exposure count
-                nobs[Yo,Xo] += 1
-
-                # mjd_min/max
-                update = np.logical_or(mjd_argmins[Yo,Xo] == -1,
-                                       (mjd_argmins[Yo,Xo] > -1) *
-                                       (mjds[itim] < mjds[mjd_argmins[Yo,Xo]]))
-                mjd_argmins[Yo[update],Xo[update]] = itim
-                update = np.logical_or(mjd_argmaxs[Yo,Xo] == -1,
-                                       (mjd_argmaxs[Yo,Xo] > -1) *
-                                       (mjds[itim] > mjds[mjd_argmaxs[Yo,Xo]]))
-                mjd_argmaxs[Yo[update],Xo[update]] = itim
-                del update
+                win.update(nobs, 1)
+
+                # mjd_min/max (mjds[-1] is 0, so -1 is always updated)
+                argmin = mjd_argmins[win.slc]
+                argmin[win.cover * ((argmin == -1) | (mjds[itim] < mjds[argmin]))] = itim
+                argmax = mjd_argmaxs[win.slc]
+                argmax[win.cover * ((argmax == -1) | (mjds[itim] > mjds[argmax]))] = itim
+                del argmin, argmax
 
             if psfsize:
                 # psfnorm is in units of 1/pixels.
@@ -452,40 +470,44 @@ def make_coadds(tims, bands, targetwcs,
                 #psfsizemap[Yo,Xo] += (iv>0) * (1/tim.sig1**2) * (1. / narcsec)
                 #flatcow[Yo,Xo] += (iv>0) * (1/tim.sig1**2)
                 iv1 = 1./tim.sig1**2
-                psfsizemap[Yo,Xo] += iv1 * (1. / narcsec)
-                flatcow   [Yo,Xo] += iv1
+                win.update(psfsizemap, iv1 * (1. / narcsec))
+                win.update(flatcow, iv1)
+
+            if detmaps or ngood or max:
+                ivpos = (iv > 0)
 
             if detmaps:
                 # point-source depth
                 detsig1 = tim.sig1 / tim.psfnorm
-                psfdetiv[Yo,Xo] += (iv > 0) * (1. / detsig1**2)
+                win.update(psfdetiv, ivpos * (1. / detsig1**2))
 
                 # Galaxy detection map
                 gdetsig1 = tim.sig1 / tim.galnorm
-                galdetiv[Yo,Xo] += (iv > 0) * (1. / gdetsig1**2)
+                win.update(galdetiv, ivpos * (1. / gdetsig1**2))
 
             if ngood:
-                congood[Yo,Xo] += (iv > 0)
+                win.update(congood, ivpos)
 
             if mods is not None:
                 # straight-up
-                comod[Yo,Xo] += goodpix * mo
+                win.update(comod, goodpix * mo)
                 # invvar-weighted
-                cowmod[Yo,Xo] += iv * mo
+                win.update(cowmod, iv * mo)
                 # chi-squared
-                cochi2[Yo,Xo] += iv * (im - mo)**2
+                win.update(cochi2, iv * (im - mo)**2)
                 del mo
                 del goodpix
 
             if max:
-                maximg[Yo,Xo] = np.maximum(maximg[Yo,Xo], im * (iv>0))
+                win.update(maximg, im * ivpos, np.maximum)
 
-            del Yo,Xo,im,iv
+            del Yo,Xo,im,iv,win
             # END of loop over tims
         # Per-band:
         cowimg /= np.maximum(cow, tinyw)
         C.coimgs.append(cowimg)
-        C.cowimgs.append(cow)
+        if not stream:
+            C.cowimgs.append(cow)
         if mods is not None:
             cowmod  /= np.maximum(cow, tinyw)
             C.comods.append(cowmod)
@@ -493,7 +515,7 @@ def make_coadds(tims, bands, targetwcs,
             coresid[cow == 0] = 0.
             C.coresids.append(coresid)
 
-        if allmasks:
+        if allmasks and not stream:
             C.allmasks.append(andmask)
 
         if unweighted:
@@ -531,9 +553,11 @@ def make_coadds(tims, bands, targetwcs,
                 ps.savefig()
 
 
-            cowimg[cow == 0] = coimg[cow == 0]
+            nocow = (cow == 0)
+            cowimg[nocow] = coimg[nocow]
             if mods is not None:
-                cowmod[cow == 0] = comod[cow == 0]
+                cowmod[nocow] = comod[nocow]
+            del nocow
 
         if xy:
             C.T.nobs   [:,iband] = nobs   [iy,ix]
@@ -573,8 +597,45 @@ def make_coadds(tims, bands, targetwcs,
 
         if callback is not None:
             callback(band, *callback_args, **kwargs)
+
+        if stream:
+            if apertures is not None:
+                # Photometer this band now, so that its maps can go
+                apresults.extend(_apphot(apargs, mp))
+                apargs = []
+                del imsigma
+            del kwargs, cow
+            if detmaps:
+                del psfdetiv, galdetiv
+            if mods is not None:
+                del cochi2
+            if unweighted:
+                del coimg
+                if mods is not None:
+                    del comod
+                if apertures is not None:
+                    del coiv
+            if ngood:
+                del congood
+            if xy:
+                del nobs
+            if psfsize:
+                del psfsizemap, flatcow
+            if xy or allmasks:
+                del ormask, andmask
+            if max:
+                del maximg
         # END of loop over bands
 
+    if stream:
+        C.cowimgs = None
+        if detmaps:
+            C.galdetivs = C.psfdetivs = None
+        if allmasks is not None:
+            C.allmasks = None
+        if max:
+            C.maximgs = None
+
     t2 = Time()
     debug('coadds: images:', t2-t0)
 
@@ -618,10 +679,8 @@ def make_coadds(tims, bands, targetwcs,
 
     if apertures is not None:
         # Aperture phot, in parallel
-        if mp is not None:
-            apresults = mp.map(_apphot_one, apargs)
-        else:
-            apresults = map(_apphot_one, apargs)
+        if not stream:
+            apresults = _apphot(apargs, mp)
         del apargs
         apresults = iter(apresults)
 
@@ -671,6 +730,39 @@ def make_coadds(tims, bands, targetwcs,
 
     return C
 
+class _CoaddWindow(object):
+    '''
+    The bounding box, in the brick, of the pixels (Yo,Xo) that one tim
+    resamples to.  Per-pixel values are scattered once into a dense
+    window and combined into the brick maps with in-place ufuncs on the
+    window's slice, rather than with fancy-indexed read-modify-writes
+    of the full maps.
+    '''
+    def __init__(self, Yo, Xo):
+        y0,y1 = int(Yo.min()), int(Yo.max())+1
+        x0,x1 = int(Xo.min()), int(Xo.max())+1
+        self.shape = (y1-y0, x1-x0)
+        self.slc = (slice(y0, y1), slice(x0, x1))
+        self.idx = (Yo - y0).astype(np.intp) * self.shape[1] + (Xo - x0)
+        cover = np.zeros(self.shape, bool)
+        cover.reshape(-1)[self.idx] = True
+        self.cover = cover
+        # scratch windows, by dtype
+        self.dense = {}
+
+    def update(self, X, v, op=np.add):
+        '''
+        X[Yo,Xo] = op(X[Yo,Xo], v), for *v* per pixel or a scalar.
+        '''
+        if not np.isscalar(v):
+            buf = self.dense.get(v.dtype)
+            if buf is None:
+                buf = self.dense[v.dtype] = np.empty(self.shape, v.dtype)
+            buf.reshape(-1)[self.idx] = v
+            v = buf
+        view = X[self.slc]
+        op(view, v, out=view, where=self.cover)
+
 def _resample_one(args):
     (itim,tim,mod,lanczos,targetwcs,sbscale) = args
     if lanczos:
@@ -686,8 +778,7 @@ def _resample_one(args):
         imgs = []
 
     try:
-        Yo,Xo,Yi,Xi,rimgs = resample_with_wcs(
-            targetwcs, tim.subwcs, imgs, 3, intType=np.int16)
+        Yo,Xo,Yi,Xi,rimgs = tim_resample(tim, targetwcs, imgs)
     except OverlapError:
         return None
     if len(Yo) == 0:
@@ -716,6 +807,11 @@ def _resample_one(args):
         dq = tim.dq[Yi,Xi]
     return itim,Yo,Xo,iv,im,mo,dq
 
+def _apphot(apargs, mp):
+    if mp is not None:
+        return mp.map(_apphot_one, apargs)
+    return list(map(_apphot_one, apargs))
+
 def _apphot_one(args):
     (irad, band, rad, img, sigma, isimage, apxy) = args
     import photutils
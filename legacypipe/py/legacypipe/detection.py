@@ -40,6 +40,95 @@ def _detmap(X):
         sat = ((tim.dq[Yi,Xi] & tim.dq_saturation_bits) > 0)
     return Yo, Xo, detim[Yi,Xi], detiv[Yi,Xi], sat
 
+def _apodize_weights(n, apodize):
+    # per-row (or -column) factors applied to detiv by _detmap's apodization
+    ramp = np.arctan(np.linspace(-np.pi, np.pi, apodize+2))
+    ramp = (ramp - ramp.min()) / (ramp.max()-ramp.min())
+    ramp = ramp[1:-1]
+    w = np.ones(n)
+    w[:len(ramp)] *= ramp
+    w[-len(ramp):] *= ramp[::-1]
+    return w
+
+def _detmap_delta(X):
+    from scipy.ndimage.filters import gaussian_filter
+    from scipy.ndimage.measurements import label, find_objects
+    from legacypipe.survey import tim_get_resamp
+    (tim, img, targetwcs, apodize) = X
+    # the nearest-pixel mapping of _detmap, so that the deltas land on the
+    # same brick pixels as a full detection_maps() run
+    R = tim_get_resamp(tim, targetwcs)
+    if R is None:
+        return []
+    (Yo,Xo,Yi,Xi) = R
+    assert(tim.psf_sigma > 0)
+    psfnorm = 1./(2. * np.sqrt(np.pi) * tim.psf_sigma)
+    detsig1 = tim.sig1 / psfnorm
+    h,w = tim.shape
+    # gaussian_filter kernel radius (truncate=4), plus one
+    r = int(4. * tim.psf_sigma + 0.5) + 1
+    ie = tim.getInvError()
+    if apodize:
+        wy = _apodize_weights(h, int(apodize))
+        wx = _apodize_weights(w, int(apodize))
+    # mapped tim pixels, in row-major order, to look up the boxes below
+    I = np.argsort(Yi.astype(np.int64) * w + Xi, kind='stable')
+    pix = Yi[I].astype(np.int64) * w + Xi[I]
+    deltas = []
+    regions,_ = label(img != 0)
+    for k,slc in enumerate(find_objects(regions)):
+        if slc is None:
+            continue
+        sy,sx = slc
+        # where the smoothed region is non-zero...
+        oy0,oy1 = max(sy.start - r, 0), min(sy.stop + r, h)
+        ox0,ox1 = max(sx.start - r, 0), min(sx.stop + r, w)
+        # ... and the pixels the filters need to get it exactly right
+        iy0,iy1 = max(oy0 - r, 0), min(oy1 + r, h)
+        ix0,ix1 = max(ox0 - r, 0), min(ox1 + r, w)
+        cut = slice(iy0, iy1), slice(ix0, ix1)
+        sub = np.where(regions[cut] == k+1, img[cut], 0.).astype(np.float32)
+        detim = gaussian_filter(sub, tim.psf_sigma) / psfnorm**2
+        detiv = np.zeros(sub.shape, np.float32) + (1. / detsig1**2)
+        detiv[ie[cut] == 0] = 0.
+        detiv = gaussian_filter(detiv, tim.psf_sigma)
+        if apodize:
+            detiv *= (wy[iy0:iy1,np.newaxis] * wx[np.newaxis,ix0:ix1])
+        oslc = slice(oy0 - iy0, oy1 - iy0), slice(ox0 - ix0, ox1 - ix0)
+        detim = detim[oslc]
+        detiv = detiv[oslc]
+        rows = np.arange(oy0, oy1) * w
+        J = np.hstack([I[i0:i1] for i0,i1 in zip(
+            np.searchsorted(pix, rows + ox0), np.searchsorted(pix, rows + ox1))])
+        if len(J) == 0:
+            continue
+        yi = Yi[J] - oy0
+        xi = Xi[J] - ox0
+        deltas.append((Yo[J], Xo[J], detim[yi,xi] * detiv[yi,xi]))
+    return deltas
+
+def detection_map_deltas(tims, images, targetwcs, bands, mp, apodize=None):
+    '''
+    Returns, per band, the change of the detection_maps() numerator
+    (detmap * detiv) when *images* (one per tim, or None) are added to
+    the tims' images, e.g. injected sources; detiv does not change.
+
+    Only the pixels near the non-zero pixels of *images* are filtered,
+    and they are mapped into the brick with the tims' own nearest-pixel
+    resampling (tim_get_resamp), as in detection_maps().
+    '''
+    H,W = targetwcs.shape
+    H,W = int(H), int(W)
+    ibands = dict([(b,i) for i,b in enumerate(bands)])
+    dnums = [np.zeros((H,W), np.float32) for b in bands]
+    todo = [(tim,img) for tim,img in zip(tims, images) if img is not None]
+    for (tim,img),deltas in zip(todo, mp.map(
+            _detmap_delta, [(tim, img, targetwcs, apodize) for tim,img in todo])):
+        ib = ibands[tim.band]
+        for Yo,Xo,dnum in deltas:
+            dnums[ib][Yo,Xo] += dnum
+    return dnums
+
 def detection_maps(tims, targetwcs, bands, mp, apodize=None):
     # Render the detection maps
     H,W = targetwcs.shape
@@ -0,0 +1,143 @@
+from __future__ import print_function
+'''
+Per-brick cache of the detection maps of stage_srcs, for runs that
+repeatedly add a few sources to the same images (obiwan injections).
+
+The first run of a brick stores the detection maps of the images
+*without* the added sources; later runs read them back and only add
+the contribution of their own added sources (detection_map_deltas),
+instead of resampling every tim into the brick again.
+
+The added sources of a tim are its `sims_image` attribute (as set by
+obiwan's SimImage.get_tractor_image); tims without one are taken as is.
+Adding sources must not change which pixels have zero inverse-variance.
+'''
+import os
+import json
+import tempfile
+import numpy as np
+
+from legacypipe.detection import detection_maps, detection_map_deltas
+
+import logging
+logger = logging.getLogger('legacypipe.detmapcache')
+
+# LegacySurveyImage files the tims are read from; the key holds their
+# size and modification time, so that new calibrations invalidate a cache
+CALIB_FILES = ['imgfn', 'wtfn', 'dqfn', 'psffn', 'merged_psffn',
+               'skyfn', 'splineskyfn', 'merged_splineskyfn']
+def info(*args):
+    from legacypipe.utils import log_info
+    log_info(logger, args)
+def debug(*args):
+    from legacypipe.utils import log_debug
+    log_debug(logger, args)
+
+class DetectionMapCache(object):
+    '''
+    Baseline detection maps, one npz file per brick under *dirnm*.
+    '''
+    def __init__(self, dirnm):
+        self.dirnm = dirnm
+
+    def fn(self, brickname):
+        return os.path.join(self.dirnm, 'detmaps-%s.npz' % brickname)
+
+    @staticmethod
+    def tim_key(tim):
+        '''
+        What the baseline maps depend on for one tim: its name, PSF
+        sigma and noise, and its image and calibration files.
+        '''
+        files = []
+        for attr in CALIB_FILES:
+            fn = getattr(getattr(tim, 'imobj', None), attr, None)
+            if fn is not None and os.path.exists(fn):
+                st = os.stat(fn)
+                files.append([fn, st.st_size, int(st.st_mtime)])
+        psf_sigma = getattr(tim, 'psf_sigma', None)
+        sig1 = getattr(tim, 'sig1', None)
+        return [tim.name,
+                None if psf_sigma is None else float(psf_sigma),
+                None if sig1 is None else float(sig1),
+                files]
+
+    @staticmethod
+    def key(tims, targetwcs, bands, apodize):
+        '''
+        What the baseline maps depend on, as a string.
+        '''
+        H,W = targetwcs.shape
+        return json.dumps(dict(
+            tims=sorted([DetectionMapCache.tim_key(tim) for tim in tims],
+                        key=lambda k: k[0]),
+            bands=list(bands), apodize=apodize, shape=[int(H), int(W)],
+            crval=[float(x) for x in targetwcs.crval],
+            crpix=[float(x) for x in targetwcs.crpix],
+            cd=[float(x) for x in targetwcs.cd]))
+
+    def get(self, brickname, key):
+        '''
+        Returns (detmaps, detivs, satmaps) lists, or None if not cached
+        (or cached for other tims or another target WCS).
+        '''
+        fn = self.fn(brickname)
+        if not os.path.exists(fn):
+            return None
+        try:
+            with np.load(fn) as X:
+                if str(X['key']) != key:
+                    info('Detection-map cache', fn, 'is for other inputs; ignoring it')
+                    return None
+                return (list(X['detmaps']), list(X['detivs']),
+                        list(X['satmaps']))
+        except Exception as e:
+            info('Failed to read detection-map cache', fn, ':', e)
+            return None
+
+    def put(self, brickname, key, detmaps, detivs, satmaps):
+        from astrometry.util.file import trymakedirs
+        trymakedirs(self.dirnm)
+        fn = self.fn(brickname)
+        # unique per writer: rs-chunks of a brick may run at the same time,
+        # on different nodes
+        f,tmpfn = tempfile.mkstemp(dir=self.dirnm, suffix='.tmp.npz')
+        os.close(f)
+        try:
+            np.savez(tmpfn, key=key, detmaps=np.array(detmaps),
+                     detivs=np.array(detivs), satmaps=np.array(satmaps))
+            os.rename(tmpfn, fn)
+        except (IOError, OSError) as e:
+            info('Failed to write detection-map cache', fn, ':', e)
+            if os.path.exists(tmpfn):
+                os.remove(tmpfn)
+            return
+        debug('Wrote detection-map cache', fn)
+
+def cached_detection_maps(cache, brickname, tims, targetwcs, bands, mp,
+                          apodize=None):
+    '''
+    Same as detection_maps(), using and filling the DetectionMapCache
+    *cache*.
+    '''
+    images = [getattr(tim, 'sims_image', None) for tim in tims]
+    key = cache.key(tims, targetwcs, bands, apodize)
+    base = cache.get(brickname, key)
+    if base is None:
+        detmaps, detivs, satmaps = detection_maps(tims, targetwcs, bands, mp,
+                                                  apodize=apodize)
+        # the baseline: these maps minus the added sources
+        dnums = detection_map_deltas(tims, images, targetwcs, bands, mp,
+                                     apodize=apodize)
+        basemaps = [(detmap * detiv - dnum) / np.maximum(1e-16, detiv)
+                    for detmap,detiv,dnum in zip(detmaps, detivs, dnums)]
+        cache.put(brickname, key, basemaps, detivs, satmaps)
+        return detmaps, detivs, satmaps
+
+    info('Using cached detection maps for brick', brickname)
+    basemaps, detivs, satmaps = base
+    dnums = detection_map_deltas(tims, images, targetwcs, bands, mp,
+                                 apodize=apodize)
+    detmaps = [(basemap + dnum / np.maximum(1e-16, detiv)).astype(np.float32)
+               for basemap,detiv,dnum in zip(basemaps, detivs, dnums)]
+    return detmaps, detivs, satmaps
@@ -58,6 +58,105 @@ def remap_dq_cp_codes(dq):
     dqbits[dq == 8] |= DQ_BITS['trans']
     return dqbits
 
+class MergedCalibCache(object):
+    '''
+    Process-wide cache of the merged (one file per exposure) PsfEx and
+    splinesky tables, so that the CCDs of an exposure read its file
+    once instead of once each.
+
+    Tables are keyed on filename, re-read if the file's mtime changed,
+    and indexed by (expnum, ccdname); the least recently used are
+    dropped beyond *maxsize* files.  Consistency validation results are
+    cached per table and image metadata too.
+    '''
+    def __init__(self, maxsize=16):
+        from collections import OrderedDict
+        self.maxsize = maxsize
+        self.tables = OrderedDict()
+
+    def get_table(self, fn):
+        '''
+        Returns the entry for *fn*: a dict with the table 'T', the
+        'index' {(expnum, ccdname): row} and the 'valid' validation results.
+        '''
+        mtime = os.path.getmtime(fn)
+        entry = self.tables.pop(fn, None)
+        if entry is None or entry['mtime'] != mtime:
+            T = fits_table(fn)
+            index = {}
+            for i,(e,c) in enumerate(zip(T.expnum, T.ccdname)):
+                key = (e, c.strip())
+                # duplicated CCDs match nothing
+                index[key] = None if key in index else i
+            entry = dict(T=T, index=index, valid={}, mtime=mtime)
+        # most recently used goes last
+        self.tables[fn] = entry
+        while len(self.tables) > self.maxsize:
+            self.tables.popitem(last=False)
+        return entry
+
+    def validate(self, fn, im, old_calibs_ok=False):
+        '''
+        validate_procdate_plver() of merged calibration file *fn* for image *im*.
+        '''
+        entry = self.get_table(fn)
+        key = (im.expnum, im.plver, im.procdate, im.plprocid, old_calibs_ok)
+        if not key in entry['valid']:
+            entry['valid'][key] = validate_procdate_plver(
+                fn, 'table', im.expnum, im.plver, im.procdate, im.plprocid,
+                data=entry['T'], old_calibs_ok=old_calibs_ok)
+        return entry['valid'][key]
+
+    def get_row(self, fn, im):
+        '''
+        Returns the row of merged calibration file *fn* for image *im*,
+        None unless it has exactly one.
+        '''
+        entry = self.get_table(fn)
+        i = entry['index'].get((im.expnum, im.ccdname))
+        if i is None:
+            return None
+        # indexing with an array copies the row, callers can modify it
+        return entry['T'][np.array([i])][0]
+
+merged_calib_cache = MergedCalibCache()
+
+def prefetch_merged_calibs(ims, psf=True, sky=True):
+    '''
+    Reads the merged PsfEx / splinesky file of each exposure of the
+    images *ims* (eg, all the CCDs of a brick) into merged_calib_cache.
+    '''
+    fns = []
+    for im in ims:
+        if psf:
+            fns.append(getattr(im, 'merged_psffn', None))
+        if sky:
+            fns.append(getattr(im, 'merged_splineskyfn', None))
+    # keep them all, in case the brick has many exposures
+    ufns = set([fn for fn in fns if fn and os.path.exists(fn)])
+    merged_calib_cache.maxsize = max(merged_calib_cache.maxsize, len(ufns))
+    for fn in ufns:
+        merged_calib_cache.get_table(fn)
+
+def with_fits_handles(func):
+    '''
+    Decorator for LegacySurveyImage methods: while *func* runs, each
+    FITS file read through the image's methods is opened once and each
+    header parsed once; the files are closed when it returns.
+    '''
+    import functools
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if getattr(self, '_fits_handles', None) is not None:
+            # nested call, the outer one closes the files
+            return func(self, *args, **kwargs)
+        self._fits_handles = {}
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            self.close_fits_handles()
+    return wrapper
+
 class LegacySurveyImage(object):
     '''A base class containing common code for the images we handle.
 
@@ -104,6 +203,9 @@ class LegacySurveyImage(object):
         '''
         super(LegacySurveyImage, self).__init__()
         self.survey = survey
+        # see with_fits_handles
+        self._fits_handles = None
+        self._headers = {}
 
         imgfn = ccd.image_filename.strip()
 
@@ -237,6 +339,7 @@ class LegacySurveyImage(object):
         '''
         return None,None,None,None
 
+    @with_fits_handles
     def get_tractor_image(self, slc=None, radecpoly=None,
                           gaussPsf=False, pixPsf=False, hybridPsf=False,
                           normalizePsf=False,
@@ -293,11 +396,13 @@ class LegacySurveyImage(object):
         assert(validate_procdate_plver(self.wtfn, 'primaryheader',
                                        self.expnum, self.plver, self.procdate,
                                        self.plprocid,
+                                       data=self.read_cached_header(self.wtfn, 0),
                                        cpheader=True,
                                        old_calibs_ok=old_calibs_ok))
         assert(validate_procdate_plver(self.dqfn, 'primaryheader',
                                        self.expnum, self.plver, self.procdate,
                                        self.plprocid,
+                                       data=self.read_cached_header(self.dqfn, 0),
                                        cpheader=True,
                                        old_calibs_ok=old_calibs_ok))
         band = self.band
@@ -319,10 +424,7 @@ class LegacySurveyImage(object):
             imghdr = self.read_image_header()
         assert(np.all(np.isfinite(img)))
         #obiwan
-        import astropy.io.fits as fits
-        img_header = fits.open(self.imgfn)[self.hdu].header
-        #import pdb;pdb.set_trace()
-        img_gain = np.average([img_header['GAINA'],img_header['GAINB']])
+        img_gain = np.average([imghdr['GAINA'],imghdr['GAINB']])
         # Read data-quality (flags) map and zero out the invvars of masked pixels
         if get_invvar:
             get_dq = True
@@ -648,6 +750,17 @@ class LegacySurveyImage(object):
         return galnorm
 
     def _read_fits(self, fn, hdu, slice=None, header=None, **kwargs):
+        if getattr(self, '_fits_handles', None) is not None:
+            # inside with_fits_handles: reuse the open file and parsed header
+            f = self.get_fits_handle(fn)[hdu]
+            if slice is not None:
+                # only the tiles overlapping the slice are decompressed
+                img = f[slice]
+            else:
+                img = f.read(**kwargs)
+            if header:
+                return (img, self.read_cached_header(fn, hdu))
+            return img
         if slice is not None:
             f = fitsio.FITS(fn)[hdu]
             img = f[slice]
@@ -657,6 +770,43 @@ class LegacySurveyImage(object):
             return img
         return fitsio.read(fn, ext=hdu, header=header, **kwargs)
 
+    def get_fits_handle(self, fn):
+        '''
+        Returns the fitsio.FITS of *fn* opened by with_fits_handles,
+        opening it on first use.
+        '''
+        f = self._fits_handles.get(fn)
+        if f is None:
+            f = self._fits_handles[fn] = fitsio.FITS(fn)
+        return f
+
+    def close_fits_handles(self):
+        '''
+        Closes the files opened by get_fits_handle().  They must not
+        outlive the call, since tims (holding this object) get pickled.
+        '''
+        handles, self._fits_handles = self._fits_handles, None
+        for f in (handles or {}).values():
+            f.close()
+
+    def read_cached_header(self, fn, ext):
+        '''
+        Returns the header of extension *ext* of *fn*, read once per
+        image object.
+        '''
+        headers = self.__dict__.setdefault('_headers', {})
+        key = (fn, ext)
+        hdr = headers.get(key)
+        if hdr is None:
+            if ext == 0:
+                hdr = read_primary_header(fn)
+            elif getattr(self, '_fits_handles', None) is not None:
+                hdr = self.get_fits_handle(fn)[ext].read_header()
+            else:
+                hdr = fitsio.read_header(fn, ext=ext)
+            headers[key] = hdr
+        return hdr
+
     def read_image(self, **kwargs):
         '''
         Reads the image file from disk.
@@ -702,7 +852,7 @@ class LegacySurveyImage(object):
         primary_header : fitsio header
             The FITS header
         '''
-        return read_primary_header(self.imgfn)
+        return self.read_cached_header(self.imgfn, 0)
 
     def read_image_header(self, **kwargs):
         '''
@@ -713,7 +863,7 @@ class LegacySurveyImage(object):
         header : fitsio header
             The FITS header
         '''
-        return fitsio.read_header(self.imgfn, ext=self.hdu)
+        return self.read_cached_header(self.imgfn, self.hdu)
 
     def read_dq(self, **kwargs):
         '''
@@ -865,19 +1015,14 @@ class LegacySurveyImage(object):
     def read_merged_splinesky_model(self, slc=None, old_calibs_ok=False):
         from tractor.utils import get_class_from_name
         debug('Reading merged spline sky models from', self.merged_splineskyfn)
-        T = fits_table(self.merged_splineskyfn)
-        if not validate_procdate_plver(self.merged_splineskyfn, 'table',
-                                       self.expnum, self.plver, self.procdate,
-                                       self.plprocid, data=T, old_calibs_ok=old_calibs_ok):
+        if not merged_calib_cache.validate(self.merged_splineskyfn, self,
+                                           old_calibs_ok=old_calibs_ok):
             raise RuntimeError('Merged splinesky file %s did not pass consistency validation (PLVER, PROCDATE/PLPROCID, EXPNUM)' %
                                self.merged_splineskyfn)
-        I, = np.nonzero((T.expnum == self.expnum) *
-                        np.array([c.strip() == self.ccdname
-                                  for c in T.ccdname]))
-        debug('Found', len(I), 'matching CCDs in merged splinesky file')
-        if len(I) != 1:
+        Ti = merged_calib_cache.get_row(self.merged_splineskyfn, self)
+        if Ti is None:
+            debug('No matching CCD in merged splinesky file')
             return None
-        Ti = T[I[0]]
         # Remove any padding
         h,w = Ti.gridh, Ti.gridw
         Ti.gridvals = Ti.gridvals[:h, :w]
@@ -962,21 +1107,14 @@ class LegacySurveyImage(object):
     def read_merged_psfex_model(self, normalizePsf=False, old_calibs_ok=False):
         from tractor import PsfExModel
         debug('Reading merged PsfEx models from', self.merged_psffn)
-        T = fits_table(self.merged_psffn)
-
-        if not validate_procdate_plver(self.merged_psffn, 'table',
-                                       self.expnum, self.plver, self.procdate,
-                                       self.plprocid, data=T, old_calibs_ok=old_calibs_ok):
+        if not merged_calib_cache.validate(self.merged_psffn, self,
+                                           old_calibs_ok=old_calibs_ok):
             raise RuntimeError('Merged PSFEx file %s did not pass consistency validation (PLVER, PROCDATE/PLPROCID, EXPNUM)' %
                   self.merged_psffn)
-
-        I, = np.nonzero((T.expnum == self.expnum) *
-                        np.array([c.strip() == self.ccdname
-                                  for c in T.ccdname]))
-        debug('Found', len(I), 'matching CCDs')
-        if len(I) != 1:
+        Ti = merged_calib_cache.get_row(self.merged_psffn, self)
+        if Ti is None:
+            debug('No matching CCD in merged PsfEx file')
             return None
-        Ti = T[I[0]]
         # Remove any padding
         degree = Ti.poldeg1
         # number of terms in polynomial
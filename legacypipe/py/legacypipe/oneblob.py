@@ -35,7 +35,7 @@ def one_blob(X):
     if X is None:
         return None
     (nblob, iblob, Isrcs, brickwcs, bx0, by0, blobw, blobh, blobmask, timargs,
-     srcs, bands, plots, ps, simul_opt, use_ceres, rex, refmap) = X
+     srcs, bands, plots, ps, simul_opt, use_ceres, rex, refmap, warm) = X
 
     debug('Fitting blob number %i: blobid %i, nsources %i, size %i x %i, %i images' %
           (nblob, iblob, len(Isrcs), blobw, blobh, len(timargs)))
@@ -83,7 +83,7 @@ def one_blob(X):
     B.hit_limit = np.zeros(len(B), bool)
 
     ob = OneBlob('%i'%(nblob+1), blobwcs, blobmask, timargs, srcs, bands,
-                 plots, ps, simul_opt, use_ceres, rex, refmap)
+                 plots, ps, simul_opt, use_ceres, rex, refmap, warm=warm)
     ob.run(B)
 
     B.blob_totalpix = np.zeros(len(B), np.int32) + ob.total_pix
@@ -104,7 +104,7 @@ def one_blob(X):
 
 class OneBlob(object):
     def __init__(self, name, blobwcs, blobmask, timargs, srcs, bands,
-                 plots, ps, simul_opt, use_ceres, rex, refmap):
+                 plots, ps, simul_opt, use_ceres, rex, refmap, warm=None):
         self.name = name
         self.rex = rex
         self.blobwcs = blobwcs
@@ -121,6 +121,9 @@ class OneBlob(object):
         self.ps = ps
         self.simul_opt = simul_opt
         self.use_ceres = use_ceres
+        # per source: None, or the dchisq of the baseline fit it was
+        # warm-started from (runbrick._warm_start_sources)
+        self.warm = warm
         self.deblend = False
         self.tims = self.create_tims(timargs)
         self.total_pix = sum([np.sum(t.getInvError() > 0) for t in self.tims])
@@ -352,8 +355,13 @@ class OneBlob(object):
                            origin='lower')
                 plt.figure(1)
 
-            # only plot models for one source
-            keepsrc = self.model_selection_one_source(src, srci, models, B)
+            if self.warm is not None and self.warm[srci] is not None:
+                # Warm-started: keep the baseline model type
+                keepsrc = src
+                B.dchisq[srci,:] = self.warm[srci]
+            else:
+                # only plot models for one source
+                keepsrc = self.model_selection_one_source(src, srci, models, B)
             B.sources[srci] = keepsrc
             cat[srci] = keepsrc
 
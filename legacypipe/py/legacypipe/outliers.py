@@ -213,6 +213,7 @@ def compare_one(X):
     from scipy.ndimage.filters import gaussian_filter
     from scipy.ndimage.morphology import binary_dilation
     from astrometry.util.resample import resample_with_wcs,OverlapError
+    from legacypipe.survey import tim_resample
 
     (tim,sig,targetwcs, coimg,cow, veto, make_badcoadds, plots,ps) = X
 
@@ -223,8 +224,7 @@ def compare_one(X):
 
     img = gaussian_filter(tim.getImage(), sig)
     try:
-        Yo,Xo,Yi,Xi,[rimg] = resample_with_wcs(
-            targetwcs, tim.subwcs, [img], intType=np.int16)
+        Yo,Xo,Yi,Xi,[rimg] = tim_resample(tim, targetwcs, [img])
     except OverlapError:
         return None
     del img
@@ -381,14 +381,14 @@ def compare_one(X):
 
 def blur_resample_one(X):
     from scipy.ndimage.filters import gaussian_filter
-    from astrometry.util.resample import resample_with_wcs,OverlapError
+    from astrometry.util.resample import OverlapError
+    from legacypipe.survey import tim_resample
 
     tim,sig,targetwcs = X
 
     img = gaussian_filter(tim.getImage(), sig)
     try:
-        Yo,Xo,Yi,Xi,[rimg] = resample_with_wcs(
-            targetwcs, tim.subwcs, [img], intType=np.int16)
+        Yo,Xo,Yi,Xi,[rimg] = tim_resample(tim, targetwcs, [img])
     except OverlapError:
         return None
     del img
@@ -47,6 +47,13 @@ from legacypipe.coadds import make_coadds, write_coadd_images, quick_coadds
 rgbkwargs = dict(mnmx=(-3,300.), arcsinh=1.)
 rgbkwargs_resid = dict(mnmx=(-5,5))
 
+# Convert WISE fluxes from Vega to AB.
+# http://wise2.ipac.caltech.edu/docs/release/allsky/expsup/sec4_4h.html#conv2ab
+wise_vega_to_ab = dict(w1=2.699,
+                       w2=3.339,
+                       w3=5.174,
+                       w4=6.620)
+
 import logging
 logger = logging.getLogger('legacypipe.runbrick')
 def info(*args):
@@ -56,10 +63,12 @@ def debug(*args):
     from legacypipe.utils import log_debug
     log_debug(logger, args)
 
-def runbrick_global_init():
+def runbrick_global_init(resample_plan_bytes=0):
     from tractor.galaxy import disable_galaxy_cache
+    from legacypipe.survey import resample_plan_cache
     info('Starting process', os.getpid(), Time()-Time())
     disable_galaxy_cache()
+    resample_plan_cache.max_bytes = resample_plan_bytes
 
 def stage_tims(W=3600, H=3600, pixscale=0.262, brickname=None,
                survey=None,
@@ -271,6 +280,12 @@ def stage_tims(W=3600, H=3600, pixscale=0.262, brickname=None,
         debug('[parallel tims] Calibrations:', tnow-tlast)
         tlast = tnow
 
+    # Read each exposure's merged calibrations once; worth it only when
+    # the tims are read in this process (pool workers have their own cache)
+    if mp.pool is None:
+        from legacypipe.image import prefetch_merged_calibs
+        prefetch_merged_calibs(ims, psf=not gaussPsf, sky=splinesky)
+
     # Read Tractor images
     args = [(im, targetrd, dict(gaussPsf=gaussPsf, pixPsf=pixPsf,
                                 hybridPsf=hybridPsf, normalizePsf=normalizePsf,
@@ -582,6 +597,7 @@ def stage_srcs(targetrd=None, pixscale=None, targetwcs=None,
                star_clusters=True,
                star_halos=False,
                record_event=None,
+               detmap_cache_dir=None,
                **kwargs):
     '''
     In this stage we run SED-matched detection to find objects in the
@@ -723,8 +739,15 @@ def stage_srcs(targetrd=None, pixscale=None, targetwcs=None,
 
     tnow = Time()
     info('Rendering detection maps...')
-    detmaps, detivs, satmaps = detection_maps(tims, targetwcs, bands, mp,
-                                              apodize=10)
+    if detmap_cache_dir is not None:
+        from legacypipe.detmapcache import (DetectionMapCache,
+                                            cached_detection_maps)
+        detmaps, detivs, satmaps = cached_detection_maps(
+            DetectionMapCache(detmap_cache_dir), brickname, tims, targetwcs,
+            bands, mp, apodize=10)
+    else:
+        detmaps, detivs, satmaps = detection_maps(tims, targetwcs, bands, mp,
+                                                  apodize=10)
     tnow = Time()
     debug('[parallel srcs] Detmaps:', tnow-tlast)
     tlast = tnow
@@ -966,6 +989,12 @@ def stage_fitblobs(T=None,
                    bailout=False,
                    record_event=None,
                    custom_brick=False,
+                   shared_tims=False,
+                   blob_cost_model=None,
+                   split_blobs=None,
+                   warm_start_catalog=None,
+                   warm_start_avoid=None,
+                   warm_start_radius=5.,
                    **kwargs):
     '''
     This is where the actual source fitting happens.
@@ -1100,6 +1129,13 @@ def stage_fitblobs(T=None,
         # one more place where blob numbers are recorded...
         T.blob = blobs[np.clip(T.iby, 0, H-1), np.clip(T.ibx, 0, W-1)]
 
+    # Start the fits of already-known sources from their baseline solution?
+    warm = None
+    if warm_start_catalog is not None:
+        warm = _warm_start_sources(T, cat, warm_start_catalog, bands,
+                                   avoid_radec=warm_start_avoid,
+                                   avoid_radius=warm_start_radius)
+
     # drop any cached data before we start pickling/multiprocessing
     survey.drop_cache()
 
@@ -1118,21 +1154,27 @@ def stage_fitblobs(T=None,
 
     skipblobs = []
     R = []
+    journal = None
+    if checkpoint_filename:
+        from legacypipe.checkpoint import CheckpointJournal
+        journal = CheckpointJournal(checkpoint_filename,
+                                    fsync_period=checkpoint_period)
     # Check for existing checkpoint file.
-    if checkpoint_filename and os.path.exists(checkpoint_filename):
-        from astrometry.util.file import unpickle_from_file
+    if journal is not None and os.path.exists(checkpoint_filename):
         info('Reading', checkpoint_filename)
         try:
-            R = unpickle_from_file(checkpoint_filename)
-            debug('Read', len(R), 'results from checkpoint file', checkpoint_filename)
+            # results are checked one at a time as they are read
+            R = _check_checkpoints(journal.read(), blobslices, brickname)
         except:
             import traceback
             print('Failed to read checkpoint file ' + checkpoint_filename)
             traceback.print_exc()
-        keepR = _check_checkpoints(R, blobslices, brickname)
-        info('Keeping', len(keepR), 'of', len(R), 'checkpointed results')
-        R = keepR
+            R = []
+        info('Keeping', len(R), 'of', journal.nread, 'checkpointed results')
         skipblobs = [r['iblob'] for r in R]
+        journal.open(keep=R)
+    elif journal is not None:
+        journal.open()
 
     bailout_mask = None
     if bailout:
@@ -1155,64 +1197,76 @@ def stage_fitblobs(T=None,
         HH, WW = targetwcs.shape
         refmap = np.zeros((int(HH), int(WW)), np.uint8)
 
-    # Create the iterator over blobs to process
-    blobiter = _blob_iter(brickname, blobslices, blobsrcs, blobs, targetwcs, tims,
-                          cat, bands, plots, ps, simul_opt, use_ceres,
-                          refmap, brick, rex,
-                          skipblobs=skipblobs,
-                          max_blobsize=max_blobsize, custom_brick=custom_brick)
-    # to allow timingpool to queue tasks one at a time
-    blobiter = iterwrapper(blobiter, len(blobsrcs))
-
-    if checkpoint_filename is None:
-        R = mp.map(_bounce_one_blob, blobiter)
-    else:
-        from astrometry.util.ttime import CpuMeas
+    # Order the blobs by predicted cost rather than by pixel count?
+    blob_order = None
+    if blob_cost_model is not None:
+        from legacypipe.blobcost import get_blob_cost_model, blob_features
+        costmodel = get_blob_cost_model(blob_cost_model)
+        blobfeatures = blob_features(blobslices, blobsrcs, blobs, targetwcs, tims)
+        predicted = costmodel.predict(*blobfeatures)
+        inmap = np.unique(blobs[blobs>=0])
+        blob_order = inmap[np.argsort(-predicted[inmap], kind='stable')]
+        if len(blob_order):
+            info('Predicted blob costs: total %.1f, largest %.1f (blob %i)' %
+                 (predicted[inmap].sum(), predicted[blob_order[0]], blob_order[0]))
+
+    nworkers = 1
+    if mp.pool is not None:
+        nworkers = getattr(mp.pool, '_processes', 1)
+
+    # Put the tims in shared memory once, rather than pickling their
+    # pixels into each blob task?
+    shtims = None
+    if shared_tims:
+        from legacypipe.sharedtims import SharedTims
+        shtims = SharedTims(tims)
+
+    # Split the blobs with many sources into groups fit as separate tasks?
+    blob_groups = None
+    if split_blobs and nworkers > 1:
+        blob_groups = _split_blobs(blobsrcs, cat, targetwcs, split_blobs,
+                                   nworkers, skipblobs=skipblobs)
 
-        # Begin running one_blob on each blob...
-        Riter = mp.imap_unordered(_bounce_one_blob, blobiter)
-        # measure wall time and write out checkpoint file periodically.
-        last_checkpoint = CpuMeas()
-        n_finished = 0
-        n_finished_total = 0
-        while True:
-            import multiprocessing
-            # Time to write a checkpoint file? (And have something to write?)
-            tnow = CpuMeas()
-            dt = tnow.wall_seconds_since(last_checkpoint)
-            if dt >= checkpoint_period and n_finished > 0:
-                # Write checkpoint!
-                debug('Writing', n_finished, 'new results; total for this run', n_finished_total)
-                try:
-                    _write_checkpoint(R, checkpoint_filename)
-                    last_checkpoint = tnow
-                    dt = 0.
-                    n_finished = 0
-                except:
-                    print('Failed to rename checkpoint file', checkpoint_filename)
-                    import traceback
-                    traceback.print_exc()
-            # Wait for results (with timeout)
-            try:
-                if mp.pool is not None:
-                    timeout = max(1, checkpoint_period - dt)
-                    r = Riter.next(timeout)
-                else:
-                    r = next(Riter)
+    try:
+        # Create the iterator over blobs to process
+        blobiter = _blob_iter(brickname, blobslices, blobsrcs, blobs, targetwcs, tims,
+                              cat, bands, plots, ps, simul_opt, use_ceres,
+                              refmap, brick, rex,
+                              skipblobs=skipblobs,
+                              max_blobsize=max_blobsize, custom_brick=custom_brick,
+                              shared_tims=shtims, blob_order=blob_order,
+                              blob_groups=blob_groups, warm=warm)
+        # to allow timingpool to queue tasks one at a time
+        blobiter = iterwrapper(blobiter, _count_blob_tasks(blobs, blob_order,
+                                                           skipblobs, blob_groups))
+
+        if journal is None:
+            R = list(_merge_blob_groups(mp.map(_bounce_one_blob, blobiter),
+                                        blobs, targetwcs))
+        else:
+            # Begin running one_blob on each blob, appending each result to
+            # the checkpoint journal as it arrives.
+            n_finished = 0
+            for r in _merge_blob_groups(mp.imap_unordered(_bounce_one_blob, blobiter),
+                                        blobs, targetwcs):
+                journal.append(r)
                 R.append(r)
                 n_finished += 1
-                n_finished_total += 1
-            except StopIteration:
-                debug('Done')
-                break
-            except multiprocessing.TimeoutError:
-                # print('Timed out waiting for result')
-                continue
-
-        # Write checkpoint when done!
-        _write_checkpoint(R, checkpoint_filename)
-
-        debug('Got', n_finished_total, 'results; wrote', len(R), 'to checkpoint')
+            journal.close()
+            debug('Got', n_finished, 'results; total', len(R), 'in checkpoint journal')
+    finally:
+        # don't leave the tims' pixels in shared memory if fitting fails
+        if shtims is not None:
+            shtims.cleanup()
+
+    if blob_order is not None:
+        from legacypipe.blobcost import timing_table, report_timing
+        timing = timing_table(blob_order, blobfeatures, predicted, R)
+        report_timing(timing, nworkers)
+        if write_metrics:
+            with survey.write_output('blob-timing', brick=brickname) as out:
+                timing.writeto(None, fits_object=out.fits)
+        del timing
 
     debug('[parallel fitblobs] Fitting sources took:', Time()-tlast)
 
@@ -1512,9 +1566,27 @@ def _format_all_models(T, newcat, BB, bands, rex):
 def _blob_iter(brickname, blobslices, blobsrcs, blobs, targetwcs, tims, cat, bands,
                plots, ps, simul_opt, use_ceres, refmap,
                brick, rex,
-               skipblobs=None, max_blobsize=None, custom_brick=False):
+               skipblobs=None, max_blobsize=None, custom_brick=False,
+               shared_tims=None, blob_order=None,
+               blob_groups=None, warm=None):
     '''
     *blobs*: map, with -1 indicating no-blob, other values indexing *blobslices*,*blobsrcs*.
+
+    *shared_tims*: legacypipe.sharedtims.SharedTims of *tims*; if given,
+    the blob tasks refer to its pixels rather than carrying copies.
+
+    *blob_order*: blob numbers in the order to run them (see
+    legacypipe.blobcost); default is by decreasing pixel count.
+
+    *blob_groups*: dict from blob number to the source groups of the
+    blobs to split (see _split_blobs); each group is a task fitting
+    its sources on the part of the blob within their footprints.
+    These tasks are yielded with a fourth element (igroup, ngroups,
+    blob geometry), and _merge_blob_groups puts their results back
+    together.
+
+    *warm*: per source in *cat*, None or the baseline dchisq of a source
+    warm-started by _warm_start_sources.
     '''
     from collections import Counter
 
@@ -1523,10 +1595,11 @@ def _blob_iter(brickname, blobslices, blobsrcs, blobs, targetwcs, tims, cat, ban
 
     H,W = targetwcs.shape
 
-    # sort blobs by size so that larger ones start running first
-    blobvals = Counter(blobs[blobs>=0])
-    blob_order = np.array([i for i,npix in blobvals.most_common()])
-    del blobvals
+    if blob_order is None:
+        # sort blobs by size so that larger ones start running first
+        blobvals = Counter(blobs[blobs>=0])
+        blob_order = np.array([i for i,npix in blobvals.most_common()])
+        del blobvals
 
     if custom_brick:
         U = None
@@ -1542,6 +1615,7 @@ def _blob_iter(brickname, blobslices, blobsrcs, blobs, targetwcs, tims, cat, ban
         bslc  = blobslices[iblob]
         Isrcs = blobsrcs  [iblob]
         assert(len(Isrcs) > 0)
+        groups = None if blob_groups is None else blob_groups.get(iblob)
 
         # blob bbox in target coords
         sy,sx = bslc
@@ -1559,7 +1633,8 @@ def _blob_iter(brickname, blobslices, blobsrcs, blobs, targetwcs, tims, cat, ban
             # skip it!
             if np.all(U[bslc][blobmask] == False):
                 info('Blob', nblob+1, 'is completely outside the unique region of this brick -- skipping')
-                yield (brickname, iblob, None)
+                for task in _skipped_blob_tasks(brickname, iblob, groups):
+                    yield task
                 continue
 
         # find one pixel within the blob, for debugging purposes
@@ -1580,58 +1655,353 @@ def _blob_iter(brickname, blobslices, blobsrcs, blobs, targetwcs, tims, cat, ban
 
         if max_blobsize is not None and npix > max_blobsize:
             info('Number of pixels in blob,', npix, ', exceeds max blobsize', max_blobsize)
-            yield (brickname, iblob, None)
+            for task in _skipped_blob_tasks(brickname, iblob, groups):
+                yield task
             continue
 
-        # Here we cut out subimages for the blob...
-        rr,dd = targetwcs.pixelxy2radec([bx0,bx0,bx1,bx1],[by0,by1,by1,by0])
-        subtimargs = []
-        for tim in tims:
-            h,w = tim.shape
-            ok,x,y = tim.subwcs.radec2pixelxy(rr,dd)
-            sx0,sx1 = x.min(), x.max()
-            sy0,sy1 = y.min(), y.max()
-            #print('blob extent in pixel space of', tim.name, ': x',
-            # (sx0,sx1), 'y', (sy0,sy1), 'tim shape', (h,w))
-            if sx1 < 0 or sy1 < 0 or sx0 > w or sy0 > h:
-                continue
-            sx0 = np.clip(int(np.floor(sx0)), 0, w-1)
-            sx1 = np.clip(int(np.ceil (sx1)), 0, w-1) + 1
-            sy0 = np.clip(int(np.floor(sy0)), 0, h-1)
-            sy1 = np.clip(int(np.ceil (sy1)), 0, h-1) + 1
-            subslc = slice(sy0,sy1),slice(sx0,sx1)
-            subimg = tim.getImage ()[subslc]
-            subie  = tim.getInvError()[subslc]
-            subwcs = tim.getWcs().shifted(sx0, sy0)
-            # Note that we *don't* shift the PSF here -- we do that
-            # in the one_blob code.
-            subsky = tim.getSky().shifted(sx0, sy0)
-            tim.imobj.psfnorm = tim.psfnorm
-            tim.imobj.galnorm = tim.galnorm
-            # FIXME -- maybe the cache is worth sending?
-            if hasattr(tim.psf, 'clear_cache'):
-                tim.psf.clear_cache()
-            subtimargs.append((subimg, subie, subwcs, tim.subwcs,
-                               tim.getPhotoCal(),
-                               subsky, tim.psf, tim.name, sx0, sx1, sy0, sy1,
-                               tim.band, tim.sig1, tim.modelMinval,
-                               tim.imobj))
-
-        yield (brickname, iblob,
-               (nblob, iblob, Isrcs, targetwcs, bx0, by0, blobw, blobh,
-               blobmask, subtimargs, [cat[i] for i in Isrcs], bands, plots, ps,
-               simul_opt, use_ceres, rex, refmap[bslc]))
+        if groups is None:
+            # Here we cut out subimages for the blob...
+            subtimargs = _blob_subtims(tims, targetwcs, bx0, by0, blobw, blobh,
+                                       shared_tims)
+            yield (brickname, iblob,
+                   (nblob, iblob, Isrcs, targetwcs, bx0, by0, blobw, blobh,
+                   blobmask, subtimargs, [cat[i] for i in Isrcs], bands, plots, ps,
+                   simul_opt, use_ceres, rex, refmap[bslc],
+                   None if warm is None else [warm[i] for i in Isrcs]))
+            continue
+
+        info('Splitting blob', nblob+1, 'into', len(groups), 'groups of',
+             [len(g) for g in groups], 'sources')
+        # the per-blob catalog columns describe the whole blob
+        geometry = (bx0, by0, blobw, blobh, npix,
+                    len(_blob_tim_boxes(tims, targetwcs, bx0, by0, blobw, blobh)))
+        for igroup,Ig in enumerate(groups):
+            # ... or for each group, the part of the blob within the
+            # footprints of its sources
+            gmask = blobmask * _footprint_mask(Ig, cat, targetwcs,
+                                               bx0, by0, blobw, blobh)
+            gy,gx = np.nonzero(gmask)
+            if len(gy) == 0:
+                gmask = blobmask
+                gy,gx = np.nonzero(gmask)
+            gy0,gy1 = gy.min(), gy.max()+1
+            gx0,gx1 = gx.min(), gx.max()+1
+            gmask = gmask[gy0:gy1, gx0:gx1]
+            gbx0,gby0 = bx0 + gx0, by0 + gy0
+            gw,gh = gx1 - gx0, gy1 - gy0
+            subtimargs = _blob_subtims(tims, targetwcs, gbx0, gby0, gw, gh,
+                                       shared_tims)
+            yield (brickname, iblob,
+                   (nblob, iblob, Ig, targetwcs, gbx0, gby0, gw, gh,
+                   gmask, subtimargs, [cat[i] for i in Ig], bands, plots, ps,
+                   simul_opt, use_ceres, rex,
+                   refmap[gby0:gby0+gh, gbx0:gbx0+gw],
+                   None if warm is None else [warm[i] for i in Ig]),
+                   (igroup, len(groups), geometry))
+
+def _skipped_blob_tasks(brickname, iblob, groups):
+    # the skipped (None) tasks of a blob: one per source group if split
+    if groups is None:
+        return [(brickname, iblob, None)]
+    return [(brickname, iblob, None, (igroup, len(groups), None))
+            for igroup in range(len(groups))]
+
+def _blob_tim_boxes(tims, targetwcs, bx0, by0, blobw, blobh):
+    '''
+    Returns a list of (itim, sx0, sx1, sy0, sy1), the pixel bounding
+    box in each of *tims* overlapping the (*bx0*,*by0*,*blobw*,*blobh*)
+    box of the brick.
+    '''
+    bx1,by1 = bx0 + blobw, by0 + blobh
+    rr,dd = targetwcs.pixelxy2radec([bx0,bx0,bx1,bx1],[by0,by1,by1,by0])
+    boxes = []
+    for itim,tim in enumerate(tims):
+        h,w = tim.shape
+        ok,x,y = tim.subwcs.radec2pixelxy(rr,dd)
+        sx0,sx1 = x.min(), x.max()
+        sy0,sy1 = y.min(), y.max()
+        #print('blob extent in pixel space of', tim.name, ': x',
+        # (sx0,sx1), 'y', (sy0,sy1), 'tim shape', (h,w))
+        if sx1 < 0 or sy1 < 0 or sx0 > w or sy0 > h:
+            continue
+        sx0 = np.clip(int(np.floor(sx0)), 0, w-1)
+        sx1 = np.clip(int(np.ceil (sx1)), 0, w-1) + 1
+        sy0 = np.clip(int(np.floor(sy0)), 0, h-1)
+        sy1 = np.clip(int(np.ceil (sy1)), 0, h-1) + 1
+        boxes.append((itim, sx0, sx1, sy0, sy1))
+    return boxes
+
+def _blob_subtims(tims, targetwcs, bx0, by0, blobw, blobh, shared_tims=None):
+    '''
+    Cuts out of *tims* the subimages covering the (*bx0*,*by0*,*blobw*,
+    *blobh*) box of the brick, in the form one_blob takes them.
+    '''
+    subtimargs = []
+    for itim,sx0,sx1,sy0,sy1 in _blob_tim_boxes(tims, targetwcs,
+                                                bx0, by0, blobw, blobh):
+        if shared_tims is not None:
+            subtimargs.append(shared_tims.subtim(itim, sx0, sx1, sy0, sy1))
+            continue
+        tim = tims[itim]
+        subslc = slice(sy0,sy1),slice(sx0,sx1)
+        subimg = tim.getImage ()[subslc]
+        subie  = tim.getInvError()[subslc]
+        subwcs = tim.getWcs().shifted(sx0, sy0)
+        # Note that we *don't* shift the PSF here -- we do that
+        # in the one_blob code.
+        subsky = tim.getSky().shifted(sx0, sy0)
+        tim.imobj.psfnorm = tim.psfnorm
+        tim.imobj.galnorm = tim.galnorm
+        # FIXME -- maybe the cache is worth sending?
+        if hasattr(tim.psf, 'clear_cache'):
+            tim.psf.clear_cache()
+        subtimargs.append((subimg, subie, subwcs, tim.subwcs,
+                           tim.getPhotoCal(),
+                           subsky, tim.psf, tim.name, sx0, sx1, sy0, sy1,
+                           tim.band, tim.sig1, tim.modelMinval,
+                           tim.imobj))
+    return subtimargs
+
+def _warm_start_source(src):
+    # A source read from a tractor catalog (EllipseE shapes), in the
+    # parameterization used while fitting (see oneblob._initialize_models)
+    from tractor.ellipses import EllipseESoft
+    from tractor.galaxy import (DevGalaxy, ExpGalaxy, FixedCompositeGalaxy,
+                                SoftenedFracDev)
+    from legacypipe.survey import (LegacyEllipseWithPriors, LogRadius,
+                                   RexGalaxy, SimpleGalaxy)
+    def soft(ell):
+        return LegacyEllipseWithPriors(
+            *EllipseESoft.fromEllipseE(ell).getAllParams())
+    if isinstance(src, SimpleGalaxy):
+        return src
+    if isinstance(src, RexGalaxy):
+        return RexGalaxy(src.getPosition(), src.getBrightness(),
+                         LogRadius(np.log(max(src.shape.re, 1e-3))))
+    if isinstance(src, (DevGalaxy, ExpGalaxy)):
+        src.shape = soft(src.shape)
+    elif isinstance(src, FixedCompositeGalaxy):
+        src.fracDev = SoftenedFracDev(src.fracDev.clipped())
+        src.shapeExp = soft(src.shapeExp)
+        src.shapeDev = soft(src.shapeDev)
+    return src
+
+def _warm_start_sources(T, cat, baseline, bands, avoid_radec=None,
+                        avoid_radius=5., match_radius=1.):
+    '''
+    Replaces the detected sources in *cat* (rows of *T*) that match,
+    within *match_radius* arcsec, a source of the *baseline* tractor
+    catalog (filename or table; e.g. of a run of this brick without
+    injected sources) by that source -- except for reference sources
+    and those within *avoid_radius* arcsec of any of the *avoid_radec*
+    (ra,dec) positions.
+
+    Returns a list with, per source in *cat*, the baseline dchisq of the
+    replaced sources and None for the others; one_blob keeps the model
+    type of the replaced sources rather than running model selection.
+    '''
+    from astrometry.libkd.spherematch import match_radec
+    from legacypipe.catalog import read_fits_catalog
+
+    warm = [None] * len(cat)
+    if isinstance(baseline, str):
+        info('Reading baseline catalog', baseline)
+        baseline = fits_table(baseline)
+    if baseline is None or len(baseline) == 0 or len(cat) == 0:
+        return warm
+    I,J,_ = match_radec(T.ra, T.dec, baseline.ra, baseline.dec,
+                        match_radius / 3600., nearest=True)
+    keep = np.array([t.strip() in ['PSF', 'REX', 'SIMP', 'EXP', 'DEV', 'COMP']
+                     for t in baseline.type[J]], bool)
+    if 'ref_cat' in T.get_columns():
+        keep *= np.array([len(r.strip()) == 0 for r in T.ref_cat[I]], bool)
+    if avoid_radec is not None and len(avoid_radec):
+        rd = np.array(avoid_radec)
+        K,_,_ = match_radec(T.ra[I], T.dec[I], rd[:,0], rd[:,1],
+                            avoid_radius / 3600.)
+        keep[K] = False
+    I,J = I[keep], J[keep]
+    srcs = read_fits_catalog(baseline[J], hdr=fitsio.FITSHDR(), bands=bands)
+    hasdchisq = 'dchisq' in baseline.get_columns()
+    for i,j,src in zip(I, J, srcs):
+        cat[i] = _warm_start_source(src)
+        if hasdchisq:
+            warm[i] = baseline.dchisq[j].astype(np.float32)
+        else:
+            warm[i] = np.zeros(5, np.float32)
+    info('Warm-starting', len(I), 'of', len(cat),
+         'sources from the baseline catalog')
+    return warm
+
+def _footprint_radius(src, pixscale, minradius=32.):
+    # Pixel radius beyond which a source's model is negligible: the PSF
+    # wings plus a generous multiple of its half-light radius.
+    re = 0.
+    for attr in ['shape', 'shapeExp', 'shapeDev']:
+        shape = getattr(src, attr, None)
+        if shape is not None:
+            re = max(re, getattr(shape, 're', 0.))
+    return minradius + 8. * re / pixscale
+
+def _split_blob_sources(Isrcs, cat, targetwcs, max_groups):
+    '''
+    Splits the sources *Isrcs* of a blob into the connected groups of
+    sources whose footprints (_footprint_radius) overlap, then packs
+    those groups into at most *max_groups* sets with similar numbers of
+    sources.  Returns a list of index arrays (just [Isrcs] if the
+    sources are all connected).
+    '''
+    from scipy.sparse.csgraph import connected_components
+    Isrcs = np.asarray(Isrcs)
+    pos = [cat[i].getPosition() for i in Isrcs]
+    _,x,y = targetwcs.radec2pixelxy(np.array([p.ra for p in pos]),
+                                    np.array([p.dec for p in pos]))
+    pixscale = targetwcs.pixel_scale()
+    rad = np.array([_footprint_radius(cat[i], pixscale) for i in Isrcs])
+    touch = (((x[:,np.newaxis] - x[np.newaxis,:])**2 +
+              (y[:,np.newaxis] - y[np.newaxis,:])**2) <
+             (rad[:,np.newaxis] + rad[np.newaxis,:])**2)
+    ncomp,labels = connected_components(touch, directed=False)
+    if ncomp == 1:
+        return [Isrcs]
+    comps = [Isrcs[labels == k] for k in range(ncomp)]
+    comps.sort(key=len, reverse=True)
+    # largest groups first, each to the set with the fewest sources so far
+    sets = [[] for i in range(min(max_groups, ncomp))]
+    for c in comps:
+        i = np.argmin([sum([len(g) for g in gs]) for gs in sets])
+        sets[i].append(c)
+    return [np.sort(np.hstack(gs)) for gs in sets]
+
+def _footprint_mask(Isrcs, cat, targetwcs, x0, y0, w, h):
+    '''
+    Returns the mask of the pixels of the (*x0*,*y0*,*w*,*h*) box of
+    the brick within the footprint (_footprint_radius) of any of the
+    sources *Isrcs*.
+    '''
+    mask = np.zeros((h,w), bool)
+    pixscale = targetwcs.pixel_scale()
+    for i in Isrcs:
+        pos = cat[i].getPosition()
+        _,x,y = targetwcs.radec2pixelxy(pos.ra, pos.dec)
+        # zero-indexed, relative to the box
+        x -= 1. + x0
+        y -= 1. + y0
+        r = _footprint_radius(cat[i], pixscale)
+        xlo,xhi = max(int(np.floor(x - r)), 0), min(int(np.ceil(x + r)) + 1, w)
+        ylo,yhi = max(int(np.floor(y - r)), 0), min(int(np.ceil(y + r)) + 1, h)
+        if xlo >= xhi or ylo >= yhi:
+            continue
+        dx = np.arange(xlo, xhi)[np.newaxis,:] - x
+        dy = np.arange(ylo, yhi)[:,np.newaxis] - y
+        mask[ylo:yhi, xlo:xhi] |= (dx**2 + dy**2 < r**2)
+    return mask
+
+def _split_blobs(blobsrcs, cat, targetwcs, min_sources, max_groups,
+                 skipblobs=None):
+    '''
+    Returns a dict from blob number to its source groups (see
+    _split_blob_sources), for the blobs with at least *min_sources*
+    sources that split into more than one group.
+    '''
+    if skipblobs is None:
+        skipblobs = []
+    skip = set(skipblobs)
+    groups = {}
+    for iblob,Isrcs in enumerate(blobsrcs):
+        if iblob in skip or len(Isrcs) < min_sources:
+            continue
+        g = _split_blob_sources(Isrcs, cat, targetwcs, max_groups)
+        if len(g) > 1:
+            groups[iblob] = g
+    return groups
+
+def _count_blob_tasks(blobs, blob_order, skipblobs, blob_groups):
+    # number of tasks _blob_iter yields
+    if blob_order is None:
+        blob_order = np.unique(blobs[blobs>=0])
+    skip = set(skipblobs if skipblobs is not None else [])
+    if blob_groups is None:
+        blob_groups = {}
+    return sum([len(blob_groups.get(iblob, [None])) for iblob in blob_order
+                if not iblob in skip])
+
+def _merge_blob_groups(Riter, blobs, targetwcs):
+    '''
+    Passes the one_blob results of *Riter* through, except for the
+    source groups of split blobs (see _blob_iter), which are held back
+    until all the groups of the blob have arrived and then merged into
+    one result for the blob, with its sources in group order.
+
+    The per-blob columns are set back to those of the whole blob
+    (*blobs* map in *targetwcs*), except blob_totalpix and cpu_blob,
+    summed over the groups, and the finished_in_blob flags are computed
+    against the whole blob.  The fits are not those of the unsplit
+    blob: each group is fit alone, on the pixels within its sources'
+    footprints, so the light of the other groups beyond the footprint
+    radius is neither modeled nor masked.
+    '''
+    from astrometry.util.fits import merge_tables
+    pending = {}
+    for r in Riter:
+        group = r.pop('group', None)
+        if group is None:
+            yield r
+            continue
+        igroup,ngroups,geometry = group
+        iblob = r['iblob']
+        parts = pending.setdefault(iblob, [])
+        parts.append((igroup, r['result']))
+        if len(parts) < ngroups:
+            continue
+        del pending[iblob]
+        parts.sort(key=lambda p: p[0])
+        parts = [p for _,p in parts if p is not None and len(p)]
+        result = None
+        if len(parts):
+            result = merge_tables(parts)
+            result.iblob = iblob
+            bx0,by0,blobw,blobh,npix,nimages = geometry
+            result.blob_x0[:] = bx0
+            result.blob_y0[:] = by0
+            result.blob_width[:] = blobw
+            result.blob_height[:] = blobh
+            result.blob_npix[:] = npix
+            result.blob_nimages[:] = nimages
+            result.blob_totalpix[:] = sum([p.blob_totalpix[0] for p in parts])
+            # total CPU time spent on the blob
+            result.cpu_blob[:] = sum([p.cpu_blob[0] for p in parts])
+            blobmask = (blobs[by0:by0+blobh, bx0:bx0+blobw] == iblob)
+            _,x,y = targetwcs.radec2pixelxy(
+                np.array([src.getPosition().ra  for src in result.sources]),
+                np.array([src.getPosition().dec for src in result.sources]))
+            result.finished_in_blob = blobmask[
+                np.clip(np.round(y-1).astype(int) - by0, 0, blobh-1),
+                np.clip(np.round(x-1).astype(int) - bx0, 0, blobw-1)]
+        yield dict(brickname=r['brickname'], iblob=iblob, result=result)
 
 def _bounce_one_blob(X):
     ''' This just wraps the one_blob function, for debugging &
     multiprocessing purposes.
     '''
     from legacypipe.oneblob import one_blob
-    (brickname, iblob, X) = X
+    group = None
+    if len(X) == 4:
+        # one source group of a split blob
+        (brickname, iblob, X, group) = X
+    else:
+        (brickname, iblob, X) = X
     try:
+        if X is not None:
+            from legacypipe.sharedtims import attach_subtims
+            # subtims are at index 9, see _blob_iter
+            X = X[:9] + (attach_subtims(X[9]),) + X[10:]
         result = one_blob(X)
         ### This defines the format of the results in the checkpoints files
-        return dict(brickname=brickname, iblob=iblob, result=result)
+        r = dict(brickname=brickname, iblob=iblob, result=result)
+        if group is not None:
+            r.update(group=group)
+        return r
     except:
         import traceback
         print('Exception in one_blob: brick %s, iblob %i' % (brickname, iblob))
@@ -1662,6 +2032,7 @@ def stage_coadds(survey=None, bands=None, version_header=None, targetwcs=None,
                  saturated_pix=None,
                  brightblobmask=None,
                  bailout_mask=None,
+                 stream_coadds=False,
                  mp=None,
                  record_event=None,
                  **kwargs):
@@ -1669,6 +2040,10 @@ def stage_coadds(survey=None, bands=None, version_header=None, targetwcs=None,
     After the `stage_fitblobs` fitting stage, we have all the source
     model fits, and we can create coadds of the images, model, and
     residuals.  We also perform aperture photometry in this stage.
+
+    With *stream_coadds*, each band's coadd maps are written, and
+    reduced to the depth histogram and ALLMASK bits, as soon as that
+    band is done, and then released.
     '''
     from functools import reduce
     from legacypipe.survey import apertures_arcsec
@@ -1683,7 +2058,8 @@ def stage_coadds(survey=None, bands=None, version_header=None, targetwcs=None,
         sims_mods = [tim.sims_image for tim in tims]
         T_sims_coadds = make_coadds(tims, bands, targetwcs, mods=sims_mods,
                                      lanczos=lanczos, mp=mp,callback=write_coadd_images, callback_args=(survey, brickname, version_header, tims,
-                                                                                            targetwcs))
+                                                                                            targetwcs),
+                                     stream=stream_coadds)
         sims_coadd = T_sims_coadds.comods
         del T_sims_coadds
         for band in bands:
@@ -1733,28 +2109,40 @@ def stage_coadds(survey=None, bands=None, version_header=None, targetwcs=None,
     apxy = np.vstack((xx - 1., yy - 1.)).T
     del xx,yy,ok,ra,dec
 
+    allmaskvals = dict(g=MASKBITS['ALLMASK_G'], r=MASKBITS['ALLMASK_R'],
+                       z=MASKBITS['ALLMASK_Z'])
+
     record_event and record_event('stage_coadds: coadds')
+    callback = write_coadd_images
+    callback_args = (survey, brickname, version_header, tims, targetwcs)
+    if stream_coadds:
+        D,U = _depth_table(brick, targetwcs)
+        allmaskbits = np.zeros((H,W), np.int16)
+        callback = _write_coadd_band
+        callback_args = callback_args + (D, U, allmaskvals, allmaskbits)
+        del U
     C = make_coadds(tims, bands, targetwcs, mods=mods, xy=ixy,
                     ngood=True, detmaps=True, psfsize=True, allmasks=True,
                     lanczos=lanczos,
                     apertures=apertures, apxy=apxy,
-                    callback=write_coadd_images,
-                    callback_args=(survey, brickname, version_header, tims,
-                                   targetwcs),
-                    plots=plots, ps=ps, mp=mp)
+                    callback=callback, callback_args=callback_args,
+                    plots=plots, ps=ps, mp=mp, stream=stream_coadds)
+    del callback_args
     record_event and record_event('stage_coadds: extras')
 
     # Coadds of galaxy sims only, image only
     if hasattr(tims[0], 'sims_image'):
         sims_mods = [tim.sims_image for tim in tims]
         T_sims_coadds = make_coadds(tims, bands, targetwcs, mods=sims_mods,
-                                    lanczos=lanczos, mp=mp)
+                                    lanczos=lanczos, mp=mp,
+                                    stream=stream_coadds)
         sims_coadd = T_sims_coadds.comods
         del T_sims_coadds
         image_only_mods= [tim.data-tim.sims_image for tim in tims]
         T_image_coadds = make_coadds(tims, bands, targetwcs,
                                      mods=image_only_mods,
-                                     lanczos=lanczos, mp=mp)
+                                     lanczos=lanczos, mp=mp,
+                                     stream=stream_coadds)
         image_coadd= T_image_coadds.comods
         del T_image_coadds
     ###
@@ -1796,7 +2184,8 @@ def stage_coadds(survey=None, bands=None, version_header=None, targetwcs=None,
     del AP
 
     # Compute depth histogram
-    D = _depth_histogram(brick, targetwcs, bands, C.psfdetivs, C.galdetivs)
+    if not stream_coadds:
+        D = _depth_histogram(brick, targetwcs, bands, C.psfdetivs, C.galdetivs)
     with survey.write_output('depth-table', brick=brickname) as out:
         D.writeto(None, fits_object=out.fits)
     del D
@@ -1844,12 +2233,14 @@ def stage_coadds(survey=None, bands=None, version_header=None, targetwcs=None,
             maskbits += saturvals[b] * sat.astype(np.int16)
 
     # ALLMASK_{g,r,z}
-    allmaskvals = dict(g=MASKBITS['ALLMASK_G'], r=MASKBITS['ALLMASK_R'],
-                       z=MASKBITS['ALLMASK_Z'])
-    for b,allmask in zip(bands, C.allmasks):
-        if not b in allmaskvals:
-            continue
-        maskbits += allmaskvals[b]* (allmask > 0).astype(np.int16)
+    if stream_coadds:
+        maskbits += allmaskbits
+        del allmaskbits
+    else:
+        for b,allmask in zip(bands, C.allmasks):
+            if not b in allmaskvals:
+                continue
+            maskbits += allmaskvals[b]* (allmask > 0).astype(np.int16)
 
     # BAILOUT_MASK
     if bailout_mask is not None:
@@ -2074,7 +2465,28 @@ def get_fiber_fluxes(cat, T, targetwcs, H, W, pixscale, bands,
 
     return fiberflux, fibertotflux
 
+def _write_coadd_band(band, survey, brickname, version_header, tims, targetwcs,
+                      D, U, allmaskvals, allmaskbits,
+                      psfdetiv=None, galdetiv=None, andmask=None, **kwargs):
+    '''
+    make_coadds callback for stream_coadds: writes the coadd images of
+    one band, and adds its depth histogram to *D* and its ALLMASK bit
+    to *allmaskbits*, before make_coadds drops the band's maps.
+    '''
+    write_coadd_images(band, survey, brickname, version_header, tims,
+                       targetwcs, psfdetiv=psfdetiv, galdetiv=galdetiv,
+                       **kwargs)
+    _depth_histogram_band(D, U, band, psfdetiv, galdetiv)
+    if band in allmaskvals:
+        allmaskbits += allmaskvals[band] * (andmask > 0).astype(np.int16)
+
 def _depth_histogram(brick, targetwcs, bands, detivs, galdetivs):
+    D,U = _depth_table(brick, targetwcs)
+    for band,detiv,galdetiv in zip(bands,detivs,galdetivs):
+        _depth_histogram_band(D, U, band, detiv, galdetiv)
+    return D
+
+def _depth_table(brick, targetwcs):
     # Compute the brick's unique pixels.
     U = None
     if hasattr(brick, 'ra1'):
@@ -2085,32 +2497,120 @@ def _depth_histogram(brick, targetwcs, bands, detivs, galdetivs):
         U = np.flatnonzero(U)
         debug(len(U), 'of', W*H, 'pixels are unique to this brick')
 
+    depthbins = _depth_bins()
+    D = fits_table()
+    D.depthlo = depthbins[:-1].astype(np.float32)
+    D.depthhi = depthbins[1: ].astype(np.float32)
+    return D,U
+
+def _depth_bins():
     # depth histogram bins
     depthbins = np.arange(20, 25.001, 0.1)
     depthbins[0] = 0.
     depthbins[-1] = 100.
-    D = fits_table()
-    D.depthlo = depthbins[:-1].astype(np.float32)
-    D.depthhi = depthbins[1: ].astype(np.float32)
+    return depthbins
+
+def _depth_histogram_band(D, U, band, detiv, galdetiv):
+    depthbins = _depth_bins()
+    for det,name in [(detiv, 'ptsrc'), (galdetiv, 'gal')]:
+        # compute stats for 5-sigma detection
+        with np.errstate(divide='ignore'):
+            depth = 5. / np.sqrt(det)
+        # that's flux in nanomaggies -- convert to mag
+        depth = -2.5 * (np.log10(depth) - 9)
+        # no coverage -> very bright detection limit
+        depth[np.logical_not(np.isfinite(depth))] = 0.
+        if U is not None:
+            depth = depth.flat[U]
+        if len(depth):
+            debug(band, name, 'band depth map: percentiles',
+                  np.percentile(depth, np.arange(0,101, 10)))
+        # histogram
+        D.set('counts_%s_%s' % (name, band),
+              np.histogram(depth, bins=depthbins)[0].astype(np.int32))
+
+def _wise_fixed_sources(cat, baseline, refit_radec=None, refit_radius=30.,
+                        match_radius=1.):
+    '''
+    For incremental WISE forced photometry: finds the sources in *cat*
+    that match, within *match_radius* arcsec, a source of the *baseline*
+    tractor catalog (filename or table), except those within
+    *refit_radius* arcsec of any of the *refit_radec* (ra,dec)
+    positions.  These can keep the baseline WISE fluxes.
 
-    for band,detiv,galdetiv in zip(bands,detivs,galdetivs):
-        for det,name in [(detiv, 'ptsrc'), (galdetiv, 'gal')]:
-            # compute stats for 5-sigma detection
-            with np.errstate(divide='ignore'):
-                depth = 5. / np.sqrt(det)
-            # that's flux in nanomaggies -- convert to mag
-            depth = -2.5 * (np.log10(depth) - 9)
-            # no coverage -> very bright detection limit
-            depth[np.logical_not(np.isfinite(depth))] = 0.
-            if U is not None:
-                depth = depth.flat[U]
-            if len(depth):
-                debug(band, name, 'band depth map: percentiles',
-                      np.percentile(depth, np.arange(0,101, 10)))
-            # histogram
-            D.set('counts_%s_%s' % (name, band),
-                  np.histogram(depth, bins=depthbins)[0].astype(np.int32))
-    return D
+    Returns (I, J, baseline): indices into *cat* and *baseline*.
+    '''
+    from astrometry.libkd.spherematch import match_radec
+
+    if isinstance(baseline, str):
+        info('Reading baseline catalog', baseline)
+        baseline = fits_table(baseline)
+    if (len(baseline) == 0 or len(cat) == 0 or
+        not 'flux_w1' in baseline.get_columns()):
+        return np.array([], int), np.array([], int), baseline
+    ra  = np.array([src.getPosition().ra  for src in cat])
+    dec = np.array([src.getPosition().dec for src in cat])
+    I,J,_ = match_radec(ra, dec, baseline.ra, baseline.dec,
+                        match_radius / 3600., nearest=True)
+    keep = np.ones(len(I), bool)
+    if refit_radec is not None and len(refit_radec):
+        rd = np.array(refit_radec)
+        K,_,_ = match_radec(ra[I], dec[I], rd[:,0], rd[:,1],
+                            refit_radius / 3600.)
+        keep[K] = False
+    I,J = I[keep], J[keep]
+    info('Keeping the baseline WISE fluxes of', len(I), 'of', len(cat), 'sources')
+    return I, J, baseline
+
+def _wise_baseline_phot(baseline, J, band, epoch=None):
+    '''
+    The WISE results of rows *J* of a *baseline* tractor catalog in
+    *band* (1-4) -- of the full-depth coadds or of time-resolved
+    *epoch* -- as unwise_forcedphot columns (Vega nanomaggies), or None
+    if the baseline does not have them.
+    '''
+    fluxfactor = 10.** (wise_vega_to_ab['w%i' % band] / -2.5)
+    prefix = '' if epoch is None else 'lc_'
+    cols = {}
+    for c,bc,scale in [('w%i_nanomaggies',      'flux_w%i',      1./fluxfactor),
+                       ('w%i_nanomaggies_ivar', 'flux_ivar_w%i', fluxfactor**2),
+                       ('w%i_prochi2',          'rchisq_w%i',    1.),
+                       ('w%i_profracflux',      'fracflux_w%i',  1.)]:
+        bc = prefix + bc % band
+        if not bc in baseline.get_columns():
+            return None
+        x = baseline.get(bc)[J]
+        if epoch is not None:
+            if x.ndim != 2 or epoch >= x.shape[1]:
+                return None
+            x = x[:,epoch]
+        cols[c % band] = (x * scale).astype(np.float32)
+    return cols
+
+def _wise_fixed_flux(wfixed, nsrcs, band, epoch=None):
+    '''
+    The *fixed_flux* argument of unwise_forcedphot for the sources
+    (_wise_fixed_sources) *wfixed*, and the baseline results to put in
+    their rows; (None, None) to fit all sources.
+    '''
+    if wfixed is None:
+        return None, None
+    I,J,baseline = wfixed
+    vals = _wise_baseline_phot(baseline, J, band, epoch=epoch)
+    if vals is None:
+        return None, None
+    fixed = np.empty(nsrcs)
+    fixed[:] = np.nan
+    fixed[I] = vals['w%i_nanomaggies' % band]
+    return fixed, vals
+
+def _wise_set_fixed(phot, wfixed, vals):
+    # Copy the baseline results into the rows of the fixed sources
+    if vals is None:
+        return
+    I = wfixed[0]
+    for c,v in vals.items():
+        phot.get(c)[I] = v
 
 def stage_wise_forced(
     survey=None,
@@ -2127,6 +2627,12 @@ def stage_wise_forced(
     brick=None,
     wise_ceres=True,
     unwise_coadds=False,
+    wise_baseline_catalog=None,
+    wise_refit_radec=None,
+    wise_refit_radius=30.,
+    unwise_cache_dir=None,
+    unwise_tile_cache_dir=None,
+    unwise_tile_cache_gb=4.,
     version_header=None,
     mp=None,
     record_event=None,
@@ -2136,8 +2642,17 @@ def stage_wise_forced(
     '''
     After the model fits are finished, we can perform forced
     photometry of the unWISE coadds.
+
+    With *wise_baseline_catalog* (a tractor catalog of this brick, eg,
+    without injected sources), only the sources that are not in it, or
+    are within *wise_refit_radius* arcsec of the *wise_refit_radec*
+    positions, are fit; the others are held at, and report, their
+    baseline WISE fluxes.  *unwise_cache_dir* caches the prepared unWISE
+    cutouts between runs of the brick.  *unwise_tile_cache_dir* is a
+    node-local cache (of at most *unwise_tile_cache_gb* GB) of the
+    decompressed unWISE mask and model-sky tiles, shared between bricks.
     '''
-    from legacypipe.unwise import unwise_phot, collapse_unwise_bitmask, unwise_tiles_touching_wcs
+    from legacypipe.unwise import unwise_phot, collapse_unwise_bitmask, unwise_tiles_touching_wcs, UnwiseTimCache, UnwiseTileCache
     from tractor import NanoMaggies
 
     record_event and record_event('stage_wise_forced: starting')
@@ -2160,16 +2675,34 @@ def stage_wise_forced(
     # use Aaron's WISE pixelized PSF model (unwise_psf repository)?
     wpixpsf = True
 
+    wfixed = None
+    if wise_baseline_catalog is not None:
+        wfixed = _wise_fixed_sources(cat, wise_baseline_catalog,
+                                     refit_radec=wise_refit_radec,
+                                     refit_radius=wise_refit_radius)
+    tim_cache = None
+    if unwise_cache_dir is not None:
+        tim_cache = UnwiseTimCache(unwise_cache_dir)
+    tile_cache = None
+    if unwise_tile_cache_dir is not None:
+        tile_cache = UnwiseTileCache(unwise_tile_cache_dir,
+                                     max_bytes=unwise_tile_cache_gb * 1e9)
+
     # Create list of groups-of-tiles to photometer
     args = []
+    # Baseline results of the fixed sources, per element of args
+    fixedvals = []
     # Skip if $UNWISE_COADDS_DIR or --unwise-dir not set.
     if unwise_dir is not None:
         wtiles = tiles.copy()
         wtiles.unwise_dir = np.array([unwise_dir]*len(tiles))
         for band in [1,2,3,4]:
             get_masks = targetwcs if (band == 1) else None
+            fixed,vals = _wise_fixed_flux(wfixed, len(cat), band)
             args.append((wcat, wtiles, band, roiradec,
-                         wise_ceres, wpixpsf, unwise_coadds, get_masks, ps, True, unwise_modelsky_dir))
+                         wise_ceres, wpixpsf, unwise_coadds, get_masks, ps, True, unwise_modelsky_dir,
+                         fixed, tim_cache, tile_cache))
+            fixedvals.append(vals)
 
     # Add time-resolved WISE coadds
     # Skip if $UNWISE_COADDS_TIMERESOLVED_DIR or --unwise-tr-dir not set.
@@ -2222,14 +2755,23 @@ def stage_wise_forced(
                 eptiles = TR[I]
                 eptiles.unwise_dir = np.array([os.path.join(tdir, 'e%03i'%ep)
                                               for ep in epochs[I,ie]])
+                fixed,vals = _wise_fixed_flux(wfixed, len(cat), band, epoch=ie)
                 eargs.append((ie,(wcat, eptiles, band, roiradec,
-                                  wise_ceres, wpixpsf, False, None, ps, False, unwise_modelsky_dir)))
+                                  wise_ceres, wpixpsf, False, None, ps, False, unwise_modelsky_dir,
+                                  fixed, tim_cache, tile_cache)))
+                fixedvals.append(vals)
 
     # Run the forced photometry!
     record_event and record_event('stage_wise_forced: photometry')
     phots = mp.map(unwise_phot, args + [a for ie,a in eargs])
     record_event and record_event('stage_wise_forced: results')
 
+    if tile_cache is not None:
+        stats = [p.tile_cache_stats for p in phots if p is not None]
+        info('unWISE tile cache', unwise_tile_cache_dir, ':',
+             sum(s['hits'] for s in stats), 'hits,',
+             sum(s['misses'] for s in stats), 'misses')
+
     # Unpack results...
     WISE = None
     wise_mask_maps = None
@@ -2242,6 +2784,7 @@ def stage_wise_forced(
                 (wcat,tiles,band) = args[i+1][:3]
                 print('"None" result from WISE forced phot:', tiles, band)
                 continue
+            _wise_set_fixed(p.phot, wfixed, fixedvals[i])
             if unwise_coadds:
                 wise_models.update(p.models)
             if p.maskmap is not None:
@@ -2286,13 +2829,15 @@ def stage_wise_forced(
     if WISE_T is not None:
         WISE_T = fits_table()
         phots = phots[len(args):]
-        for (ie,a),r in zip(eargs, phots):
+        efixedvals = fixedvals[len(args):]
+        for (ie,a),r,vals in zip(eargs, phots, efixedvals):
             debug('Epoch', ie, 'photometry:')
             if r is None:
                 debug('Failed.')
                 continue
             assert(ie < Nepochs)
             phot = r.phot
+            _wise_set_fixed(phot, wfixed, vals)
             #phot.about()
             phot.delete_column('wise_coadd_id')
             for c in phot.columns():
@@ -2463,11 +3008,7 @@ def stage_writecat(
 
     if WISE is not None:
         # Convert WISE fluxes from Vega to AB.
-        # http://wise2.ipac.caltech.edu/docs/release/allsky/expsup/sec4_4h.html#conv2ab
-        vega_to_ab = dict(w1=2.699,
-                          w2=3.339,
-                          w3=5.174,
-                          w4=6.620)
+        vega_to_ab = wise_vega_to_ab
 
         for band in [1,2,3,4]:
             primhdr.add_record(dict(
@@ -2586,6 +3127,22 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
               depth_cut=None,
               nblobs=None, blob=None, blobxy=None, blobradec=None, blobid=None,
               max_blobsize=None,
+              shared_tims=False,
+              blob_cost_model=None,
+              split_blobs=None,
+              warm_start_catalog=None,
+              warm_start_avoid=None,
+              warm_start_radius=5.,
+              detmap_cache_dir=None,
+              resample_plans=False,
+              resample_plan_gb=2.,
+              stream_coadds=False,
+              wise_baseline_catalog=None,
+              wise_refit_radec=None,
+              wise_refit_radius=30.,
+              unwise_cache_dir=None,
+              unwise_tile_cache_dir=None,
+              unwise_tile_cache_gb=4.,
               nsigma=6,
               simul_opt=False,
               wise=True,
@@ -2693,6 +3250,58 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
 
     - *max_blobsize*: int; ignore blobs with more than this many pixels
 
+    - *shared_tims*: boolean; hand the tims to the blob-fitting
+      processes through shared memory (/dev/shm) instead of pickling
+      subimages into every blob task.
+
+    - *blob_cost_model*: json file of a legacypipe.blobcost.BlobCostModel
+      (or an object with its predict() method); if given, blobs are
+      fit in order of decreasing predicted cost and the predicted and
+      actual costs are written to the blob-timing metrics file.
+
+    - *split_blobs*: int; blobs with at least this many sources are
+      split into groups of sources with non-overlapping footprints,
+      fit in parallel (one task per worker at most) on the pixels
+      within their footprints, and merged back.  The fits approximate
+      those of the unsplit blob (see _merge_blob_groups).
+
+    - *warm_start_catalog*: tractor catalog filename (or table) of a
+      baseline run of this brick; detected sources matching one of its
+      sources start from the baseline fit and keep its model type.
+
+    - *warm_start_avoid*: list of (ra,dec); sources within
+      *warm_start_radius* arcsec of these positions are fit from
+      scratch, with model selection, even if they are in the
+      *warm_start_catalog*.  Defaults to *blobradec*.
+
+    - *detmap_cache_dir*: directory of per-brick detection maps without
+      the tims' injected sources (legacypipe.detmapcache); later runs
+      of the brick only add their own injected sources to them.
+
+    - *resample_plans*: boolean; compute the mapping of each tim into
+      the brick once per process (legacypipe.survey.ResamplePlanCache)
+      and reuse it for the detection maps, coadds and outlier masking.
+      Each process keeps at most *resample_plan_gb* GB of plans.
+
+    - *stream_coadds*: boolean; in the coadds stage, write out and
+      release each band's coadd maps as soon as that band is done, so
+      that peak memory scales with one band rather than all of them.
+
+    - *wise_baseline_catalog*: tractor catalog filename (or table) of a
+      baseline run of this brick; in the WISE forced photometry,
+      sources matching one of its sources keep its WISE fluxes (they
+      are not fit) unless they are within *wise_refit_radius* arcsec of
+      one of the *wise_refit_radec* (ra,dec) positions.
+      *wise_refit_radec* defaults to *blobradec*.
+
+    - *unwise_cache_dir*: directory in which to keep the prepared
+      unWISE cutouts of this brick, for later runs of the brick.
+
+    - *unwise_tile_cache_dir*: node-local directory (eg, under /dev/shm)
+      in which to keep decompressed unWISE mask and model-sky tiles,
+      shared by the processes and bricks on the node; at most
+      *unwise_tile_cache_gb* GB.
+
     - *nsigma*: float; detection threshold in sigmas.
 
     - *simul_opt*: boolean; during fitting, if a blob contains multiple
@@ -2859,16 +3468,19 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
         if checkpoint_period is not None:
             kwargs.update(checkpoint_period=checkpoint_period)
 
+    # set in each pool process by runbrick_global_init
+    resample_plan_bytes = int(resample_plan_gb * 1e9) if resample_plans else 0
     if threads and threads > 1:
         from astrometry.util.timingpool import TimingPool, TimingPoolMeas
         pool = TimingPool(threads, initializer=runbrick_global_init,
-                          initargs=[])
+                          initargs=[resample_plan_bytes])
         poolmeas = TimingPoolMeas(pool, pickleTraffic=False)
         StageTime.add_measurement(poolmeas)
         mp = multiproc(None, pool=pool)
     else:
         from astrometry.util.ttime import CpuMeas
-        mp = multiproc(init=runbrick_global_init, initargs=[])
+        mp = multiproc(init=runbrick_global_init,
+                       initargs=[resample_plan_bytes])
         StageTime.add_measurement(CpuMeas)
         pool = None
     kwargs.update(mp=mp)
@@ -2885,6 +3497,33 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
         kwargs.update(blobid=blobid)
     if max_blobsize is not None:
         kwargs.update(max_blobsize=max_blobsize)
+    if shared_tims:
+        kwargs.update(shared_tims=shared_tims)
+    if blob_cost_model is not None:
+        kwargs.update(blob_cost_model=blob_cost_model)
+    if split_blobs is not None:
+        kwargs.update(split_blobs=split_blobs)
+    if warm_start_catalog is not None:
+        if warm_start_avoid is None:
+            warm_start_avoid = blobradec
+        kwargs.update(warm_start_catalog=warm_start_catalog,
+                      warm_start_avoid=warm_start_avoid,
+                      warm_start_radius=warm_start_radius)
+    if detmap_cache_dir is not None:
+        kwargs.update(detmap_cache_dir=detmap_cache_dir)
+    if stream_coadds:
+        kwargs.update(stream_coadds=stream_coadds)
+    if wise_baseline_catalog is not None:
+        if wise_refit_radec is None:
+            wise_refit_radec = blobradec
+        kwargs.update(wise_baseline_catalog=wise_baseline_catalog,
+                      wise_refit_radec=wise_refit_radec,
+                      wise_refit_radius=wise_refit_radius)
+    if unwise_cache_dir is not None:
+        kwargs.update(unwise_cache_dir=unwise_cache_dir)
+    if unwise_tile_cache_dir is not None:
+        kwargs.update(unwise_tile_cache_dir=unwise_tile_cache_dir,
+                      unwise_tile_cache_gb=unwise_tile_cache_gb)
 
     pickle_pat = pickle_pat % dict(brick=brick)
 
@@ -3087,6 +3726,24 @@ python -u legacypipe/runbrick.py --plots --brick 2440p070 --zoom 1900 2400 450 9
 
     parser.add_argument('--max-blobsize', type=int,
                         help='Skip blobs containing more than the given number of pixels.')
+    parser.add_argument('--split-blobs', type=int, default=None,
+                        help='Fit the non-overlapping source groups of blobs with at least this many sources in parallel')
+    parser.add_argument('--warm-start-catalog', default=None,
+                        help='Start fitting the sources found in this tractor catalog of the brick from that solution, without model selection')
+    parser.add_argument('--warm-start-radius', type=float, default=5.,
+                        help='With --warm-start-catalog, radius (arcsec) around --blobradec positions within which sources are fit from scratch')
+    parser.add_argument('--detmap-cache-dir', default=None,
+                        help='Cache the detection maps without injected sources here and reuse them in later runs of the brick')
+    parser.add_argument('--resample-plans', action='store_true', default=False,
+                        help='Resample each image into the brick once per process and reuse that mapping in all stages')
+    parser.add_argument('--resample-plan-gb', type=float, default=2.,
+                        help='Size limit of the --resample-plans of each process, in GB')
+    parser.add_argument('--stream-coadds', action='store_true', default=False,
+                        help='Write and release the coadds one band at a time, to bound the memory of the coadds stage')
+    parser.add_argument('--blob-cost-model', default=None,
+                        help='Fit blobs in order of cost predicted by this json model (python -m legacypipe.blobcost) and write the blob-timing metrics file')
+    parser.add_argument('--shared-tims', default=False, action='store_true',
+                        help='Share the tims with the blob-fitting processes through /dev/shm rather than pickling them into each blob.')
 
     parser.add_argument(
         '--check-done', default=False, action='store_true',
@@ -3184,6 +3841,16 @@ python -u legacypipe/runbrick.py --plots --brick 2440p070 --zoom 1900 2400 450 9
                         action='store_false', help='Use constant sky rather than spline.')
     parser.add_argument('--unwise-coadds', default=False,
                         action='store_true', help='Write FITS and JPEG unWISE coadds?')
+    parser.add_argument('--wise-baseline-catalog', default=None,
+                        help='Tractor catalog of a baseline run of this brick; only fit the WISE fluxes of new sources and those near --blobradec positions')
+    parser.add_argument('--wise-refit-radius', type=float, default=30.,
+                        help='With --wise-baseline-catalog, radius (arcsec) around --blobradec positions within which WISE fluxes are re-fit')
+    parser.add_argument('--unwise-cache-dir', default=None,
+                        help='Cache the prepared unWISE cutouts of the brick here, for later runs of the brick')
+    parser.add_argument('--unwise-tile-cache-dir', default=None,
+                        help='Node-local directory (eg /dev/shm/unwise) caching decompressed unWISE mask and model-sky tiles across bricks')
+    parser.add_argument('--unwise-tile-cache-gb', type=float, default=4.,
+                        help='Size limit of --unwise-tile-cache-dir, in GB')
 
     parser.add_argument('--bail-out', default=False, action='store_true',
                         help='Bail out of "fitblobs" processing, writing all blobs from the checkpoint and skipping any remaining ones.')
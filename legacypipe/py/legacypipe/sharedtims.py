@@ -0,0 +1,132 @@
+from __future__ import print_function
+'''
+Shares the tims of a brick with the one_blob worker processes through
+node-local shared memory (files in /dev/shm) instead of pickling
+subimages, PSFs and image objects into every blob task.
+
+The parent writes, once per tim, the full image and inverse-error
+arrays as .npy files and the per-tim objects (WCS, sky, PSF, photocal,
+image object, ...) as a pickle.  Blob tasks then carry a small
+SharedSubtim descriptor (tim number and pixel bounds); workers
+memory-map the arrays (zero-copy, read-only) and unpickle the
+objects once per process, and rebuild the usual subtim arguments for
+one_blob.
+
+The pool workers are forked before stage_fitblobs runs, which is why
+this goes through named files rather than anonymous shared memory
+(legacypipe/internal/sharedmem.py).
+'''
+import os
+import pickle
+import numpy as np
+
+import logging
+logger = logging.getLogger('legacypipe.sharedtims')
+def info(*args):
+    from legacypipe.utils import log_info
+    log_info(logger, args)
+def debug(*args):
+    from legacypipe.utils import log_debug
+    log_debug(logger, args)
+
+class SharedSubtim(object):
+    '''
+    Stands for one subtim argument tuple of a blob task; see
+    attach_subtims().
+    '''
+    __slots__ = ('dirnm', 'itim', 'sx0', 'sx1', 'sy0', 'sy1')
+    def __init__(self, dirnm, itim, sx0, sx1, sy0, sy1):
+        self.dirnm = dirnm
+        self.itim = itim
+        self.sx0, self.sx1, self.sy0, self.sy1 = sx0, sx1, sy0, sy1
+
+    def __getstate__(self):
+        return (self.dirnm, self.itim, self.sx0, self.sx1, self.sy0, self.sy1)
+
+    def __setstate__(self, state):
+        (self.dirnm, self.itim, self.sx0, self.sx1, self.sy0, self.sy1) = state
+
+class SharedTims(object):
+    '''
+    Writes *tims* to a new directory under *shm_dir*; call cleanup()
+    (or use as a context manager) once the blobs are done.
+    '''
+    def __init__(self, tims, shm_dir='/dev/shm'):
+        import tempfile
+        self.dirnm = tempfile.mkdtemp(prefix='legacypipe-tims-', dir=shm_dir)
+        nbytes = 0
+        for itim,tim in enumerate(tims):
+            img = tim.getImage()
+            ie = tim.getInvError()
+            np.save(self._fn(itim, 'img'), img)
+            np.save(self._fn(itim, 'inverr'), ie)
+            nbytes += img.nbytes + ie.nbytes
+            tim.imobj.psfnorm = tim.psfnorm
+            tim.imobj.galnorm = tim.galnorm
+            if hasattr(tim.psf, 'clear_cache'):
+                tim.psf.clear_cache()
+            objs = (tim.getWcs(), tim.subwcs, tim.getPhotoCal(), tim.getSky(),
+                    tim.psf, tim.name, tim.band, tim.sig1, tim.modelMinval,
+                    tim.imobj)
+            with open(self._fn(itim, 'objs', '.pickle'), 'wb') as f:
+                pickle.dump(objs, f, protocol=pickle.HIGHEST_PROTOCOL)
+        info('Wrote', len(tims), 'tims (%.1f MB of pixels) to shared memory in' %
+             (nbytes / 1e6), self.dirnm)
+
+    def _fn(self, itim, kind, ext='.npy'):
+        return os.path.join(self.dirnm, 'tim-%i-%s%s' % (itim, kind, ext))
+
+    def subtim(self, itim, sx0, sx1, sy0, sy1):
+        return SharedSubtim(self.dirnm, itim, sx0, sx1, sy0, sy1)
+
+    def cleanup(self):
+        import shutil
+        shutil.rmtree(self.dirnm, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.cleanup()
+
+# per worker process: (dirnm, itim) -> (img, inverr, objs)
+_attached = {}
+
+def _attach(dirnm, itim):
+    key = (dirnm, itim)
+    t = _attached.get(key)
+    if t is None:
+        # a new brick: forget the previous one's tims
+        for k in list(_attached.keys()):
+            if k[0] != dirnm:
+                del _attached[k]
+        fn = os.path.join(dirnm, 'tim-%i-%%s' % itim)
+        # read-only: one_blob only writes to copies (SourceModels.save_images),
+        # and these views are reused by the next blobs of this worker
+        img = np.load(fn % 'img.npy', mmap_mode='r')
+        ie = np.load(fn % 'inverr.npy', mmap_mode='r')
+        with open(fn % 'objs.pickle', 'rb') as f:
+            objs = pickle.load(f)
+        t = _attached[key] = (img, ie, objs)
+    return t
+
+def attach_subtims(subtimargs):
+    '''
+    Turns the SharedSubtim entries of a blob task's *subtimargs* into
+    the argument tuples OneBlob.create_tims() expects; other entries
+    are passed through.
+    '''
+    out = []
+    for a in subtimargs:
+        if not isinstance(a, SharedSubtim):
+            out.append(a)
+            continue
+        img, ie, objs = _attach(a.dirnm, a.itim)
+        (wcs, subwcs, pcal, sky, psf, name, band, sig1, modelMinval,
+         imobj) = objs
+        slc = slice(a.sy0, a.sy1), slice(a.sx0, a.sx1)
+        # (pcal is copied since the fitting may freeze/thaw its params)
+        out.append((img[slc], ie[slc], wcs.shifted(a.sx0, a.sy0), subwcs,
+                    pcal.copy(), sky.shifted(a.sx0, a.sy0), psf, name,
+                    a.sx0, a.sx1, a.sy0, a.sy1, band, sig1, modelMinval, imobj))
+    return out
@@ -574,11 +574,130 @@ def bin_image(data, invvar, S):
     newdata[newiv == 0] = 0.
     return newdata,newiv
 
+def _wcs_key(wcs):
+    # identifies a target WCS, in ResamplePlanCache keys
+    H,W = wcs.shape
+    return (int(H), int(W), tuple(float(x) for x in wcs.crval),
+            tuple(float(x) for x in wcs.crpix), tuple(float(x) for x in wcs.cd))
+
+class ResamplePlan(object):
+    '''
+    The mapping of a tim's pixels into a target WCS, computed once and
+    then applied to any images of the tim: the nearest-pixel indices
+    (Yo,Xo,Yi,Xi), as from resample_with_wcs(), and the offsets (dx,dy)
+    of the exact input pixel positions from (Xi,Yi), for Lanczos-3
+    interpolation.
+
+    Raises OverlapError, like resample_with_wcs(), if the tim does not
+    overlap the target.
+    '''
+    def __init__(self, targetwcs, wcs):
+        from astrometry.util.resample import resample_with_wcs
+        self.Yo,self.Xo,self.Yi,self.Xi,_ = resample_with_wcs(
+            targetwcs, wcs, intType=np.int16)
+        if len(self.Yo) == 0:
+            self.dx = self.dy = np.zeros(0, np.float32)
+            return
+        rr,dd = targetwcs.pixelxy2radec(self.Xo + 1., self.Yo + 1.)
+        _,fx,fy = wcs.radec2pixelxy(rr, dd)
+        self.dx = (fx - 1. - self.Xi).astype(np.float32)
+        self.dy = (fy - 1. - self.Yi).astype(np.float32)
+
+    def nbytes(self):
+        return sum(a.nbytes for a in [self.Yo, self.Xo, self.Yi, self.Xi,
+                                      self.dx, self.dy])
+
+    def nearest(self):
+        return self.Yo,self.Xo,self.Yi,self.Xi
+
+    def lanczos(self, imgs):
+        '''
+        Lanczos-3 interpolates each of *imgs* (tim-shaped) at the target
+        pixels; returns a list of arrays matching Yo,Xo.
+        '''
+        from astrometry.util.util import lanczos3_interpolate
+        rimgs = [np.zeros(len(self.Yo), np.float32) for img in imgs]
+        lanczos3_interpolate(self.Xi.astype(np.int32), self.Yi.astype(np.int32),
+                             self.dx, self.dy, rimgs,
+                             [img.astype(np.float32) for img in imgs])
+        return rimgs
+
+def _plan_nbytes(plan):
+    return 0 if plan is None else plan.nbytes()
+
+class ResamplePlanCache(object):
+    '''
+    Process-wide cache of the ResamplePlan of each tim into a target
+    WCS, so that the stages that resample a tim into the brick
+    (detection maps, outlier masking, coadds) compute its mapping once
+    per process.  Each pool worker fills its own cache: the plans are
+    never sent between processes nor pickled with the tims.
+
+    Plans are keyed on the tim's name and pixel extent and on the target
+    WCS; the least recently used are dropped beyond *max_bytes* (a plan
+    takes 16 bytes per tim pixel overlapping the target).  The cache is
+    off while *max_bytes* is 0.
+    '''
+    def __init__(self, max_bytes=0):
+        from collections import OrderedDict
+        self.max_bytes = max_bytes
+        self.plans = OrderedDict()
+        self.nbytes = 0
+
+    @staticmethod
+    def key(tim, targetwcs):
+        return (tim.name, getattr(tim, 'x0', 0), getattr(tim, 'y0', 0),
+                tuple(tim.shape), _wcs_key(targetwcs))
+
+    def get(self, tim, targetwcs):
+        '''
+        Returns (plan, True) -- plan is None if *tim* does not overlap
+        *targetwcs* -- or (None, False) if the cache is off.
+        '''
+        from astrometry.util.resample import OverlapError
+        if self.max_bytes <= 0:
+            return None, False
+        key = self.key(tim, targetwcs)
+        plan = self.plans.pop(key, False)
+        if plan is False:
+            try:
+                plan = ResamplePlan(targetwcs, tim.subwcs)
+            except OverlapError:
+                plan = None
+            self.nbytes += _plan_nbytes(plan)
+        # most recently used goes last
+        self.plans[key] = plan
+        while self.nbytes > self.max_bytes and len(self.plans) > 1:
+            _,old = self.plans.popitem(last=False)
+            self.nbytes -= _plan_nbytes(old)
+        return plan, True
+
+resample_plan_cache = ResamplePlanCache()
+
+def tim_resample(tim, targetwcs, imgs):
+    '''
+    resample_with_wcs(targetwcs, tim.subwcs, imgs, 3, intType=np.int16),
+    using the tim's ResamplePlan if the resample_plan_cache is on.
+    '''
+    from astrometry.util.resample import resample_with_wcs,OverlapError
+    plan,ok = resample_plan_cache.get(tim, targetwcs)
+    if not ok:
+        return resample_with_wcs(targetwcs, tim.subwcs, imgs, 3, intType=np.int16)
+    if plan is None:
+        raise OverlapError()
+    Yo,Xo,Yi,Xi = plan.nearest()
+    return Yo,Xo,Yi,Xi,plan.lanczos(imgs)
+
 def tim_get_resamp(tim, targetwcs):
     from astrometry.util.resample import resample_with_wcs,OverlapError
 
     if hasattr(tim, 'resamp'):
         return tim.resamp
+    plan,ok = resample_plan_cache.get(tim, targetwcs)
+    if ok:
+        if plan is None or len(plan.Yo) == 0:
+            return None
+        return plan.nearest()
     try:
         Yo,Xo,Yi,Xi,_ = resample_with_wcs(targetwcs, tim.subwcs, intType=np.int16)
     except OverlapError:
@@ -1181,6 +1300,10 @@ class LegacySurveyData(object):
             return swap(os.path.join(basedir, 'metrics', brickpre,
                                      'all-models-%s.fits' % (brick)))
 
+        elif filetype in ['blob-timing']:
+            return swap(os.path.join(basedir, 'metrics', brickpre,
+                                     'blob-timing-%s.fits' % (brick)))
+
         elif filetype == 'ref-sources':
             return swap(os.path.join(basedir, 'metrics', brickpre,
                                      'reference-%s.fits' % (brick)))
@@ -19,13 +19,26 @@ def unwise_forcedphot(cat, tiles, band=1, roiradecbox=None,
                       pixelized_psf=False,
                       get_masks=None,
                       move_crpix=False,
-                      modelsky_dir=None):
+                      modelsky_dir=None,
+                      fixed_flux=None,
+                      tim_cache=None,
+                      tile_cache=None):
     '''
     Given a list of tractor sources *cat*
     and a list of unWISE tiles *tiles* (a fits_table with RA,Dec,coadd_id)
     runs forced photometry, returning a FITS table the same length as *cat*.
 
     *get_masks*: the WCS to resample mask bits into.
+
+    *fixed_flux*: optional array, one per source in *cat*; sources with
+    a finite value are held at that flux (Vega nanomaggies) -- they are
+    part of the model but are not fit, and get zero flux ivar and
+    fit stats.  Sources with NaN are fit as usual.
+
+    *tim_cache*: optional UnwiseTimCache of the prepared tile cutouts.
+
+    *tile_cache*: optional UnwiseTileCache to read the mask and
+    model-sky tiles through.
     '''
     from tractor import NanoMaggies, PointSource, Tractor, ExpGalaxy, DevGalaxy, FixedCompositeGalaxy
 
@@ -71,94 +84,28 @@ def unwise_forcedphot(cat, tiles, band=1, roiradecbox=None,
     if get_masks:
         mh,mw = get_masks.shape
         maskmap = np.zeros((mh,mw), np.uint32)
+
+    if tile_cache is not None:
+        cache_stats0 = tile_cache.stats()
     
     for tile in tiles:
         print('Reading WISE tile', tile.coadd_id, 'band', band)
 
-        tim = get_unwise_tractor_image(tile.unwise_dir, tile.coadd_id, band,
-                                       bandname=wanyband, roiradecbox=roiradecbox)
+        tim = None
+        if tim_cache is not None:
+            tim_key = tim_cache.key(tile, band, roiradecbox, move_crpix,
+                                    modelsky_dir, pixelized_psf, psf_broadening)
+            tim = tim_cache.get(tile, band, tim_key)
         if tim is None:
-            print('Actually, no overlap with tile', tile.coadd_id)
-            continue
-
-        if plots:
-            sig1 = tim.sig1
-            plt.clf()
-            plt.imshow(tim.getImage(), interpolation='nearest', origin='lower',
-                       cmap='gray', vmin=-3 * sig1, vmax=10 * sig1)
-            plt.colorbar()
-            tag = '%s W%i' % (tile.coadd_id, band)
-            plt.title('%s: tim data' % tag)
-            ps.savefig()
-
-            plt.clf()
-            plt.hist((tim.getImage() * tim.inverr)[tim.inverr > 0].ravel(),
-                     range=(-5,10), bins=100)
-            plt.xlabel('Per-pixel intensity (Sigma)')
-            plt.title(tag)
-            ps.savefig()
-
-        if move_crpix and band in [1, 2]:
-            realwcs = tim.wcs.wcs
-            x,y = realwcs.crpix
-            tile_crpix = tile.get('crpix_w%i' % band)
-            dx = tile_crpix[0] - 1024.5
-            dy = tile_crpix[1] - 1024.5
-            realwcs.set_crpix(x+dx, y+dy)
-            #print('CRPIX', x,y, 'shift by', dx,dy, 'to', realwcs.crpix)
-
-        if modelsky_dir and band in [1, 2]:
-            fn = os.path.join(modelsky_dir, '%s.%i.mod.fits' % (tile.coadd_id, band))
-            if not os.path.exists(fn):
-                raise RuntimeError('WARNING: does not exist:', fn)
-            x0,x1,y0,y1 = tim.roi
-            bg = fitsio.FITS(fn)[2][y0:y1, x0:x1]
-            #print('Read background map:', bg.shape, bg.dtype, 'vs image', tim.shape)
-
-            if plots:
-                plt.clf()
-                plt.subplot(1,2,1)
-                plt.imshow(tim.getImage(), interpolation='nearest', origin='lower',
-                           cmap='gray', vmin=-3 * sig1, vmax=5 * sig1)
-                plt.subplot(1,2,2)
-                plt.imshow(bg, interpolation='nearest', origin='lower',
-                           cmap='gray', vmin=-3 * sig1, vmax=5 * sig1)
-                tag = '%s W%i' % (tile.coadd_id, band)
-                plt.suptitle(tag)
-                ps.savefig()
-
-                plt.clf()
-                ha = dict(range=(-5,10), bins=100, histtype='step')
-                plt.hist((tim.getImage() * tim.inverr)[tim.inverr > 0].ravel(),
-                         color='b', label='Original', **ha)
-                plt.hist(((tim.getImage()-bg) * tim.inverr)[tim.inverr > 0].ravel(),
-                         color='g', label='Minus Background', **ha)
-                plt.axvline(0, color='k', alpha=0.5)
-                plt.xlabel('Per-pixel intensity (Sigma)')
-                plt.legend()
-                plt.title(tag + ': background')
-                ps.savefig()
-
-            # Actually subtract the background!
-            tim.data -= bg
-
-        # Floor the per-pixel variances
-        if band in [1,2]:
-            # in Vega nanomaggies per pixel
-            floor_sigma = {1: 0.5, 2: 2.0}
-            with np.errstate(divide='ignore'):
-                new_ie = 1. / np.hypot(1./tim.inverr, floor_sigma[band])
-            new_ie[tim.inverr == 0] = 0.
-
-            if plots:
-                plt.clf()
-                plt.plot((1. / tim.inverr[tim.inverr>0]).ravel(), (1./new_ie[tim.inverr>0]).ravel(), 'b.')
-                plt.title('unWISE per-pixel error: %s band %i' % (tile.coadd_id, band))
-                plt.xlabel('original')
-                plt.ylabel('floored')
-                ps.savefig()
-
-            tim.inverr = new_ie
+            tim = _unwise_tile_tim(tile, band, roiradecbox, wanyband, move_crpix,
+                                   modelsky_dir, pixelized_psf, psf_broadening, ps,
+                                   tile_cache)
+            if tim is None:
+                print('Actually, no overlap with tile', tile.coadd_id)
+                continue
+            if tim_cache is not None:
+                tim_cache.put(tile, band, tim_key, tim)
+        th,tw = tim.shape
 
         # Read mask file?
         if get_masks:
@@ -171,7 +118,7 @@ def unwise_forcedphot(cat, tiles, band=1, roiradecbox=None,
                 if os.path.exists(fn):
                     print('Reading unWISE mask file', fn)
                     x0,x1,y0,y1 = tim.roi
-                    tilemask = fitsio.FITS(fn)[0][y0:y1,x0:x1]
+                    tilemask = read_tile_slice(fn, 0, y0, y1, x0, x1, tile_cache)
                     break
             if tilemask is None:
                 print('unWISE mask file for tile', tile.coadd_id, 'does not exist')
@@ -191,90 +138,6 @@ def unwise_forcedphot(cat, tiles, band=1, roiradecbox=None,
                     # Shouldn't happen by this point
                     print('No overlap between WISE tile', tile.coadd_id, 'and brick')
 
-        # The tiles have some overlap, so zero out pixels outside the
-        # tile's unique area.
-        th,tw = tim.shape
-        xx,yy = np.meshgrid(np.arange(tw), np.arange(th))
-        rr,dd = tim.wcs.wcs.pixelxy2radec(xx+1, yy+1)
-        unique = radec_in_unique_area(rr, dd, tile.ra1, tile.ra2, tile.dec1, tile.dec2)
-        #print(np.sum(unique), 'of', (th*tw), 'pixels in this tile are unique')
-        tim.inverr[unique == False] = 0.
-        del xx,yy,rr,dd,unique
-
-        if plots:
-            sig1 = tim.sig1
-            plt.clf()
-            plt.imshow(tim.getImage() * (tim.inverr > 0),
-                       interpolation='nearest', origin='lower',
-                       cmap='gray', vmin=-3 * sig1, vmax=10 * sig1)
-            plt.colorbar()
-            tag = '%s W%i' % (tile.coadd_id, band)
-            plt.title('%s: tim data (unique)' % tag)
-            ps.savefig()
-
-        if pixelized_psf:
-            import unwise_psf
-            if (band == 1) or (band == 2):
-                # we only have updated PSFs for W1 and W2
-                psfimg = unwise_psf.get_unwise_psf(band, tile.coadd_id, 
-                                                   modelname='neo4_unwisecat')
-            else:
-                psfimg = unwise_psf.get_unwise_psf(band, tile.coadd_id)
-
-            if band == 4:
-                # oversample (the unwise_psf models are at native W4 5.5"/pix,
-                # while the unWISE coadds are made at 2.75"/pix.
-                ph,pw = psfimg.shape
-                subpsf = np.zeros((ph*2-1, pw*2-1), np.float32)
-                from astrometry.util.util import lanczos3_interpolate
-                xx,yy = np.meshgrid(np.arange(0., pw-0.51, 0.5, dtype=np.float32),
-                                    np.arange(0., ph-0.51, 0.5, dtype=np.float32))
-                xx = xx.ravel()
-                yy = yy.ravel()
-                ix = xx.astype(np.int32)
-                iy = yy.astype(np.int32)
-                dx = (xx - ix).astype(np.float32)
-                dy = (yy - iy).astype(np.float32)
-                psfimg = psfimg.astype(np.float32)
-                rtn = lanczos3_interpolate(ix, iy, dx, dy, [subpsf.flat], [psfimg])
-
-                if plots:
-                    plt.clf()
-                    plt.imshow(psfimg, interpolation='nearest', origin='lower')
-                    plt.title('Original PSF model')
-                    ps.savefig()
-                    plt.clf()
-                    plt.imshow(subpsf, interpolation='nearest', origin='lower')
-                    plt.title('Subsampled PSF model')
-                    ps.savefig()
-
-                psfimg = subpsf
-                del xx, yy, ix, iy, dx, dy
-
-            from tractor.psf import PixelizedPSF
-            psfimg /= psfimg.sum()
-            fluxrescales = {1: 1.04, 2: 1.005, 3: 1.0, 4: 1.0}
-            psfimg *= fluxrescales[band]
-            tim.psf = PixelizedPSF(psfimg)
-
-        if psf_broadening is not None and not pixelized_psf:
-            # psf_broadening is a factor by which the PSF FWHMs
-            # should be scaled; the PSF is a little wider
-            # post-reactivation.
-            psf = tim.getPsf()
-            from tractor import GaussianMixturePSF
-            if isinstance(psf, GaussianMixturePSF):
-                #
-                print('Broadening PSF: from', psf)
-                p0 = psf.getParams()
-                pnames = psf.getParamNames()
-                p1 = [p * psf_broadening**2 if 'var' in name else p
-                      for (p, name) in zip(p0, pnames)]
-                psf.setParams(p1)
-                print('Broadened PSF:', psf)
-            else:
-                print('WARNING: cannot apply psf_broadening to WISE PSF of type', type(psf))
-
         wcs = tim.wcs.wcs
         ok,x,y = wcs.radec2pixelxy(ra, dec)
         x = np.round(x - 1.).astype(int)
@@ -350,39 +213,66 @@ def unwise_forcedphot(cat, tiles, band=1, roiradecbox=None,
     minsb = 0.
     fitsky = False
 
+    # Sources to fit
+    fit = np.ones(Nsrcs, bool)
+    if fixed_flux is not None:
+        fit = np.logical_not(np.isfinite(fixed_flux))
+        for src,f in zip(cat, fixed_flux):
+            if np.isfinite(f):
+                src.setBrightness(NanoMaggies(**{wanyband: f}))
+        print('Fitting', np.sum(fit), 'of', Nsrcs, 'sources; the rest have fixed W%i fluxes'
+              % band)
+
     tractor = Tractor(tims, cat)
     if use_ceres:
         from tractor.ceres_optimizer import CeresOptimizer
         tractor.optimizer = CeresOptimizer(BW=ceres_block, BH=ceres_block)
     tractor.freezeParamsRecursive('*')
     tractor.thawPathsTo(wanyband)
+    if fixed_flux is not None:
+        tractor.catalog.freezeParams(*[int(i) for i in np.flatnonzero(np.logical_not(fit))])
 
     kwa = dict(fitstat_extras=[('pronexp', [tim.nims for tim in tims])])
     t0 = Time()
 
-    R = tractor.optimize_forced_photometry(
-        minsb=minsb, mindlnp=1., sky=fitsky, fitstats=True,
-        variance=True, shared_params=False,
-        wantims=wantims, **kwa)
-    print('unWISE forced photometry took', Time() - t0)
-
-    if use_ceres:
-        term = R.ceres_status['termination']
-        # Running out of memory can cause failure to converge
-        # and term status = 2.
-        # Fail completely in this case.
-        if term != 0:
-            print('Ceres termination status:', term)
-            raise RuntimeError(
-                'Ceres terminated with status %i' % term)
-
-    if wantims:
-        ims1 = R.ims1
-    flux_invvars = R.IV
-    if R.fitstats is not None:
+    # Results of fit sources; the fixed ones get zeros.
+    flux_invvars = np.zeros(Nsrcs)
+    if np.any(fit):
+        R = tractor.optimize_forced_photometry(
+            minsb=minsb, mindlnp=1., sky=fitsky, fitstats=True,
+            variance=True, shared_params=False,
+            wantims=wantims, **kwa)
+        print('unWISE forced photometry took', Time() - t0)
+
+        if use_ceres:
+            term = R.ceres_status['termination']
+            # Running out of memory can cause failure to converge
+            # and term status = 2.
+            # Fail completely in this case.
+            if term != 0:
+                print('Ceres termination status:', term)
+                raise RuntimeError(
+                    'Ceres terminated with status %i' % term)
+
+        if wantims:
+            ims1 = R.ims1
+        flux_invvars[fit] = R.IV
+        if R.fitstats is not None:
+            for k in fskeys:
+                x = getattr(R.fitstats, k)
+                fitstats[k] = np.zeros(Nsrcs, np.float32)
+                fitstats[k][fit] = np.array(x).astype(np.float32)
+    else:
+        print('No sources to fit in W%i' % band)
         for k in fskeys:
-            x = getattr(R.fitstats, k)
-            fitstats[k] = np.array(x).astype(np.float32)
+            fitstats[k] = np.zeros(Nsrcs, np.float32)
+        if wantims:
+            ims1 = []
+            for tim in tims:
+                dat = tim.getImage()
+                mod = tractor.getModelImage(tim)
+                ie = tim.getInvError()
+                ims1.append((dat, mod, ie, (dat - mod) * ie, None))
 
     if save_fits:
         for i,tim in enumerate(tims):
@@ -453,7 +343,7 @@ def unwise_forcedphot(cat, tiles, band=1, roiradecbox=None,
     nm_ivar = flux_invvars
     # Sources out of bounds, eg, never change from their default
     # (1-sigma or whatever) initial fluxes.  Zero them out instead.
-    nm[nm_ivar == 0] = 0.
+    nm[fit * (nm_ivar == 0)] = 0.
 
     phot.set(wband + '_nanomaggies', nm.astype(np.float32))
     phot.set(wband + '_nanomaggies_ivar', nm_ivar.astype(np.float32))
@@ -484,12 +374,355 @@ def unwise_forcedphot(cat, tiles, band=1, roiradecbox=None,
     rtn.phot = phot
     rtn.models = None
     rtn.maskmap = None
+    rtn.tile_cache_stats = None
+    if tile_cache is not None:
+        rtn.tile_cache_stats = tile_cache.stats(since=cache_stats0)
+        print('unWISE tile cache, W%i: %i hits, %i misses' %
+              (band, rtn.tile_cache_stats['hits'], rtn.tile_cache_stats['misses']))
     if get_models:
         rtn.models = models
     if get_masks:
         rtn.maskmap = maskmap
     return rtn
 
+class UnwiseTimCache(object):
+    '''
+    The prepared unWISE tile cutouts of unwise_forcedphot (one pickle
+    file per tile, band and set of inputs, under *dirnm*), so that
+    repeated runs of a brick -- eg, obiwan chunks, which only add
+    sources to the DECam images -- do not read and prepare the tiles
+    again.
+    '''
+    def __init__(self, dirnm):
+        self.dirnm = dirnm
+
+    @staticmethod
+    def key(tile, band, roiradecbox, move_crpix, modelsky_dir,
+            pixelized_psf, psf_broadening):
+        '''
+        What the prepared cutout depends on, as a string.
+        '''
+        import json
+        crpix = None
+        if move_crpix and band in [1, 2]:
+            crpix = [float(x) for x in tile.get('crpix_w%i' % band)]
+        return json.dumps(dict(
+            unwise_dir=str(tile.unwise_dir), coadd_id=str(tile.coadd_id),
+            band=int(band), crpix=crpix, modelsky_dir=modelsky_dir,
+            roiradecbox=[float(x) for x in roiradecbox],
+            unique=[float(tile.get(c)) for c in ['ra1','ra2','dec1','dec2']],
+            pixelized_psf=bool(pixelized_psf), psf_broadening=psf_broadening))
+
+    def fn(self, tile, band, key):
+        import hashlib
+        h = hashlib.sha1(key.encode()).hexdigest()[:16]
+        return os.path.join(self.dirnm, 'unwise-%s-w%i-%s.pickle' %
+                            (str(tile.coadd_id).strip(), band, h))
+
+    def get(self, tile, band, key):
+        fn = self.fn(tile, band, key)
+        if not os.path.exists(fn):
+            return None
+        from astrometry.util.file import unpickle_from_file
+        try:
+            k,tim = unpickle_from_file(fn)
+        except Exception as e:
+            print('Failed to read unWISE cutout cache', fn, ':', e)
+            return None
+        if k != key:
+            return None
+        print('Read cached unWISE cutout', fn)
+        return tim
+
+    def put(self, tile, band, key, tim):
+        from astrometry.util.file import pickle_to_file, trymakedirs
+        trymakedirs(self.dirnm)
+        fn = self.fn(tile, band, key)
+        # unique per writer: tasks of several bricks may share the cache
+        tmpfn = '%s.tmp-%i' % (fn, os.getpid())
+        pickle_to_file((key, tim), tmpfn)
+        os.rename(tmpfn, fn)
+
+class UnwiseTileCache(object):
+    '''
+    A node-local cache of whole, decompressed unWISE tile HDUs (mask
+    bits, model sky), shared between processes -- and bricks -- as .npy
+    files under *dirnm* (eg, in /dev/shm) that are memory-mapped to
+    serve cutouts.  It holds at most *max_bytes*; the least recently
+    used tiles are dropped first.
+    '''
+    def __init__(self, dirnm, max_bytes=4e9):
+        self.dirnm = dirnm
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self, since=None):
+        s = dict(hits=self.hits, misses=self.misses)
+        if since is not None:
+            for k in s:
+                s[k] -= since[k]
+        return s
+
+    def fn(self, fn, ext):
+        import hashlib
+        st = os.stat(fn)
+        key = '%s[%s] %i %i' % (os.path.realpath(fn), ext, st.st_size,
+                                int(st.st_mtime))
+        h = hashlib.sha1(key.encode()).hexdigest()[:16]
+        base = os.path.basename(fn).split('.')[0]
+        return os.path.join(self.dirnm, '%s-%s-%s.npy' % (base, ext, h))
+
+    def read(self, fn, ext, y0, y1, x0, x1):
+        '''
+        Returns HDU *ext* of FITS file *fn*, sliced [y0:y1, x0:x1].
+        '''
+        cfn = self.fn(fn, ext)
+        try:
+            img = np.load(cfn, mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            img = None
+        if img is not None:
+            self.hits += 1
+            try:
+                # mark as recently used
+                os.utime(cfn, None)
+            except OSError:
+                pass
+        else:
+            self.misses += 1
+            img = fitsio.read(fn, ext=ext)
+            self.put(cfn, img)
+        return np.array(img[y0:y1, x0:x1])
+
+    def put(self, cfn, img):
+        from astrometry.util.file import trymakedirs
+        trymakedirs(self.dirnm)
+        tmpfn = '%s.tmp-%i.npy' % (cfn[:-4], os.getpid())
+        try:
+            np.save(tmpfn, img)
+            os.rename(tmpfn, cfn)
+        except (IOError, OSError) as e:
+            print('Failed to write unWISE tile cache file', cfn, ':', e)
+            if os.path.exists(tmpfn):
+                os.remove(tmpfn)
+            return
+        self.trim()
+
+    def trim(self):
+        # Drop the least recently used tiles beyond max_bytes.  Processes
+        # that have a dropped file mapped keep reading it.
+        files = []
+        for f in os.listdir(self.dirnm):
+            if not f.endswith('.npy') or '.tmp-' in f:
+                continue
+            path = os.path.join(self.dirnm, f)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _,size,_ in files)
+        for _,size,path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+def read_tile_slice(fn, ext, y0, y1, x0, x1, tile_cache=None):
+    '''
+    Reads [y0:y1, x0:x1] of HDU *ext* of *fn*, through *tile_cache*
+    (an UnwiseTileCache) if given.
+    '''
+    if tile_cache is None:
+        return fitsio.FITS(fn)[ext][y0:y1, x0:x1]
+    return tile_cache.read(fn, ext, y0, y1, x0, x1)
+
+def _unwise_tile_tim(tile, band, roiradecbox, wanyband, move_crpix,
+                     modelsky_dir, pixelized_psf, psf_broadening, ps,
+                     tile_cache=None):
+    '''
+    Reads the cutout of unWISE *tile* in *band* and prepares it for
+    forced photometry (sky model, error floor, unique area, PSF).
+    Returns the tractor Image, or None if the tile does not overlap.
+    '''
+    plots = (ps is not None)
+    if plots:
+        import pylab as plt
+
+    tim = get_unwise_tractor_image(tile.unwise_dir, tile.coadd_id, band,
+                                   bandname=wanyband, roiradecbox=roiradecbox)
+    if tim is None:
+        return None
+
+    if plots:
+        sig1 = tim.sig1
+        plt.clf()
+        plt.imshow(tim.getImage(), interpolation='nearest', origin='lower',
+                   cmap='gray', vmin=-3 * sig1, vmax=10 * sig1)
+        plt.colorbar()
+        tag = '%s W%i' % (tile.coadd_id, band)
+        plt.title('%s: tim data' % tag)
+        ps.savefig()
+
+        plt.clf()
+        plt.hist((tim.getImage() * tim.inverr)[tim.inverr > 0].ravel(),
+                 range=(-5,10), bins=100)
+        plt.xlabel('Per-pixel intensity (Sigma)')
+        plt.title(tag)
+        ps.savefig()
+
+    if move_crpix and band in [1, 2]:
+        realwcs = tim.wcs.wcs
+        x,y = realwcs.crpix
+        tile_crpix = tile.get('crpix_w%i' % band)
+        dx = tile_crpix[0] - 1024.5
+        dy = tile_crpix[1] - 1024.5
+        realwcs.set_crpix(x+dx, y+dy)
+        #print('CRPIX', x,y, 'shift by', dx,dy, 'to', realwcs.crpix)
+
+    if modelsky_dir and band in [1, 2]:
+        fn = os.path.join(modelsky_dir, '%s.%i.mod.fits' % (tile.coadd_id, band))
+        if not os.path.exists(fn):
+            raise RuntimeError('WARNING: does not exist:', fn)
+        x0,x1,y0,y1 = tim.roi
+        bg = read_tile_slice(fn, 2, y0, y1, x0, x1, tile_cache)
+        #print('Read background map:', bg.shape, bg.dtype, 'vs image', tim.shape)
+
+        if plots:
+            plt.clf()
+            plt.subplot(1,2,1)
+            plt.imshow(tim.getImage(), interpolation='nearest', origin='lower',
+                       cmap='gray', vmin=-3 * sig1, vmax=5 * sig1)
+            plt.subplot(1,2,2)
+            plt.imshow(bg, interpolation='nearest', origin='lower',
+                       cmap='gray', vmin=-3 * sig1, vmax=5 * sig1)
+            tag = '%s W%i' % (tile.coadd_id, band)
+            plt.suptitle(tag)
+            ps.savefig()
+
+            plt.clf()
+            ha = dict(range=(-5,10), bins=100, histtype='step')
+            plt.hist((tim.getImage() * tim.inverr)[tim.inverr > 0].ravel(),
+                     color='b', label='Original', **ha)
+            plt.hist(((tim.getImage()-bg) * tim.inverr)[tim.inverr > 0].ravel(),
+                     color='g', label='Minus Background', **ha)
+            plt.axvline(0, color='k', alpha=0.5)
+            plt.xlabel('Per-pixel intensity (Sigma)')
+            plt.legend()
+            plt.title(tag + ': background')
+            ps.savefig()
+
+        # Actually subtract the background!
+        tim.data -= bg
+
+    # Floor the per-pixel variances
+    if band in [1,2]:
+        # in Vega nanomaggies per pixel
+        floor_sigma = {1: 0.5, 2: 2.0}
+        with np.errstate(divide='ignore'):
+            new_ie = 1. / np.hypot(1./tim.inverr, floor_sigma[band])
+        new_ie[tim.inverr == 0] = 0.
+
+        if plots:
+            plt.clf()
+            plt.plot((1. / tim.inverr[tim.inverr>0]).ravel(), (1./new_ie[tim.inverr>0]).ravel(), 'b.')
+            plt.title('unWISE per-pixel error: %s band %i' % (tile.coadd_id, band))
+            plt.xlabel('original')
+            plt.ylabel('floored')
+            ps.savefig()
+
+        tim.inverr = new_ie
+
+    # The tiles have some overlap, so zero out pixels outside the
+    # tile's unique area.
+    th,tw = tim.shape
+    xx,yy = np.meshgrid(np.arange(tw), np.arange(th))
+    rr,dd = tim.wcs.wcs.pixelxy2radec(xx+1, yy+1)
+    unique = radec_in_unique_area(rr, dd, tile.ra1, tile.ra2, tile.dec1, tile.dec2)
+    #print(np.sum(unique), 'of', (th*tw), 'pixels in this tile are unique')
+    tim.inverr[unique == False] = 0.
+    del xx,yy,rr,dd,unique
+
+    if plots:
+        sig1 = tim.sig1
+        plt.clf()
+        plt.imshow(tim.getImage() * (tim.inverr > 0),
+                   interpolation='nearest', origin='lower',
+                   cmap='gray', vmin=-3 * sig1, vmax=10 * sig1)
+        plt.colorbar()
+        tag = '%s W%i' % (tile.coadd_id, band)
+        plt.title('%s: tim data (unique)' % tag)
+        ps.savefig()
+
+    if pixelized_psf:
+        import unwise_psf
+        if (band == 1) or (band == 2):
+            # we only have updated PSFs for W1 and W2
+            psfimg = unwise_psf.get_unwise_psf(band, tile.coadd_id, 
+                                               modelname='neo4_unwisecat')
+        else:
+            psfimg = unwise_psf.get_unwise_psf(band, tile.coadd_id)
+
+        if band == 4:
+            # oversample (the unwise_psf models are at native W4 5.5"/pix,
+            # while the unWISE coadds are made at 2.75"/pix.
+            ph,pw = psfimg.shape
+            subpsf = np.zeros((ph*2-1, pw*2-1), np.float32)
+            from astrometry.util.util import lanczos3_interpolate
+            xx,yy = np.meshgrid(np.arange(0., pw-0.51, 0.5, dtype=np.float32),
+                                np.arange(0., ph-0.51, 0.5, dtype=np.float32))
+            xx = xx.ravel()
+            yy = yy.ravel()
+            ix = xx.astype(np.int32)
+            iy = yy.astype(np.int32)
+            dx = (xx - ix).astype(np.float32)
+            dy = (yy - iy).astype(np.float32)
+            psfimg = psfimg.astype(np.float32)
+            lanczos3_interpolate(ix, iy, dx, dy, [subpsf.flat], [psfimg])
+
+            if plots:
+                plt.clf()
+                plt.imshow(psfimg, interpolation='nearest', origin='lower')
+                plt.title('Original PSF model')
+                ps.savefig()
+                plt.clf()
+                plt.imshow(subpsf, interpolation='nearest', origin='lower')
+                plt.title('Subsampled PSF model')
+                ps.savefig()
+
+            psfimg = subpsf
+            del xx, yy, ix, iy, dx, dy
+
+        from tractor.psf import PixelizedPSF
+        psfimg /= psfimg.sum()
+        fluxrescales = {1: 1.04, 2: 1.005, 3: 1.0, 4: 1.0}
+        psfimg *= fluxrescales[band]
+        tim.psf = PixelizedPSF(psfimg)
+
+    if psf_broadening is not None and not pixelized_psf:
+        # psf_broadening is a factor by which the PSF FWHMs
+        # should be scaled; the PSF is a little wider
+        # post-reactivation.
+        psf = tim.getPsf()
+        from tractor import GaussianMixturePSF
+        if isinstance(psf, GaussianMixturePSF):
+            #
+            print('Broadening PSF: from', psf)
+            p0 = psf.getParams()
+            pnames = psf.getParamNames()
+            p1 = [p * psf_broadening**2 if 'var' in name else p
+                  for (p, name) in zip(p0, pnames)]
+            psf.setParams(p1)
+            print('Broadened PSF:', psf)
+        else:
+            print('WARNING: cannot apply psf_broadening to WISE PSF of type', type(psf))
+
+    return tim
+
 class wphotduck(object):
     pass
 
@@ -510,10 +743,11 @@ def unwise_phot(X):
     This is the entry-point from runbrick.py, called via mp.map()
     '''
     (wcat, tiles, band, roiradec, wise_ceres, pixelized_psf, get_mods, get_masks, ps,
-     move_crpix, modelsky_dir) = X
+     move_crpix, modelsky_dir, fixed_flux, tim_cache, tile_cache) = X
     kwargs = dict(roiradecbox=roiradec, band=band, pixelized_psf=pixelized_psf,
                   get_masks=get_masks, ps=ps, move_crpix=move_crpix,
-                  modelsky_dir=modelsky_dir)
+                  modelsky_dir=modelsky_dir, fixed_flux=fixed_flux,
+                  tim_cache=tim_cache, tile_cache=tile_cache)
     if get_mods:
         kwargs.update(get_models=get_mods)
 
@@ -1,5 +1,9 @@
+import os
+import tempfile
 import unittest
 
+import numpy as np
+
 class TestOneblob(unittest.TestCase):
 
     def test_modelsel(self):
@@ -58,5 +62,289 @@ class TestOneblob(unittest.TestCase):
         self.assertTrue(mod == 'dev')
 
 
+class TestCheckpointJournal(unittest.TestCase):
+
+    def test_append_reload(self):
+        from legacypipe.checkpoint import CheckpointJournal
+        fn = os.path.join(tempfile.mkdtemp(), 'checkpoint.pickle')
+        journal = CheckpointJournal(fn)
+        self.assertEqual(list(journal.read()), [])
+        journal.open()
+        R = [dict(brickname='b', iblob=i, result=None) for i in range(3)]
+        for r in R:
+            journal.append(r)
+        journal.close()
+
+        journal = CheckpointJournal(fn)
+        self.assertEqual(list(journal.read()), R)
+        journal.open(keep=R)
+        journal.append(dict(brickname='b', iblob=3, result=None))
+        journal.close()
+        self.assertEqual([r['iblob'] for r in CheckpointJournal(fn).read()],
+                         [0, 1, 2, 3])
+
+    def test_truncated_tail(self):
+        from legacypipe.checkpoint import CheckpointJournal
+        fn = os.path.join(tempfile.mkdtemp(), 'checkpoint.pickle')
+        journal = CheckpointJournal(fn)
+        journal.open()
+        for i in range(3):
+            journal.append(dict(brickname='b', iblob=i, result=None))
+        journal.close()
+        # a job killed while writing the last record
+        with open(fn, 'r+b') as f:
+            f.truncate(os.path.getsize(fn) - 5)
+
+        journal = CheckpointJournal(fn)
+        R = list(journal.read())
+        self.assertEqual([r['iblob'] for r in R], [0, 1])
+        journal.open(keep=R)
+        self.assertEqual(os.path.getsize(fn), journal.good_size)
+        journal.append(dict(brickname='b', iblob=2, result=None))
+        journal.close()
+        self.assertEqual([r['iblob'] for r in CheckpointJournal(fn).read()],
+                         [0, 1, 2])
+
+class _FakePos(object):
+    def __init__(self, ra, dec):
+        self.ra = ra
+        self.dec = dec
+
+class _FakeSource(object):
+    # a point source at pixel (ra, dec) of _FakeWcs
+    def __init__(self, ra, dec):
+        self.pos = _FakePos(ra, dec)
+    def getPosition(self):
+        return self.pos
+
+class _FakeWcs(object):
+    # pixel coordinates (0-indexed) are the ra,dec
+    def radec2pixelxy(self, ra, dec):
+        return True, np.asarray(ra) + 1., np.asarray(dec) + 1.
+    def pixel_scale(self):
+        return 0.262
+
+class TestSplitBlobs(unittest.TestCase):
+
+    def test_split_blob_sources(self):
+        from legacypipe.runbrick import _split_blob_sources
+        wcs = _FakeWcs()
+        # two pairs of touching sources, far apart
+        cat = [_FakeSource(10, 10), _FakeSource(40, 10),
+               _FakeSource(500, 10), _FakeSource(500, 40)]
+        groups = _split_blob_sources([0,1,2,3], cat, wcs, 4)
+        self.assertEqual(sorted([list(g) for g in groups]), [[0,1], [2,3]])
+        groups = _split_blob_sources([0,1,2,3], cat, wcs, 1)
+        self.assertEqual([list(g) for g in groups], [[0,1,2,3]])
+        groups = _split_blob_sources([0,1], cat, wcs, 4)
+        self.assertEqual([list(g) for g in groups], [[0,1]])
+
+    def test_merge_blob_groups(self):
+        from astrometry.util.fits import fits_table
+        from legacypipe.runbrick import _merge_blob_groups
+        wcs = _FakeWcs()
+        blobs = np.zeros((100, 200), np.int32) - 1
+        blobs[10:50, 20:120] = 7
+        blobs[30:50, 100:120] = 8
+        geometry = (20, 10, 100, 40, 4000, 3)
+
+        def part(srcs, Isrcs):
+            B = fits_table()
+            B.sources = np.array(srcs, dtype=object)
+            B.Isrcs = np.array(Isrcs)
+            n = len(B)
+            B.iblob = np.zeros(n, np.int32) + 7
+            for c in ['blob_x0', 'blob_y0', 'blob_width', 'blob_height',
+                      'blob_nimages']:
+                B.set(c, np.zeros(n, np.int16))
+            B.blob_npix = np.zeros(n, np.int32)
+            B.blob_totalpix = np.zeros(n, np.int32) + 100
+            B.cpu_blob = np.zeros(n, np.float32) + 1.
+            B.finished_in_blob = np.zeros(n, bool)
+            return B
+        # one source has moved into the other blob
+        R = [dict(brickname='b', iblob=7, group=(1, 2, geometry),
+                  result=part([_FakeSource(90, 30), _FakeSource(110, 40)], [2, 3])),
+             dict(brickname='b', iblob=3, result=None),
+             dict(brickname='b', iblob=7, group=(0, 2, geometry),
+                  result=part([_FakeSource(30, 20)], [0]))]
+        M = list(_merge_blob_groups(iter(R), blobs, wcs))
+        self.assertEqual([r['iblob'] for r in M], [3, 7])
+        B = M[1]['result']
+        self.assertEqual(list(B.Isrcs), [0, 2, 3])
+        self.assertTrue(np.all(B.blob_x0 == 20))
+        self.assertTrue(np.all(B.blob_y0 == 10))
+        self.assertTrue(np.all(B.blob_width == 100))
+        self.assertTrue(np.all(B.blob_height == 40))
+        self.assertTrue(np.all(B.blob_npix == 4000))
+        self.assertTrue(np.all(B.blob_nimages == 3))
+        self.assertTrue(np.all(B.blob_totalpix == 200))
+        self.assertTrue(np.all(B.cpu_blob == 2.))
+        self.assertEqual(list(B.finished_in_blob), [True, True, False])
+
+class TestCoaddWindow(unittest.TestCase):
+
+    def test_update(self):
+        from legacypipe.coadds import _CoaddWindow
+        rng = np.random.RandomState(42)
+        H,W = 50, 60
+        # the distinct pixels one tim resamples to
+        I = rng.choice(H*W // 2, size=500, replace=False) + H*W // 4
+        Yo,Xo = (I // W).astype(np.int16), (I % W).astype(np.int16)
+        v = rng.normal(size=len(I)).astype(np.float32)
+        win = _CoaddWindow(Yo, Xo)
+        for op,ufunc in [(np.add, None), (np.maximum, np.maximum)]:
+            X = rng.normal(size=(H,W)).astype(np.float32)
+            expected = X.copy()
+            if ufunc is None:
+                expected[Yo,Xo] += v
+            else:
+                expected[Yo,Xo] = ufunc(expected[Yo,Xo], v)
+            win.update(X, v, op=op)
+            self.assertTrue(np.array_equal(X, expected))
+        # scalar values
+        X = np.zeros((H,W), np.int16)
+        expected = X.copy()
+        expected[Yo,Xo] |= 4
+        win.update(X, 4, op=np.bitwise_or)
+        self.assertTrue(np.array_equal(X, expected))
+
+class TestDepthHistogram(unittest.TestCase):
+
+    def test_depth_histogram(self):
+        from legacypipe.runbrick import (_depth_histogram, _depth_table,
+                                         _depth_histogram_band, _depth_bins)
+        rng = np.random.RandomState(42)
+        # no brick edges: all the pixels count
+        brick = object()
+        bands = ['g', 'r']
+        detivs = [rng.uniform(1, 1e4, size=(20,30)) for b in bands]
+        galdetivs = [d / 2. for d in detivs]
+        detivs[0][0,:] = 0.
+        D = _depth_histogram(brick, None, bands, detivs, galdetivs)
+        self.assertEqual(len(D), len(_depth_bins()) - 1)
+        for band,detiv in zip(bands, detivs):
+            counts = D.get('counts_ptsrc_%s' % band)
+            self.assertEqual(counts.sum(), detiv.size)
+            with np.errstate(divide='ignore'):
+                depth = -2.5 * (np.log10(5. / np.sqrt(detiv)) - 9)
+            depth[np.logical_not(np.isfinite(depth))] = 0.
+            self.assertTrue(np.array_equal(
+                counts, np.histogram(depth, bins=_depth_bins())[0]))
+        self.assertEqual(D.counts_ptsrc_g[0], 30)
+        # band by band, as stage_coadds does
+        D2,U = _depth_table(brick, None)
+        for band,detiv,galdetiv in zip(bands, detivs, galdetivs):
+            _depth_histogram_band(D2, U, band, detiv, galdetiv)
+        for c in D.get_columns():
+            self.assertTrue(np.array_equal(D.get(c), D2.get(c)))
+
+class TestUnwiseTileCache(unittest.TestCase):
+
+    def test_trim(self):
+        from legacypipe.unwise import UnwiseTileCache
+        dirnm = tempfile.mkdtemp()
+        img = np.zeros((10,10), np.float32)
+        cache = UnwiseTileCache(dirnm)
+        fns = [os.path.join(dirnm, 'tile%i.npy' % i) for i in range(3)]
+        cache.put(fns[0], img)
+        cache.put(fns[1], img)
+        # room for 2 tiles
+        cache.max_bytes = 2.5 * os.path.getsize(fns[0])
+        # a temp file of another process is left alone
+        tmpfn = os.path.join(dirnm, 'tile9.tmp-1.npy')
+        np.save(tmpfn, img)
+        # tile0 was used last
+        t = os.path.getmtime(fns[0])
+        os.utime(fns[1], (t - 20, t - 20))
+        os.utime(fns[0], (t - 10, t - 10))
+        cache.put(fns[2], img)
+        self.assertTrue(os.path.exists(fns[0]))
+        self.assertFalse(os.path.exists(fns[1]))
+        self.assertTrue(os.path.exists(fns[2]))
+        self.assertTrue(os.path.exists(tmpfn))
+
+
+class _NoSky(object):
+    def addTo(self, img, scale=1.):
+        pass
+
+class _FakeTim(object):
+    # a tim of shape (h,w) that maps 1:2 (pixel x,y to x+dx,y+dy and its
+    # neighbours) into the brick
+    def __init__(self, name, band, image, invvar, dx, dy):
+        self.name = name
+        self.band = band
+        self.image = image
+        self.invvar = invvar
+        self.shape = image.shape
+        self.psf_sigma = 1.5
+        self.sig1 = 0.1
+        self.dq = None
+        h,w = self.shape
+        Yi,Xi = np.unravel_index(np.arange(h*w), (h,w))
+        Yi,Xi = np.repeat(Yi, 2), np.repeat(Xi, 2)
+        Yo = Yi + dy
+        Xo = 2 * Xi + np.tile([0, 1], h*w) + dx
+        self.resamp = tuple(a.astype(np.int16) for a in (Yo,Xo,Yi,Xi))
+    def getImage(self):
+        return self.image
+    def getInvvar(self):
+        return self.invvar
+    def getInvError(self):
+        return np.sqrt(self.invvar)
+    def getSky(self):
+        return _NoSky()
+
+class _FakeTargetWcs(object):
+    shape = (60, 130)
+    crval = (10., 20.)
+    crpix = (65., 30.)
+    cd = (-7.3e-5, 0., 0., 7.3e-5)
+
+class _SerialMap(object):
+    def map(self, func, args):
+        return list(map(func, args))
+
+class TestDetectionMapCache(unittest.TestCase):
+
+    def test_cached_detection_maps(self):
+        from legacypipe.detection import detection_maps
+        from legacypipe.detmapcache import (DetectionMapCache,
+                                            cached_detection_maps)
+        rng = np.random.RandomState(42)
+        targetwcs = _FakeTargetWcs()
+        shape = (40, 50)
+        base = [rng.normal(scale=0.1, size=shape).astype(np.float32)
+                for i in range(3)]
+        invvar = np.zeros(shape, np.float32) + 100.
+        invvar[5:8, 10:20] = 0.
+        def sims(n):
+            img = np.zeros(shape, np.float32)
+            for i in range(n):
+                x,y = rng.randint(0, shape[1]), rng.randint(0, shape[0])
+                img[max(y-2,0):y+3, max(x-2,0):x+3] += rng.uniform(1, 10)
+            return img
+        def tims(images):
+            T = []
+            for i,(b,img) in enumerate(zip(base, images)):
+                tim = _FakeTim('tim%i' % i, 'gr'[i % 2], b + img, invvar,
+                               5 * i, 3 * i)
+                tim.sims_image = img
+                T.append(tim)
+            return T
+        cache = DetectionMapCache(tempfile.mkdtemp())
+        mp = _SerialMap()
+        for run in range(2):
+            T = tims([sims(5), sims(3), np.zeros(shape, np.float32)])
+            detmaps,detivs,satmaps = cached_detection_maps(
+                cache, 'brick', T, targetwcs, ['g','r'], mp, apodize=10)
+            expected = detection_maps(T, targetwcs, ['g','r'], mp, apodize=10)
+            for got,exp in zip([detmaps, detivs, satmaps], expected):
+                for g,e in zip(got, exp):
+                    self.assertTrue(np.allclose(g, e, rtol=1e-4, atol=1e-4))
+        self.assertEqual(os.listdir(cache.dirnm), ['detmaps-brick.npz'])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,4 +1,5 @@
 from mpi_master_slave.master_slave import *
 from mpi_master_slave.work_queue import *
 from mpi_master_slave.multi_work_queue import *
+from mpi_master_slave.sub_master import SubMaster, split_by_node, batches, node_shared_array
 import mpi_master_slave.exceptions
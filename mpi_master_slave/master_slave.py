@@ -1,31 +1,109 @@
 from mpi4py import MPI
 from enum import IntEnum
+import time
 from mpi_master_slave import exceptions
 from abc import ABC, abstractmethod
 
 # Define MPI message tags
-Tags = IntEnum('Tags', 'READY START DONE EXIT')
+Tags = IntEnum('Tags', 'READY START DONE EXIT HEARTBEAT')
 
 __all__ = ['Master', 'Slave']
 __author__ = 'Luca Scarabello'
 
+class Mailbox:
+    """
+    Receives the messages slaves send to rank 0 with MPI.ANY_SOURCE, so the
+    cost of dispatching is per message and not per slave. There is one
+    Mailbox per communicator, shared by all the Masters of the process:
+    each Master pops the messages of its own slaves
+    """
+
+    def __init__(self, comm):
+        self.comm = comm
+        self.status = MPI.Status()
+        self.pending = {}
+        self.forgotten = set()
+
+    def poll(self):
+        """
+        Receive all the messages already arrived, return how many
+        """
+        n = 0
+        while self.comm.Iprobe(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG,
+                               status=self.status):
+            source = self.status.Get_source()
+            tag = self.status.Get_tag()
+            data = self.comm.recv(source=source, tag=tag)
+            if source not in self.forgotten:
+                self.pending.setdefault(source, []).append((tag, data))
+            n += 1
+        return n
+
+    def wait(self, timeout=None):
+        """
+        Block until a message is pending or timeout seconds passed. With no
+        timeout this is a blocking MPI Probe, otherwise Iprobe with a short
+        backoff since MPI has no timed wait
+        """
+        if self.pending or self.poll():
+            return
+        if timeout is None:
+            self.comm.Probe(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG)
+            self.poll()
+            return
+        t_end = time.time() + timeout
+        delay = 1e-4
+        while not self.poll() and time.time() < t_end:
+            time.sleep(delay)
+            delay = min(2 * delay, 0.01)
+
+    def pop(self, sources):
+        """
+        Remove and return {source: [(tag, data), ...]} for the given sources
+        """
+        self.poll()
+        return {s: self.pending.pop(s) for s in set(self.pending) & sources}
+
+    def forget(self, source):
+        """
+        Drop the pending and future messages of source (e.g. a dead slave)
+        """
+        self.pending.pop(source, None)
+        self.forgotten.add(source)
+
+_mailboxes = []
+
+def get_mailbox(comm):
+    for c, mailbox in _mailboxes:
+        if c == comm:
+            return mailbox
+    mailbox = Mailbox(comm)
+    _mailboxes.append((comm, mailbox))
+    return mailbox
+
 class Master:
     """
     The main process creates one or more of this class that handle groups of
     slave processes
     """
     
-    def __init__(self, slaves = None):
+    def __init__(self, slaves = None, comm = None):
         
         if slaves is None:
             slaves = []
+        if comm is None:
+            comm = MPI.COMM_WORLD
             
-        self.comm = MPI.COMM_WORLD
+        self.comm = comm
         self.status = MPI.Status()        
+        self.mailbox = get_mailbox(self.comm)
         self.slaves = set(slaves)
         self.ready   = set()
         self.running = set()
         self.completed = {}
+        self.last_seen = {}
+        # slaves given up on by remove_dead_slave, maybe still alive
+        self.removed = set()
         
     def num_slaves(self):
         return len(self.slaves)
@@ -55,16 +133,34 @@ class Master:
             
         return None
 
+    def update(self):
+        """
+        Apply the messages received from this Master's slaves
+        """
+        now = time.time()
+        for slave, messages in self.mailbox.pop(self.slaves).items():
+            for tag, data in messages:
+                if tag == Tags.READY:
+                    self.ready.add(slave)
+                elif tag == Tags.DONE:
+                    self.running.discard(slave)
+                    self.completed[slave] = data
+                    self.last_seen[slave] = now
+                elif tag == Tags.HEARTBEAT:
+                    self.last_seen[slave] = now
+
+    def wait(self, timeout=None):
+        """
+        Block until some slave sends a message (or timeout seconds passed),
+        instead of sleeping between calls to get_ready_slaves and
+        get_completed_slaves
+        """
+        self.mailbox.wait(timeout)
+
     def get_ready_slaves(self):
                 
         # Check processes that are ready to start working again
-        possibly_ready = self.slaves - (self.ready | self.running)
-        for s in possibly_ready:
-                           
-            if self.comm.Iprobe(source=s, tag=Tags.READY):
-                self.comm.recv(source=s, tag=Tags.READY, status=self.status)
-                slave = self.status.Get_source()
-                self.ready.add(slave)
+        self.update()
 
         # don't return completed ones, caller needs to collect returned data first
         return self.ready - (self.running | self.completed.keys())
@@ -77,6 +173,7 @@ class Master:
             self.comm.send(obj=data, dest=slave, tag=Tags.START)
             self.ready.remove(slave)
             self.running.add(slave)
+            self.last_seen[slave] = time.time()
 
         # Caller giving a non-ready slave a job is bad! 
         else:
@@ -86,16 +183,42 @@ class Master:
     def get_completed_slaves(self):
         
         # check for completed job and store returned data
-        for s in set(self.running):
-            
-            if self.comm.Iprobe(source=s, tag=Tags.DONE):
-                data = self.comm.recv(source=s, tag=Tags.DONE, status=self.status)
-                slave = self.status.Get_source()
-                self.running.remove(slave)
-                self.completed[slave] = data
+        self.update()
         
         return set(self.completed.keys())
 
+    def get_heartbeats(self):
+        """
+        Collect the heartbeats sent by running slaves (see Slave.heartbeat)
+        and return the time each running slave was last heard of
+        """
+        self.update()
+
+        return {s: self.last_seen[s] for s in self.running}
+
+    def get_dead_slaves(self, timeout):
+        """
+        Running slaves that have not been heard of for more than timeout
+        seconds. Only meaningful if the slaves send heartbeats while working
+        """
+        now = time.time()
+        return set(s for s, t in self.get_heartbeats().items()
+                   if now - t > timeout)
+
+    def remove_dead_slave(self, slave):
+        """
+        Forget a slave (e.g. from get_dead_slaves) so that it is never given
+        work again nor waited for at termination. Its late messages are
+        dropped; terminate_slaves still sends it EXIT, in case it was only
+        slow
+        """
+        for group in (self.slaves, self.ready, self.running):
+            group.discard(slave)
+        self.removed.add(slave)
+        self.completed.pop(slave, None)
+        self.last_seen.pop(slave, None)
+        self.mailbox.forget(slave)
+
     def get_data(self, completed_slave):
         
         # onece the caller collect the returned data the job can be run again
@@ -115,8 +238,27 @@ class Master:
 
         for s in self.slaves:
             self.comm.send(obj=None, dest=s, tag=Tags.EXIT)
+        # removed slaves may be hung: don't block on them nor wait for an
+        # answer (a slow one gets EXIT once it asks for more work)
+        exit_requests = [self.comm.isend(None, dest=s, tag=Tags.EXIT)
+                         for s in self.removed]
         for s in self.slaves:
             self.comm.recv(source=s, tag=Tags.EXIT)
+        self.free_requests(exit_requests)
+
+    @staticmethod
+    def free_requests(requests):
+        """
+        Complete the requests that can be, cancel and free the others: a
+        request still pending at MPI_Finalize is erroneous, and a hung
+        slave must not block the shutdown
+        """
+        if MPI.Request.Testall(requests):
+            return
+        for req in requests:
+            if not req.Test():
+                req.Cancel()
+                req.Free()
     
     
 class Slave(ABC):
@@ -124,8 +266,11 @@ class Slave(ABC):
     A slave process extend this class, create an instance and invoke the run
     process
     """
-    def __init__(self):
-        self.comm = MPI.COMM_WORLD
+    def __init__(self, comm = None):
+        if comm is None:
+            comm = MPI.COMM_WORLD
+        # the Master is rank 0 of comm
+        self.comm = comm
         
     def run(self):
         """
@@ -147,6 +292,13 @@ class Slave(ABC):
         
         self.comm.send(None, dest=0, tag=Tags.EXIT)
         
+    def heartbeat(self):
+        """
+        Call this periodically from do_work to tell the Master this slave is
+        still alive (see Master.get_dead_slaves)
+        """
+        self.comm.send(None, dest=0, tag=Tags.HEARTBEAT)
+
     @abstractmethod
     def do_work(self, data):
         """
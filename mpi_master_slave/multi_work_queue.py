@@ -94,6 +94,15 @@ class MultiWorkQueue:
                 master.move_slave(to_master=other_work_queue.master)
                 break
 
+    def wait(self, timeout=None):
+        """
+        Block until any slave sends a message (or timeout seconds passed), all
+        the Masters share the same Mailbox
+        """
+        for work_queue in self.work_queue.values():
+            work_queue.wait(timeout)
+            break
+
     def get_completed_work(self, task_id):
         return self.work_queue[task_id].get_completed_work()
 
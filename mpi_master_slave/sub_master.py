@@ -0,0 +1,97 @@
+from mpi4py import MPI
+from mpi_master_slave import Master, Slave
+from mpi_master_slave import WorkQueue
+
+__all__ = ['SubMaster', 'split_by_node', 'batches', 'node_shared_array']
+
+def split_by_node(comm=None):
+    """
+    Split comm for a two-level Master/SubMaster/Slave layout
+
+    Returns (node_comm, leader_comm). Rank 0 of comm is the global Master: it
+    has no node_comm and is rank 0 of leader_comm. On every node, node rank 0
+    is a SubMaster, member of leader_comm, and the other ranks of node_comm are
+    its Slaves (leader_comm is MPI.COMM_NULL for them)
+    """
+    if comm is None:
+        comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
+    shared = comm.Split_type(MPI.COMM_TYPE_SHARED, key=rank)
+    node_id = shared.allreduce(rank, op=MPI.MIN)
+    shared.Free()
+
+    # the global Master is left out of its node
+    color = MPI.UNDEFINED if rank == 0 else node_id
+    node_comm = comm.Split(color, key=rank)
+
+    is_leader = rank == 0 or node_comm.Get_rank() == 0
+    leader_comm = comm.Split(0 if is_leader else MPI.UNDEFINED, key=rank)
+    return node_comm, leader_comm
+
+def batches(tasks, size):
+    """
+    Group tasks in lists of size tasks, one list is the work of a SubMaster
+    """
+    tasks = list(tasks)
+    return [tasks[i:i + size] for i in range(0, len(tasks), size)]
+
+def node_shared_array(node_comm, array=None, shape=None, dtype=None):
+    """
+    numpy array in MPI shared memory, one copy per node
+
+    Node rank 0 passes the array (e.g. a table read from disk) and the others
+    get a zero-copy view of it, so node-local ranks share cached tables
+    instead of each reading its own. Collective on node_comm
+    """
+    import numpy as np
+    if node_comm.Get_rank() == 0:
+        shape, dtype = array.shape, array.dtype
+    shape, dtype = node_comm.bcast((shape, dtype), root=0)
+    itemsize = np.dtype(dtype).itemsize
+    nbytes = int(np.prod(shape)) * itemsize
+    win = MPI.Win.Allocate_shared(nbytes if node_comm.Get_rank() == 0 else 0,
+                                  itemsize, comm=node_comm)
+    buf, _ = win.Shared_query(0)
+    shared = np.ndarray(buffer=buf, dtype=dtype, shape=shape)
+    if node_comm.Get_rank() == 0:
+        shared[...] = array
+    node_comm.Barrier()
+    # keep the window alive as long as the array
+    return shared, win
+
+
+class SubMaster(Slave):
+    """
+    Node-local master: a Slave of the global Master (over leader_comm) whose
+    work is a batch of tasks, that it runs on the Slaves of its node (over
+    node_comm). Only one message per batch crosses the interconnect to the
+    global Master, everything else stays on the node
+    """
+
+    def __init__(self, node_comm, leader_comm, heartbeat_interval=None):
+        super(SubMaster, self).__init__(comm=leader_comm)
+        self.master = Master(range(1, node_comm.Get_size()), comm=node_comm)
+        self.work_queue = WorkQueue(self.master)
+        self.heartbeat_interval = heartbeat_interval
+
+    def do_work(self, batch):
+        """
+        Run the batch on the local Slaves, return the list of their results
+        """
+        for data in batch:
+            self.work_queue.add_work(data)
+
+        results = []
+        while not self.work_queue.done():
+            self.work_queue.do_work()
+            for slave_return_data in self.work_queue.get_completed_work():
+                results.append(slave_return_data)
+            if not self.work_queue.done():
+                self.work_queue.wait(self.heartbeat_interval)
+                if self.heartbeat_interval is not None:
+                    self.heartbeat()
+        return results
+
+    def run(self):
+        super(SubMaster, self).run()
+        self.master.terminate_slaves()
@@ -50,6 +50,14 @@ class WorkQueue:
 
             self.master.run(slave, data)
 
+    def wait(self, timeout=None):
+        """
+        Block until a slave of the Master becomes ready or completes its work
+        (or timeout seconds passed). Call it between do_work and
+        get_completed_work instead of sleeping
+        """
+        self.master.wait(timeout)
+
     def get_completed_work(self):
         """
         Fetch the return value of slave that completed its work
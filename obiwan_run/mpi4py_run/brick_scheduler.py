@@ -0,0 +1,186 @@
+"""
+Fault-tolerant brick scheduler for example1.py (mode 'scheduler')
+
+Keeps the state of every brick (queued/running/done/failed) in a json file
+that is rewritten as bricks finish, so a killed allocation resumes from it
+without rerunning brickstat. Failed bricks are requeued until their retry
+budget is used up, running slaves that stop sending heartbeats are dropped
+and their brick requeued, and bricks are handed out longest (predicted) first.
+"""
+import json
+import os
+import time
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+def read_brick_sizes(fn):
+    """{brickname: number of randoms} from random_division's brick_list.out"""
+    sizes = {}
+    if fn is None or not os.path.exists(fn):
+        return sizes
+    for line in open(fn):
+        words = line.split()
+        if len(words) == 2:
+            sizes[words[0]] = int(words[1])
+    return sizes
+
+
+class BrickState(object):
+    """
+    State of each brick of a run, persisted to the json file fn
+
+    Each brick has a state, the number of failed attempts and the runtime [s]
+    of its last attempt (None if never finished one)
+    """
+
+    def __init__(self, fn, bricks=None, save_every=30.):
+        self.fn = fn
+        self.save_every = save_every
+        self.last_save = 0.
+        if os.path.exists(fn):
+            self.bricks = json.load(open(fn))
+            # left running by an allocation that got killed
+            for b in self.bricks.values():
+                if b['state'] == RUNNING:
+                    b['state'] = QUEUED
+        else:
+            self.bricks = {}
+        for brick in (bricks if bricks is not None else []):
+            if not brick in self.bricks:
+                self.bricks[brick] = dict(state=QUEUED, attempts=0, runtime=None)
+
+    def with_state(self, state):
+        return [brick for brick, b in self.bricks.items() if b['state'] == state]
+
+    def set(self, brick, state, runtime=None):
+        b = self.bricks[brick]
+        b['state'] = state
+        if runtime is not None:
+            b['runtime'] = runtime
+
+    def save(self, force=False):
+        """Atomic rewrite of the json file, at most every save_every seconds"""
+        now = time.time()
+        if not force and now - self.last_save < self.save_every:
+            return
+        tmpfn = self.fn + '.tmp'
+        with open(tmpfn, 'w') as f:
+            json.dump(self.bricks, f)
+        os.rename(tmpfn, self.fn)
+        self.last_save = now
+
+    def summary(self):
+        return ', '.join('%d %s' % (len(self.with_state(s)), s)
+                         for s in [QUEUED, RUNNING, DONE, FAILED])
+
+
+class BrickScheduler(object):
+    """
+    Drive a Master's slaves through the queued bricks of a BrickState
+
+    Slaves get (brickname, attempt) and must return (ok, message, runtime),
+    sending Slave.heartbeat() at least every heartbeat_timeout seconds while
+    working.
+
+    Args:
+        master: mpi_master_slave.Master
+        state: BrickState
+        brick_sizes: {brickname: number of randoms}, to predict the cost of
+            bricks that never ran
+        max_retries: number of times a failed brick is requeued
+        heartbeat_timeout: seconds without news before a running slave is dead
+        poll: max seconds to wait for a slave message before checking heartbeats
+    """
+
+    def __init__(self, master, state, brick_sizes=None, max_retries=2,
+                 heartbeat_timeout=600., poll=10.):
+        self.master = master
+        self.state = state
+        self.brick_sizes = brick_sizes if brick_sizes is not None else {}
+        self.max_retries = max_retries
+        self.heartbeat_timeout = heartbeat_timeout
+        self.poll = poll
+        self.running = {}
+
+    def mean_rate(self):
+        """Mean runtime per random of the bricks that ran, None if none did"""
+        rates = [b['runtime'] / self.brick_sizes[name]
+                 for name, b in self.state.bricks.items()
+                 if b['runtime'] is not None and self.brick_sizes.get(name, 0) > 0]
+        if rates:
+            return sum(rates) / len(rates)
+        return None
+
+    def predicted_cost(self, brick, rate=None):
+        """Runtime of the last attempt if any, else number of randoms scaled
+        by rate, the mean runtime per random (see mean_rate)"""
+        b = self.state.bricks[brick]
+        if b['runtime'] is not None:
+            return b['runtime']
+        nran = self.brick_sizes.get(brick, 0)
+        if rate is not None:
+            return nran * rate
+        return nran
+
+    def order_queue(self):
+        queue = self.state.with_state(QUEUED)
+        rate = self.mean_rate()
+        queue.sort(key=lambda brick: self.predicted_cost(brick, rate),
+                   reverse=True)
+        return queue
+
+    def failed(self, brick, runtime=None):
+        b = self.state.bricks[brick]
+        b['attempts'] += 1
+        if b['attempts'] <= self.max_retries:
+            self.state.set(brick, QUEUED, runtime=runtime)
+            print('Master: requeued %s (attempt %d failed)' % (brick, b['attempts']))
+        else:
+            self.state.set(brick, FAILED, runtime=runtime)
+            print('Master: giving up on %s after %d attempts' % (brick, b['attempts']))
+
+    def run(self):
+        queue = self.order_queue()
+        print('Master: %s' % self.state.summary())
+        while queue or self.running:
+            if self.master.num_slaves() == 0:
+                print('Master: no slaves left alive')
+                break
+
+            for slave in self.master.get_ready_slaves():
+                if not queue:
+                    break
+                brick = queue.pop(0)
+                self.master.run(slave, (brick, self.state.bricks[brick]['attempts']))
+                self.running[slave] = brick
+                self.state.set(brick, RUNNING)
+
+            requeue = False
+            for slave in self.master.get_completed_slaves():
+                ok, message, runtime = self.master.get_data(slave)
+                brick = self.running.pop(slave)
+                if ok:
+                    self.state.set(brick, DONE, runtime=runtime)
+                    print('Master: %s done in %.0f s' % (brick, runtime))
+                else:
+                    print('Master: %s failed: %s' % (brick, message))
+                    self.failed(brick, runtime=runtime)
+                    requeue = True
+
+            for slave in self.master.get_dead_slaves(self.heartbeat_timeout):
+                brick = self.running.pop(slave)
+                self.master.remove_dead_slave(slave)
+                # the slave may only be slow: it is sent EXIT at shutdown and
+                # its late result, if any, is ignored
+                print('Master: slave %d stopped sending heartbeats while running %s' % (slave, brick))
+                self.failed(brick)
+                requeue = True
+
+            if requeue:
+                queue = self.order_queue()
+            self.state.save()
+            # until a slave sends something, wake up to check heartbeats
+            self.master.wait(timeout=self.poll)
+
+        self.state.save(force=True)
+        print('Master: %s' % self.state.summary())
@@ -1,21 +1,36 @@
 from mpi4py import MPI
 from mpi_master_slave import Master, Slave
 from mpi_master_slave import WorkQueue
+from mpi_master_slave import SubMaster, split_by_node, batches
 import time
 import numpy as np
 import sys
 import os
+from brick_scheduler import BrickState, BrickScheduler, read_brick_sizes
 name = sys.argv[1]
+# 'queue': run UnfinishedBricks.txt once, 'scheduler': see brick_scheduler.py,
+# 'hierarchical': like 'queue' but through one SubMaster per node
+mode = sys.argv[2] if len(sys.argv) > 2 else 'queue'
+assert(mode in ['queue','scheduler','hierarchical'])
 BRICKSTAT_DIR=os.environ['obiwan_code']+'/brickstat/%s/'%name
+STATE_FN=os.environ['obiwan_out']+'/scheduler_state_rs%s.json'%os.environ.get('rowstart','0')
+HEARTBEAT_INTERVAL=60.
+# bricks a SubMaster pulls from the global Master at once, per local slave
+BATCH_PER_SLAVE=2
+# 'subprocess': one slurm_brick_scheduler.sh per brick, 'inprocess': see InProcessSlave
+SLAVE_MODE=os.environ.get('slave_mode','subprocess')
+assert(SLAVE_MODE in ['subprocess','inprocess'])
 class MyApp(object):
     """
     This is my application that has a lot of work to do so it gives work to do
     to its slaves until all the work is done
     """
 
-    def __init__(self, slaves):
+    def __init__(self, slaves, comm=None, batch_size=None):
         # when creating the Master we tell it what slaves it can handle
-        self.master = Master(slaves)
+        self.master = Master(slaves, comm=comm)
+        # if set, slaves are SubMasters and get batches of tasks
+        self.batch_size = batch_size
         # WorkQueue is a convenient class that run slaves on a tasks queue
         self.work_queue = WorkQueue(self.master)
 
@@ -34,12 +49,15 @@ class MyApp(object):
         # let's prepare our work queue. This can be built at initialization time
         # but it can also be added later as more work become available
         #
-        task_list = np.loadtxt(BRICKSTAT_DIR + 'UnfinishedBricks.txt', dtype=np.str)
+        task_list = np.loadtxt(BRICKSTAT_DIR + 'UnfinishedBricks.txt', dtype=str)
         if tasks is None:
            tasks = len(task_list)
-        for i in range(tasks):
+        task_data = [(task_list[i], i) for i in range(tasks)]
+        if self.batch_size is not None:
+            task_data = batches(task_data, self.batch_size)
+        for data in task_data:
             # 'data' will be passed to the slave and can be anything
-            self.work_queue.add_work(data=(task_list[i], i))
+            self.work_queue.add_work(data=data)
        
         #
         # Keeep starting slaves as long as there is work to do
@@ -55,12 +73,14 @@ class MyApp(object):
             # reclaim returned data from completed slaves
             #
             for slave_return_data in self.work_queue.get_completed_work():
-                done, message = slave_return_data
-                if done:
-                    print('Master: slave finished is task and says "%s"' % message)
+                if self.batch_size is None:
+                    slave_return_data = [slave_return_data]
+                for done, message, runtime in slave_return_data:
+                    if done:
+                        print('Master: slave finished is task and says "%s"' % message)
 
-            # sleep some time
-            time.sleep(0.3)
+            # wait for a slave to become ready or complete its task
+            self.work_queue.wait()
 
 
 class MySlave(Slave):
@@ -69,19 +89,152 @@ class MySlave(Slave):
     and calls 'Slave.run'. The Master will do the rest
     """
 
-    def __init__(self):
-        super(MySlave, self).__init__()
+    def __init__(self, heartbeat_interval=None, comm=None):
+        super(MySlave, self).__init__(comm=comm)
+        self.heartbeat_interval = heartbeat_interval
 
     def do_work(self, data):
         import subprocess
         rank = MPI.COMM_WORLD.Get_rank()
         name = MPI.Get_processor_name()
         task, task_arg = data
-        subprocess.call(["./slurm_brick_scheduler.sh",task])
+        t0 = time.time()
+        proc = subprocess.Popen(["./slurm_brick_scheduler.sh",task])
+        if self.heartbeat_interval is None:
+            proc.wait()
+        else:
+            while True:
+                try:
+                    proc.wait(timeout=self.heartbeat_interval)
+                    break
+                except subprocess.TimeoutExpired:
+                    self.heartbeat()
+        runtime = time.time() - t0
         print(task)
         sys.stdout.flush()
         print('  Slave %s rank %d executing "%s" task_id "%d"' % (name, rank, task, task_arg) )
-        return (True, 'I completed my task (%d)' % task_arg)
+        if proc.returncode != 0:
+            return (False, 'task %s exited with %d' % (task, proc.returncode), runtime)
+        return (True, 'I completed my task (%d)' % task_arg, runtime)
+
+
+def share_ccds(node_comm):
+    """kenobi.share_survey_ccds() for the dataset of slurm_brick_scheduler.sh"""
+    import kenobi
+    return kenobi.share_survey_ccds(node_comm, dataset=os.environ.get('dataset', 'dr8'))
+
+
+class InProcessSlave(MySlave):
+    """
+    Runs kenobi.main() for each brick inside the slave process, with the
+    arguments and log file of slurm_brick_scheduler.sh, so legacypipe, tractor
+    and galsim are imported once and the survey CCD tables and kd-trees stay
+    loaded from one brick to the next (see kenobi.keep_survey_tables_warm).
+    With node_comm, the CCD table is read once per node and shared by its
+    ranks (see kenobi.share_survey_ccds, collective on node_comm)
+
+    Bricks run with --threads 1 whatever $threads is: a multiprocessing pool
+    would fork this MPI rank, which most MPI libraries do not support, while
+    the heartbeat thread runs. Start one rank per core instead
+
+    Heartbeats are sent from a second thread while the brick runs, which
+    needs MPI_THREAD_MULTIPLE (mpi4py's default request)
+    """
+
+    def __init__(self, heartbeat_interval=None, comm=None, node_comm=None):
+        super(InProcessSlave, self).__init__(heartbeat_interval=heartbeat_interval, comm=comm)
+        if heartbeat_interval is not None:
+            assert MPI.Query_thread() == MPI.THREAD_MULTIPLE, \
+                'in-process heartbeats need MPI_THREAD_MULTIPLE'
+        import kenobi
+        self.kenobi = kenobi
+        self.kenobi.keep_survey_tables_warm()
+        if node_comm is not None:
+            self.ccds_win = share_ccds(node_comm)
+
+    @staticmethod
+    def rsdir():
+        rsdir = 'rs%s' % os.environ['rowstart']
+        if os.environ['do_more'] != 'no':
+            rsdir = 'more_' + rsdir
+        if os.environ['do_skipids'] != 'no':
+            rsdir = rsdir.replace('rs', 'skip_rs', 1)
+        return rsdir
+
+    def brick_argv(self, brick):
+        env = os.environ
+        outdir = env['obiwan_out'] + '/output'
+        if env.get('RANDOMS_STORAGE') == 'packed':
+            randoms_from_fits = env['obiwan_out'] + '/divided_randoms/packed_randoms.index.fits'
+        else:
+            randoms_from_fits = env['obiwan_out'] + '/divided_randoms/brick_%s.fits' % brick
+        pickle = '%s/pickles/%s/%s/runbrick-%%(brick)s-%%%%(stage)s.pickle' % (
+            outdir, brick[:3], self.rsdir())
+        return ['--dataset', env.get('dataset', 'dr8'), '-b', brick,
+                '--nobj', env['nobj'], '--rowstart', env['rowstart'], '-o', env['object'],
+                '--randoms_db', env['randoms_db'], '--outdir', outdir, '--add_sim_noise',
+                '--threads', '1',
+                '--do_skipids', env['do_skipids'],
+                '--do_more', env['do_more'], '--minid', env['minid'],
+                '--randoms_from_fits', randoms_from_fits,
+                '--pickle', pickle]
+
+    def run_brick(self, brick):
+        """kenobi.main() on brick with stdout/err appended to its log"""
+        log = '%s/output/logs/%s/%s/log.%s' % (os.environ['obiwan_out'], brick[:3],
+                                               self.rsdir(), brick)
+        if not os.path.exists(os.path.dirname(log)):
+            os.makedirs(os.path.dirname(log))
+        args = self.kenobi.get_parser().parse_args(args=self.brick_argv(brick))
+        sys.stdout.flush()
+        sys.stderr.flush()
+        saved = os.dup(1), os.dup(2)
+        fd = os.open(log, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        os.dup2(fd, 1)
+        os.dup2(fd, 2)
+        os.close(fd)
+        try:
+            self.kenobi.main(args=args)
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+            os.close(saved[0])
+            os.close(saved[1])
+
+    def do_work(self, data):
+        import threading
+        import traceback
+        rank = MPI.COMM_WORLD.Get_rank()
+        name = MPI.Get_processor_name()
+        task, task_arg = data
+        print('  Slave %s rank %d executing "%s" task_id "%d" in-process' % (name, rank, task, task_arg) )
+        sys.stdout.flush()
+        # the brick runs in this thread, heartbeats come from another one
+        stop = threading.Event()
+        beater = None
+        if self.heartbeat_interval is not None:
+            def beat():
+                while not stop.wait(self.heartbeat_interval):
+                    self.heartbeat()
+            beater = threading.Thread(target=beat)
+            beater.daemon = True
+            beater.start()
+        t0 = time.time()
+        try:
+            self.run_brick(task)
+            ok, message = True, 'I completed my task (%d)' % task_arg
+        except BaseException as e:
+            traceback.print_exc()
+            ok, message = False, 'task %s raised %s' % (task, repr(e))
+        finally:
+            # no heartbeat may still be in flight when run() sends DONE
+            stop.set()
+            if beater is not None:
+                beater.join()
+        runtime = time.time() - t0
+        return (ok, message, runtime)
 
 
 def main():
@@ -91,16 +244,55 @@ def main():
     size = MPI.COMM_WORLD.Get_size()
 
     print('I am  %s rank %d (total %d)' % (name, rank, size) )
+    SlaveClass = InProcessSlave if SLAVE_MODE == 'inprocess' else MySlave
 
-    if rank == 0: # Master
+    if mode == 'hierarchical':
+
+        node_comm, leader_comm = split_by_node()
+        if rank == 0: # global Master, its slaves are the SubMasters
+            nsub = leader_comm.Get_size() - 1
+            # slaves per SubMaster
+            nlocal = max((size - 1) // max(nsub, 1) - 1, 1)
+            app = MyApp(slaves=range(1, nsub + 1), comm=leader_comm,
+                        batch_size=BATCH_PER_SLAVE * nlocal)
+            app.run()
+            app.terminate_slaves()
+        elif leader_comm != MPI.COMM_NULL: # one per node
+            sub = SubMaster(node_comm, leader_comm)
+            if SLAVE_MODE == 'inprocess':
+                # reads the CCD table for the slaves of the node
+                sub.ccds_win = share_ccds(node_comm)
+            sub.run()
+        elif SLAVE_MODE == 'inprocess': # Any slave, its master is the node SubMaster
+            InProcessSlave(comm=node_comm, node_comm=node_comm).run()
+        else:
+            SlaveClass(comm=node_comm).run()
+
+    elif rank == 0 and mode == 'scheduler': # Master
+
+        master = Master(range(1, size))
+        bricks = None
+        if not os.path.exists(STATE_FN):
+            bricks = list(np.loadtxt(BRICKSTAT_DIR + 'UnfinishedBricks.txt', dtype=str, ndmin=1))
+        state = BrickState(STATE_FN, bricks=bricks)
+        sizes = read_brick_sizes(os.environ['obiwan_out']+'/divided_randoms/brick_list.out')
+        BrickScheduler(master, state, brick_sizes=sizes,
+                       heartbeat_timeout=10*HEARTBEAT_INTERVAL).run()
+        master.terminate_slaves()
+
+    elif rank == 0: # Master
 
         app = MyApp(slaves=range(1, size))
         app.run()
         app.terminate_slaves()
 
+    elif mode == 'scheduler': # Any slave
+
+        SlaveClass(heartbeat_interval=HEARTBEAT_INTERVAL).run()
+
     else: # Any slave
 
-        MySlave().run()
+        SlaveClass().run()
 
     print('Task completed (rank %d)' % (rank) )
 
@@ -1,5 +1,11 @@
 #!/bin/bash -l
 #source /srv/py3_venv/bin/activate
 export PYTHONPATH=/global/cscratch1/sd/huikong/Obiwan/dr8/obiwan_code:$PYTHONPATH
+if [ x$slave_mode == xinprocess ]; then
+# slaves import kenobi themselves instead of running slurm_brick_scheduler.sh;
+# each brick then runs single-threaded, so start one MPI rank per core
+source ./obiwan_env.sh
+export PYTHONPATH=$obiwan_code/py:$obiwan_code/legacypipe/py:${UNWISE_PSF_DIR}/py:$PYTHONPATH
+fi
 
-python ./example1.py $name_for_run
+python ./example1.py $name_for_run $scheduler_mode
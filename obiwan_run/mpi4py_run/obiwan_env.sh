@@ -0,0 +1,24 @@
+#!/bin/bash
+# survey data locations, sourced by slurm_brick_scheduler.sh and, for
+# slave_mode=inprocess, by example1.sh
+export LEGACY_SURVEY_DIR=$obiwan_data
+
+# Burst-buffer!
+if [ x$DW_PERSISTENT_STRIPED_DR8 == x ]; then
+BB=${LEGACY_SURVEY_DIR}/
+else
+BB=$DW_PERSISTENT_STRIPED_DR8
+fi
+
+#star catalogs
+#catdir=/global/cscratch1/sd/landriau/dr8/alldata
+export DUST_DIR=/global/project/projectdirs/cosmo/data/dust/v0_0/  #${catdir}/dust_v0.1
+export UNWISE_COADDS_DIR=/global/project/projectdirs/cosmo/work/wise/outputs/merge/neo5/fulldepth:/global/project/projectdirs/cosmo/data/unwise/allwise/unwise-coadds/fulldepth #/global/project/projectdirs/cosmo/work/wise/outputs/merge/neo4/fulldepth    #${catdir}/unwise_coadds_4:${catdir}/unwise_coadds_1
+export UNWISE_COADDS_TIMERESOLVED_DIR=/global/projecta/projectdirs/cosmo/work/wise/outputs/merge/neo4     #${catdir}/unwise_timeresolved_coadds
+export GAIA_CAT_DIR=/global/project/projectdirs/cosmo/work/gaia/chunks-gaia-dr2-astrom-2   #${catdir}/chunks-gaia-dr2-astrom-2
+export GAIA_CAT_VER=2
+export TYCHO2_KD_DIR=/global/project/projectdirs/cosmo/staging/tycho2    #${catdir}/tycho2
+export LARGEGALAXIES_DIR=/global/project/projectdirs/cosmo/staging/largegalaxies/v2.0
+UNWISE_PSF_DIR=/src/unwise_psf
+export WISE_PSF_DIR=${UNWISE_PSF_DIR}/etc
+export PS1CAT_DIR=/global/project/projectdirs/cosmo/work/ps1/cats/chunks-qz-star-v3    #${catdir}/ps1cat
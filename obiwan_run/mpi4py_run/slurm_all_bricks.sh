@@ -24,6 +24,11 @@ export do_more=no
 export minid=1
 export object=elg
 export nobj=200
+#queue: run UnfinishedBricks.txt once; scheduler: retries, heartbeats, resumes from $obiwan_out/scheduler_state_rs$rowstart.json
+#hierarchical: like queue, with one sub-master per node handing bricks to the ranks of its node
+export scheduler_mode=queue
+#subprocess: one slurm_brick_scheduler.sh per brick; inprocess: slaves run kenobi themselves, keeping the survey tables loaded
+export slave_mode=subprocess
 
 export usecores=32
 export threads=$usecores
@@ -1,27 +1,12 @@
 #!/bin/bash
 echo entering scheduler...
-export LEGACY_SURVEY_DIR=$obiwan_data
-RANDOMS_FROM_FITS=$obiwan_out/divided_randoms/brick_${1}.fits
-
-# Burst-buffer!
-if [ x$DW_PERSISTENT_STRIPED_DR8 == x ]; then
-BB=${LEGACY_SURVEY_DIR}/
+if [ x$RANDOMS_STORAGE == xpacked ]; then
+RANDOMS_FROM_FITS=$obiwan_out/divided_randoms/packed_randoms.index.fits
 else
-BB=$DW_PERSISTENT_STRIPED_DR8
+RANDOMS_FROM_FITS=$obiwan_out/divided_randoms/brick_${1}.fits
 fi
 
-#star catalogs
-#catdir=/global/cscratch1/sd/landriau/dr8/alldata
-export DUST_DIR=/global/project/projectdirs/cosmo/data/dust/v0_0/  #${catdir}/dust_v0.1
-export UNWISE_COADDS_DIR=/global/project/projectdirs/cosmo/work/wise/outputs/merge/neo5/fulldepth:/global/project/projectdirs/cosmo/data/unwise/allwise/unwise-coadds/fulldepth #/global/project/projectdirs/cosmo/work/wise/outputs/merge/neo4/fulldepth    #${catdir}/unwise_coadds_4:${catdir}/unwise_coadds_1
-export UNWISE_COADDS_TIMERESOLVED_DIR=/global/projecta/projectdirs/cosmo/work/wise/outputs/merge/neo4     #${catdir}/unwise_timeresolved_coadds
-export GAIA_CAT_DIR=/global/project/projectdirs/cosmo/work/gaia/chunks-gaia-dr2-astrom-2   #${catdir}/chunks-gaia-dr2-astrom-2
-export GAIA_CAT_VER=2
-export TYCHO2_KD_DIR=/global/project/projectdirs/cosmo/staging/tycho2    #${catdir}/tycho2
-export LARGEGALAXIES_DIR=/global/project/projectdirs/cosmo/staging/largegalaxies/v2.0
-UNWISE_PSF_DIR=/src/unwise_psf
-export WISE_PSF_DIR=${UNWISE_PSF_DIR}/etc
-export PS1CAT_DIR=/global/project/projectdirs/cosmo/work/ps1/cats/chunks-qz-star-v3    #${catdir}/ps1cat
+source $(dirname $0)/obiwan_env.sh
 
 #PYTHONPATH
 export PYTHONPATH=$obiwan_code/py:$obiwan_code/legacypipe/py:/usr/local/lib/python:/usr/local/lib/python3.6/dist-packages:.:${UNWISE_PSF_DIR}/py
@@ -24,6 +24,7 @@ import matplotlib.pyplot as plt
 from pkg_resources import resource_filename
 from pickle import dump
 from glob import glob
+from collections import OrderedDict
 import csv
 
 from astropy.table import Table, Column, vstack
@@ -55,6 +56,7 @@ from tractor.psfex import PsfEx, PsfExModel
 from tractor.basics import GaussianMixtureEllipsePSF, RaDecPos
 from tractor.sfd import SFDMap
 from tractor.galaxy import DevGalaxy, ExpGalaxy
+from tractor.patch import ModelMask
 from legacypipe.survey import LegacyEllipseWithPriors
 import tractor
 from tractor import *
@@ -145,6 +147,8 @@ class SimDecals(LegacySurveyData):
         image_eq_model: referred to as 'testA'
             wherever add a simulated source, replace both image and invvar of the image
             with that of the simulated source only
+        stamp_cache: StampCache of unit-flux stamps, None to render every source
+        tim_cache: TimCache of the tims before injection, None to always read them
 
     Attributes:
         DR: see above
@@ -161,7 +165,7 @@ class SimDecals(LegacySurveyData):
 
     def __init__(self, dataset=None, survey_dir=None, metacat=None, simcat=None,
                  output_dir=None,add_sim_noise=False, seed=0,
-                 image_eq_model=False,**kwargs):
+                 image_eq_model=False,stamp_cache=None,tim_cache=None,**kwargs):
         self.dataset= dataset
         #import pdb;pdb.set_trace()
         kw= dict(survey_dir=survey_dir,
@@ -176,8 +180,16 @@ class SimDecals(LegacySurveyData):
         self.add_sim_noise= add_sim_noise
         self.seed= seed
         self.image_eq_model= image_eq_model
+        self.stamp_cache= stamp_cache
+        self.tim_cache= tim_cache
         print('SimDecals: self.image_eq_model=',self.image_eq_model)
 
+    def drop_cache(self):
+        # runbrick drops the tables before multiprocessing, keep them for the
+        # next brick when running in-process
+        remember_survey(self)
+        super(SimDecals, self).drop_cache()
+
     def get_image_object(self, t):
         if self.dataset == 'cosmos':
             return SimImageCosmos(self, t)
@@ -202,24 +214,16 @@ class SimDecals(LegacySurveyData):
         return []
 
 def get_srcimg_invvar(stamp_ivar,img_ivar):
-    """stamp_ivar, img_ivar -- galsim Image objects"""
+    """stamp_ivar, img_ivar -- numpy arrays of the same shape"""
     # Use img_ivar when stamp_ivar == 0, both otherwise
-    use_img_ivar= np.ones(img_ivar.array.shape).astype(bool)
-    use_img_ivar[ stamp_ivar.array > 0 ] = False
+    use_img_ivar= stamp_ivar <= 0
     # First compute using both
-    ivar= np.power(stamp_ivar.array.copy(), -1) + np.power(img_ivar.array.copy(), -1)
-    ivar= np.power(ivar,-1)
-    keep= np.ones(ivar.shape).astype(bool)
-    keep[ (stamp_ivar.array > 0)*\
-          (img_ivar.array > 0) ] = False
-    ivar[keep] = 0.
+    ivar= np.zeros(img_ivar.shape, np.float32)
+    both= (stamp_ivar > 0)*(img_ivar > 0)
+    ivar[both]= 1./(1./stamp_ivar[both] + 1./img_ivar[both])
     # Now use img_ivar only where need to
-    ivar[ use_img_ivar ] = img_ivar.array.copy()[ use_img_ivar ]
-    # return
-    obj_ivar = stamp_ivar.copy()
-    obj_ivar.fill(0.)
-    obj_ivar+= ivar
-    return obj_ivar
+    ivar[use_img_ivar]= img_ivar[use_img_ivar]
+    return ivar
 
 def saturation_e(camera):
     # Saturation limit
@@ -301,10 +305,23 @@ class SimImage(DecamImage):
                                   .replace('_ooi_','_oow_'))
         self.dqfn= self.wtfn.replace('_oow_','_ood_')
 
+    def get_pristine_tim(self, **kwargs):
+        """legacypipe's tim, from the survey's TimCache if it has one"""
+        cache = self.survey.tim_cache
+        if cache is not None:
+            cached, tim = cache.get(self, kwargs)
+            if cached:
+                print('TimCache: read %s from cache' % self.name)
+                return tim
+        tim = super(SimImage, self).get_tractor_image(**kwargs)
+        if cache is not None:
+            cache.put(self, kwargs, tim)
+        return tim
+
     def get_tractor_image(self, **kwargs):
         #t0 = time_builtin.clock()
         #import pdb;pdb.set_trace()
-        tim = super(SimImage, self).get_tractor_image(**kwargs)
+        tim = self.get_pristine_tim(**kwargs)
         #print('get_tractor_image:time'+str(time_builtin.clock()-t0))
         if tim is None: # this can be None when the edge of a CCD overlaps
             return tim
@@ -314,93 +331,38 @@ class SimImage(DecamImage):
         #    seed = self.survey.metacat['SEED']
         #else:
         #    seed = None
-        t1=time_builtin.clock()
+        t0= Time()
         objtype = self.survey.metacat.get('objtype')[0]
         objstamp = BuildStamp(tim, seed=self.survey.seed,
                               camera=self.t.camera,
-                              gain=tim.gain,exptime=self.t.exptime)
+                              gain=tim.gain,exptime=self.t.exptime,
+                              stamp_cache=self.survey.stamp_cache)
+        # Render every source in one pass onto a single model image,
         # ids make it onto a ccd (geometry cut)
-        tim.ids_added=[]
-
-        # Grab the data and inverse variance images [nanomaggies!]
-        tim_image = galsim.Image(tim.getImage())
-        tim_invvar = galsim.Image(tim.getInvvar())
-        tim_dq = galsim.Image(tim.dq)
-        # Also store galaxy sims and sims invvar
-        sims_image = tim_image.copy()
-        sims_image.fill(0.0)
-        sims_ivar = sims_image.copy()
-
-        # Store simulated galaxy images in tim object
-        # Loop on each object.
-        #f = open(self.stamp_stat_fn,'a')
-        for ii, obj in enumerate(self.survey.simcat):
-            # Print timing
-            t0= Time()
-            if objtype in ['lrg','elg']:
-                obj.n = int(obj.n)
-                strin= 'Drawing 1 %s: n=%.2f, rhalf=%.2f, e1=%.2f, e2=%.2f' % \
-                        (objtype.upper(), obj.n,obj.rhalf,obj.e1,obj.e2)
-                print(strin)
-
-            if objtype == 'star':
-                stamp = objstamp.star(obj)
-            elif objtype == 'elg':
-                stamp = objstamp.elg(obj)
-            elif objtype == 'lrg':
-                stamp = objstamp.lrg(obj)
-            elif objtype == 'qso':
-                stamp = objstamp.qso(obj)
-            t0= ptime('Finished Drawing %s: id=%d band=%s dbflux=%f addedflux=%f' %
-                (objtype.upper(), obj.id,objstamp.band,
-                 obj.get(objstamp.band+'flux'),stamp.array.sum()), t0)
-            stamp_nonoise= stamp.copy()
-            if self.survey.add_sim_noise:
-                stamp += noise_for_galaxy(stamp,objstamp.nano2e)
-            ivarstamp= ivar_for_galaxy(stamp,objstamp.nano2e)
-            # Add source if EVEN 1 pix falls on the CCD
-            overlap = stamp.bounds & tim_image.bounds
-            if overlap.area() > 0:
-                print('Stamp overlaps tim: id=%d band=%s' % (obj.id,objstamp.band))
-                tim.ids_added.append(obj.id)
-                stamp = stamp[overlap]
-                ivarstamp = ivarstamp[overlap]
-                stamp_nonoise= stamp_nonoise[overlap]
-
-                # Zero out invvar where bad pixel mask is flagged (> 0)
-                keep = np.ones(tim_dq[overlap].array.shape)
-                keep[ tim_dq[overlap].array > 0 ] = 0.
-                ivarstamp *= keep
-                # Add stamp to image
-                #import pdb;pdb.set_trace()
-                #f.write(str(tim_image[overlap].array.sum()/np.ones_like(tim_image[overlap].array).sum())+'\n')
-                back= tim_image[overlap].copy()
-                tim_image[overlap] += stamp #= back.copy() + stamp.copy()
-                # Add variances
-                back_ivar= tim_invvar[overlap].copy()
-                tot_ivar= get_srcimg_invvar(ivarstamp, back_ivar)
-                tim_invvar[overlap] = tot_ivar.copy()
-
-                #Extra
-                sims_image[overlap] += stamp.copy()
-                sims_ivar[overlap] += ivarstamp.copy()
-
-                if np.min(sims_ivar.array) < 0:
-                    log.warning('Negative invvar!')
-                    import pdb ; pdb.set_trace()
-        #f.close()
-        tim.sims_image = sims_image.array
-        tim.sims_inverr = np.sqrt(sims_ivar.array)
+        sims_image, tim.ids_added = objstamp.draw_batch(self.survey.simcat,
+                                                         objtype=objtype)
+        t0= ptime('Drew %d %s on %s band=%s addedflux=%f' %
+                  (len(tim.ids_added), objtype.upper(), tim.name,
+                   objstamp.band, sims_image.sum()), t0)
+        if self.survey.add_sim_noise:
+            sims_image += noise_for_galaxy(sims_image,objstamp.nano2e)
+        sims_ivar= ivar_for_galaxy(sims_image,objstamp.nano2e)
+        # Zero out invvar where bad pixel mask is flagged (> 0)
+        sims_ivar[tim.dq > 0] = 0.
+        # Add stamps to image and variances, once for the whole CCD
+        tim_invvar= get_srcimg_invvar(sims_ivar, tim.getInvvar())
+
+        tim.sims_image = sims_image
+        tim.sims_inverr = np.sqrt(sims_ivar)
         # Can set image=model, ivar=1/model for testing
         if self.survey.image_eq_model:
-            tim.data = sims_image.array.copy()
+            tim.data = sims_image.copy()
             tim.inverr = np.zeros(tim.data.shape)
-            tim.inverr[sims_image.array > 0.] = np.sqrt(1./sims_image.array.copy()[sims_image.array > 0.])
+            tim.inverr[sims_image > 0.] = np.sqrt(1./sims_image[sims_image > 0.])
         else:
-            tim.data = tim_image.array
-            tim.inverr = np.sqrt(tim_invvar.array)
+            tim.data = tim.getImage() + sims_image
+            tim.inverr = np.sqrt(tim_invvar)
         sys.stdout.flush()
-        #print('get_tractor_image in obiwan :time '+str(time_builtin.clock()-t1))
         return tim
 # except NameError:
 #     pass
@@ -423,13 +385,12 @@ class SimImageCosmos(SimImage,DecamImagePlusNoise):
 def noise_for_galaxy(gal,nano2e):
     """Returns numpy array of noise in Img count units for gal in image cnt units"""
     # Noise model + no negative image vals when compute noise
-    one_std_per_pix= gal.array.copy() # nanomaggies
+    one_std_per_pix= gal.copy() # nanomaggies
     one_std_per_pix[one_std_per_pix < 0]=0
     # rescale
     one_std_per_pix *= nano2e # e-
     one_std_per_pix= np.sqrt(one_std_per_pix)
-    num_stds= np.random.randn(one_std_per_pix.shape[0],one_std_per_pix.shape[1])
-    #one_std_per_pix.shape, num_stds.shape
+    num_stds= np.random.randn(*one_std_per_pix.shape)
     noise= one_std_per_pix * num_stds
     # rescale
     noise /= nano2e #nanomaggies
@@ -439,20 +400,359 @@ def ivar_for_galaxy(gal,nano2e):
     """Adds gaussian noise to perfect source
 
     Args:
-        gal: galsim.Image() for source, UNITS: nanomags
+        gal: numpy array for source, UNITS: nanomags
         nano2e: factor to convert to e- (gal * nano2e has units e-)
 
     Returns:
-        galsim.Image() of invvar for the source, UNITS: nanomags
+        numpy array of invvar for the source, UNITS: nanomags,
+            zero wherever the source is zero
     """
-    var= gal.copy() * nano2e #e^2
-    var.applyNonlinearity(np.abs)
-    var /= nano2e**2 #nanomag^2
-    var.invertSelf()
-    return var
+    var= np.abs(gal) / nano2e #nanomag^2
+    ivar= np.zeros(gal.shape, np.float32)
+    ivar[var > 0]= 1./var[var > 0]
+    return ivar
+
+
+
+
+def simcat_on_ccd(simcat,wcs,shape,stamp_size=64):
+    """Rows of simcat whose stamp_size x stamp_size footprint overlaps a CCD
+
+    One vectorized radec2pixelxy over the whole catalog, done once per CCD
+    so that sources off the CCD are never rendered.
+
+    Args:
+        simcat: fits_table with ra, dec
+        wcs: the CCD's (sub)wcs, e.g. tim.subwcs
+        shape: (h,w) of the CCD image
+
+    Returns:
+        tuple: indices into simcat, x, y 0-indexed pixel positions of those rows
+    """
+    (h,w) = shape
+    if len(simcat) == 0:
+        return np.array([], int), np.array([]), np.array([])
+    ok,xx,yy = wcs.radec2pixelxy(simcat.get('ra'), simcat.get('dec'))
+    # FITS (1-indexed) -> pixel (0-indexed)
+    xx = np.atleast_1d(xx) - 1.
+    yy = np.atleast_1d(yy) - 1.
+    x0 = np.round(xx).astype(int) - stamp_size//2
+    y0 = np.round(yy).astype(int) - stamp_size//2
+    I = np.flatnonzero(np.atleast_1d(ok) *
+                       (x0 + stamp_size > 0) * (x0 < w) *
+                       (y0 + stamp_size > 0) * (y0 < h))
+    return I, xx[I], yy[I]
+
+class StampCache(object):
+    """LRU cache of unit-flux, PSF-convolved postage stamps
+
+    Keyed on quantized morphology (n, rhalf, e1, e2), band, the pixels of
+    the local constant PSF and the local CD matrix, see
+    BuildStamp.unit_stamp(). Nothing in the key names the CCD, so a stamp
+    is reused by any CCD, PSF region or rs-chunk whose PSF and pixel grid
+    match to the quanta. It lives at module level: one per process, one
+    per pool worker. hits, misses count lookups, to tune the quantization
+    (see stats()).
+
+    Args:
+        maxsize: max number of stamps kept
+        rhalf_quantum: rhalf [arcsec] is rounded to a multiple of this
+        e_quantum: e1,e2 are rounded to a multiple of this
+        psf_quantum: PSF pixels, in units of the PSF peak, are rounded to a
+            multiple of this before hashing, 0 for exact pixels
+        cd_quantum: local CD matrix elements [arcsec/pixel] are rounded to
+            a multiple of this
+    """
+
+    def __init__(self, maxsize=5000, rhalf_quantum=0.01, e_quantum=0.01,
+                 psf_quantum=1e-3, cd_quantum=1e-3):
+        self.maxsize = maxsize
+        self.rhalf_quantum = rhalf_quantum
+        self.e_quantum = e_quantum
+        self.psf_quantum = psf_quantum
+        self.cd_quantum = cd_quantum
+        self.stamps = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def quantize(val, quantum):
+        return float(np.round(val / quantum) * quantum)
+
+    def psf_key(self, psf):
+        """hash of the pixels of a constant PSF (plus the Gaussian part of a
+        hybrid PSF), rounded to psf_quantum"""
+        import hashlib
+        pix = getattr(psf, 'pix', psf)
+        img = getattr(pix, 'img', None)
+        h = hashlib.sha1(type(psf).__name__.encode())
+        if img is None:
+            h.update(np.array(psf.getParams(), np.float64).tobytes())
+        else:
+            img = np.asarray(img, np.float64)
+            if self.psf_quantum > 0:
+                img = np.round(img / (img.max() * self.psf_quantum))
+            h.update(img.tobytes())
+        gauss = getattr(psf, 'gauss', None)
+        if gauss is not None:
+            h.update(np.array(gauss.getParams(), np.float64).tobytes())
+        return h.hexdigest()
+
+    def cd_key(self, cd):
+        """CD matrix [deg/pixel] rounded to cd_quantum [arcsec/pixel]"""
+        return tuple(self.quantize(v * 3600., self.cd_quantum)
+                     for v in np.ravel(cd))
+
+    def get(self, key):
+        stamp = self.stamps.pop(key, None)
+        if stamp is None:
+            self.misses += 1
+            return None
+        # most recently used goes last
+        self.stamps[key] = stamp
+        self.hits += 1
+        return stamp
+
+    def put(self, key, stamp):
+        self.stamps[key] = stamp
+        while len(self.stamps) > self.maxsize:
+            self.stamps.popitem(last=False)
+
+    def stats(self):
+        n = self.hits + self.misses
+        return 'stamp cache: %d hits, %d misses (%.1f%% hit rate), %d stamps' % \
+            (self.hits, self.misses, 100.*self.hits/max(n,1), len(self.stamps))
+
+_stamp_cache = None
+
+def get_stamp_cache(maxsize=5000, rhalf_quantum=0.01, e_quantum=0.01,
+                    psf_quantum=1e-3, cd_quantum=1e-3):
+    """Process-wide StampCache, (re)created only if its settings changed"""
+    global _stamp_cache
+    if maxsize <= 0:
+        return None
+    c = _stamp_cache
+    if (c is None or c.maxsize != maxsize or c.rhalf_quantum != rhalf_quantum
+        or c.e_quantum != e_quantum or c.psf_quantum != psf_quantum
+        or c.cd_quantum != cd_quantum):
+        _stamp_cache = StampCache(maxsize=maxsize, rhalf_quantum=rhalf_quantum,
+                                  e_quantum=e_quantum, psf_quantum=psf_quantum,
+                                  cd_quantum=cd_quantum)
+    return _stamp_cache
+
+# input and calibration files whose (size, mtime) go into the TimCache key
+TIM_CACHE_FILES = ['imgfn', 'wtfn', 'dqfn', 'psffn', 'merged_psffn',
+                   'splineskyfn', 'merged_splineskyfn']
+
+class TimCache(object):
+    """On-disk cache of the tims of a brick before sources are injected
+
+    Every rs-chunk of a brick reads the same CCDs with the same options, so the
+    first one pickles the tim legacypipe returns and the next ones load it
+    instead of re-reading the pixels, PSF and sky and remapping the invvar.
+    Entries are keyed on the CCD, the get_tractor_image() options (which
+    include the brick footprint) and the size and mtime of the image and
+    calibration files, so a new calibration makes a new entry (and drops the
+    CCD's old ones).
+
+    The whole cache (all the bricks under root) holds at most max_bytes: after
+    each write the least recently used entries are deleted.
 
+    Args:
+        cache_dir: one directory per brick, e.g. on /dev/shm for a node-local cache
+        max_bytes: size bound of the files under root, None for no bound
+        root: directory holding the caches of all bricks, default cache_dir
+    """
 
+    def __init__(self, cache_dir, max_bytes=None, root=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.root = root if root is not None else cache_dir
+        if not os.path.exists(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                # made by another worker in the meantime
+                pass
+
+    def key(self, imobj, kwargs):
+        import hashlib
+        files = []
+        for attr in TIM_CACHE_FILES:
+            fn = getattr(imobj, attr, None)
+            if fn is not None and os.path.exists(fn):
+                st = os.stat(fn)
+                files.append((fn, st.st_size, int(st.st_mtime)))
+        opts = [(k, np.asarray(v).tolist() if isinstance(v, np.ndarray) else v)
+                for k,v in sorted(kwargs.items())]
+        return hashlib.sha1(repr((imobj.name, imobj.hdu, files, opts))
+                            .encode()).hexdigest()
+
+    def fn(self, imobj, kwargs):
+        return os.path.join(self.cache_dir, '%s-%s.pickle' %
+                            (imobj.name, self.key(imobj, kwargs)))
+
+    def get(self, imobj, kwargs):
+        """Returns (cached, tim), tim can be a cached None (CCD off the brick)"""
+        from pickle import load
+        fn = self.fn(imobj, kwargs)
+        if not os.path.exists(fn):
+            return False, None
+        try:
+            with open(fn, 'rb') as f:
+                tim = load(f)
+        except Exception as e:
+            print('TimCache: could not read %s: %s' % (fn, e))
+            return False, None
+        if tim is not None:
+            tim.imobj = imobj
+        try:
+            # mark as recently used
+            os.utime(fn, None)
+        except OSError:
+            pass
+        return True, tim
+
+    def put(self, imobj, kwargs, tim):
+        fn = self.fn(imobj, kwargs)
+        tmpfn = '%s.tmp%d' % (fn, os.getpid())
+        # the image object holds the survey, simulated catalog and stamps
+        if tim is not None:
+            tim.imobj = None
+        try:
+            with open(tmpfn, 'wb') as f:
+                dump(tim, f, protocol=-1)
+            os.rename(tmpfn, fn)
+        except (IOError, OSError) as e:
+            print('TimCache: could not write %s: %s' % (fn, e))
+        finally:
+            if tim is not None:
+                tim.imobj = imobj
+        self.drop_stale(imobj, fn)
+        self.trim()
+
+    def drop_stale(self, imobj, fn):
+        """Deletes the other entries of this CCD (older calibrations or files)"""
+        prefix = '%s-' % imobj.name
+        for f in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, f)
+            if (f.startswith(prefix) and f.endswith('.pickle') and
+                len(f) == len(os.path.basename(fn)) and path != fn):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def trim(self):
+        """Deletes the least recently used entries under root beyond max_bytes"""
+        if self.max_bytes is None:
+            return
+        files = []
+        for dirpath, _, fns in os.walk(self.root):
+            for f in fns:
+                if not f.endswith('.pickle'):
+                    continue
+                path = os.path.join(dirpath, f)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+# survey attributes reused by keep_warm(): bricktree is left out since
+# LegacySurveyData.drop_cache() frees it
+WARM_TABLES = ['ccds', 'bricks', 'ccds_index', 'ccd_kdtrees']
+_warm_tables = None
+
+def keep_survey_tables_warm():
+    """Turns on reuse of the CCD and brick tables across the bricks run in this
+    process (see example1.py InProcessSlave), off by default so that a
+    one-brick run frees them when runbrick drops its cache"""
+    global _warm_tables
+    if _warm_tables is None:
+        _warm_tables = {}
+
+def _warm_key(survey):
+    return (type(survey).__name__, survey.survey_dir,
+            getattr(survey, 'subset', None))
+
+def warm_survey(survey):
+    """Give a new survey the tables remembered from the previous one like it"""
+    if _warm_tables is None:
+        return survey
+    for attr,val in _warm_tables.get(_warm_key(survey), {}).items():
+        if getattr(survey, attr, None) is None:
+            setattr(survey, attr, val)
+    return survey
+
+def remember_survey(survey):
+    """Keep the tables survey has read so far for the next warm_survey()"""
+    if _warm_tables is None:
+        return
+    tables = _warm_tables.setdefault(_warm_key(survey), {})
+    for attr in WARM_TABLES:
+        val = getattr(survey, attr, None)
+        if val is not None:
+            tables[attr] = val
+
+def share_survey_ccds(node_comm, dataset=None, survey_dir=None):
+    """Reads the SimDecals CCD table once per node, into MPI shared memory
+
+    Collective on node_comm (see mpi_master_slave.split_by_node): node rank 0
+    reads the table, every rank keeps a zero-copy view of it for warm_survey(),
+    so the in-process slaves of a node share one copy instead of each reading
+    its own. Turns on keep_survey_tables_warm(). Not for dataset 'cosmos'.
 
+    Returns:
+        the MPI window of the table, to keep alive as long as it is used
+    """
+    from astrometry.util.fits import tabledata
+    from mpi_master_slave import node_shared_array
+    keep_survey_tables_warm()
+    survey = SimDecals(dataset=dataset, survey_dir=survey_dir)
+    rec = None
+    if node_comm.Get_rank() == 0:
+        ccds = survey.get_ccds_readonly()
+        cols = ccds.get_columns()
+        rec = np.empty(len(ccds), dtype=[(c, ccds.get(c).dtype, ccds.get(c).shape[1:])
+                                         for c in cols])
+        for c in cols:
+            rec[c] = ccds.get(c)
+    shared, win = node_shared_array(node_comm, rec)
+    ccds = tabledata()
+    for c in shared.dtype.names:
+        ccds.set(c, shared[c])
+    _warm_tables.setdefault(_warm_key(survey), {})['ccds'] = ccds
+    return win
+
+def fourier_shift(img,dx,dy):
+    """Returns a copy of img shifted by dx,dy (sub-pixel) pixels via the Fourier shift theorem"""
+    if dx == 0 and dy == 0:
+        return img.copy()
+    h,w = img.shape
+    ky = np.fft.fftfreq(h)[:,np.newaxis]
+    kx = np.fft.rfftfreq(w)[np.newaxis,:]
+    ft = np.fft.rfft2(img) * np.exp(-2j*np.pi*(kx*dx + ky*dy))
+    return np.fft.irfft2(ft, s=(h,w)).astype(img.dtype)
+
+def add_stamp(img,stamp,x0,y0):
+    """img[y0:,x0:] += stamp, clipped to img"""
+    (h,w) = img.shape
+    (sh,sw) = stamp.shape
+    xlo,xhi = max(x0,0), min(x0+sw,w)
+    ylo,yhi = max(y0,0), min(y0+sh,h)
+    if xlo >= xhi or ylo >= yhi:
+        return
+    img[ylo:yhi, xlo:xhi] += stamp[ylo-y0:yhi-y0, xlo-x0:xhi-x0]
 
 class BuildStamp():
 
@@ -462,8 +762,10 @@ class BuildStamp():
           Args:
           tim: Tractor Image Object for a specific CCD
           gain: gain of the CCD
+          stamp_cache: StampCache, if set draw_batch() reuses unit-flux stamps from it
       """
-      def __init__(self,tim,seed=0,camera=None,gain=None,exptime=None): #I think tim is the only useful thing here
+      def __init__(self,tim,seed=0,camera=None,gain=None,exptime=None,
+                   stamp_cache=None): #I think tim is the only useful thing here
           self.band = tim.band.strip()
           self.zpscale = tim.zpscale      # nanomaggies-->ADU (decam) or e-/sec (bass,mzls)
           assert(camera in ['decam','mosaic','90prime'])
@@ -472,6 +774,14 @@ class BuildStamp():
           else:
                 self.nano2e = self.zpscale
           self.tim = tim
+          # footprint of each injected source, and size of the cells
+          # sharing one constant PSF evaluation in draw_batch()
+          self.stamp_size = 64
+          self.psf_region = 128
+          self.region_psfs = {}
+          self.region_tims = {}
+          self.region_stamp_keys = {}
+          self.stamp_cache = stamp_cache
       def setlocal(self,obj):#get a sub_tim image as what's been done in fitblobs stage. see _blob_iter? code for details
               """Get the pixel positions, local wcs, local PSF."""
               #changed to fit for what's been done in fitblobs stage
@@ -522,6 +832,145 @@ class BuildStamp():
           galsim_img.bounds.ymax=self.sy1-1
           return galsim_img
 
+      def source(self,obj,objtype='elg'):
+          """Tractor source for one simcat row, with flux in this tim's band"""
+          pos = RaDecPos(float(obj.get('ra')),float(obj.get('dec')))
+          flux = float(obj.get(self.band+'flux'))
+          if objtype in ['star','qso']:
+              return self.make_source(pos,flux,objtype)
+          return self.make_source(pos,flux,objtype,
+                                  n=int(obj.get('n')),rhalf=float(obj.get('rhalf')),
+                                  e1=float(obj.get('e1')),e2=float(obj.get('e2')))
+
+      def make_source(self,pos,flux,objtype,n=None,rhalf=None,e1=None,e2=None):
+          assert(self.band in ['g','r','z'])
+          brightness = tractor.NanoMaggies(order=[self.band], **{self.band:flux})
+          if objtype in ['star','qso']:
+              return PointSource(pos,brightness)
+          shape = LegacyEllipseWithPriors(np.log(rhalf), e1, e2)
+          if n==1:
+              return ExpGalaxy(pos,brightness,shape)
+          elif n==4:
+              return DevGalaxy(pos,brightness,shape)
+          raise ValueError('sersic n=%d not supported, only n=1 (exp) or n=4 (dev)' % n)
+
+      def region_key(self,x,y):
+          """psf_region x psf_region cell containing pixel x,y (0-indexed)"""
+          return (int(x) // self.psf_region, int(y) // self.psf_region)
+
+      def region_center(self,key):
+          return (int((key[0] + 0.5) * self.psf_region),
+                  int((key[1] + 0.5) * self.psf_region))
+
+      def region_psf(self,key):
+          if not key in self.region_psfs:
+              cx,cy = self.region_center(key)
+              self.region_psfs[key] = self.tim.psf.constantPsfAt(cx, cy)
+          return self.region_psfs[key]
+
+      def region_tim(self,x,y):
+          """tractor.Image sharing this tim's pixels, with the constant PSF of the
+          psf_region x psf_region cell containing pixel x,y (0-indexed).
+          Evaluated once per cell, all sources in the cell share it."""
+          key = self.region_key(x,y)
+          if not key in self.region_tims:
+              psf = self.region_psf(key)
+              self.region_tims[key] = tractor.Image(data=self.tim.getImage(), inverr=self.tim.getInvError(),
+                                                    wcs=self.tim.getWcs(), psf=psf,
+                                                    photocal=self.tim.getPhotoCal(),
+                                                    sky=self.tim.getSky(), name=self.tim.name)
+          return self.region_tims[key]
+
+      def draw_batch(self,simcat,objtype='elg'):
+          """Render all simcat sources landing on this tim into one model image
+
+          Only sources whose 64x64 footprint overlaps the CCD (simcat_on_ccd)
+          are drawn, each into its footprint (clipped to the CCD) and
+          accumulated in place, with no per-object tractor.Image or galsim copies.
+
+          Returns:
+              tuple: model image with the shape of tim [nanomaggies], list of ids added
+          """
+          (h,w) = self.tim.shape
+          model = np.zeros((h,w), np.float32)
+          ids_added = []
+          I,xx,yy = simcat_on_ccd(simcat, self.tim.subwcs, (h,w),
+                                  stamp_size=self.stamp_size)
+          if self.stamp_cache is not None:
+              # cached stamps are in nanomaggies, this tim's counts per nanomaggy
+              counts = self.tim.getPhotoCal().brightnessToCounts(
+                  tractor.NanoMaggies(order=[self.band], **{self.band:1.}))
+          for i,x,y in zip(I,xx,yy):
+              obj = simcat[i]
+              x0 = int(np.round(x)) - self.stamp_size//2
+              y0 = int(np.round(y)) - self.stamp_size//2
+              ids_added.append(obj.get('id'))
+              if self.stamp_cache is not None:
+                  key = self.region_key(np.clip(x, 0, w-1), np.clip(y, 0, h-1))
+                  stamp = self.unit_stamp(obj, objtype, key)
+                  stamp = fourier_shift(stamp, x - np.round(x), y - np.round(y))
+                  stamp *= float(obj.get(self.band+'flux')) * counts
+                  add_stamp(model, stamp, x0, y0)
+                  continue
+              src = self.source(obj, objtype=objtype)
+              mm = ModelMask(x0, y0, self.stamp_size, self.stamp_size)
+              region = self.region_tim(np.clip(x, 0, w-1), np.clip(y, 0, h-1))
+              patch = src.getModelPatch(region, modelMask=mm)
+              if patch is not None:
+                  patch.addTo(model)
+          return model, ids_added
+
+      def stamp_key(self,region):
+          """StampCache key of PSF cell 'region': its constant PSF's pixels
+          and the CD matrix at its center"""
+          if not region in self.region_stamp_keys:
+              cache = self.stamp_cache
+              cx,cy = self.region_center(region)
+              self.region_stamp_keys[region] = (
+                  cache.psf_key(self.region_psf(region)),
+                  cache.cd_key(self.tim.getWcs().cdAtPixel(cx, cy)))
+          return self.region_stamp_keys[region]
+
+      def unit_stamp(self,obj,objtype,region):
+          """Unit-flux (1 nanomaggy), PSF-convolved stamp for obj's quantized morphology
+
+          Rendered centered on the central pixel of PSF cell 'region', with
+          the cell's constant PSF, and looked up in / stored to self.stamp_cache
+          under the cell's stamp_key(), so other CCDs with the same PSF and
+          pixel grid reuse it.
+          """
+          cache = self.stamp_cache
+          if objtype in ['star','qso']:
+              morph = ('psf',)
+          else:
+              morph = (int(obj.get('n')),
+                       cache.quantize(float(obj.get('rhalf')), cache.rhalf_quantum),
+                       cache.quantize(float(obj.get('e1')), cache.e_quantum),
+                       cache.quantize(float(obj.get('e2')), cache.e_quantum))
+          key = morph + (self.band,) + self.stamp_key(region)
+          stamp = cache.get(key)
+          if stamp is not None:
+              return stamp
+          S = self.stamp_size
+          cx,cy = self.region_center(region)
+          subtim = tractor.Image(data=np.zeros((S,S), np.float32),
+                                 inverr=np.ones((S,S), np.float32),
+                                 wcs=self.tim.getWcs().shifted(cx - S//2, cy - S//2),
+                                 psf=self.region_psf(region),
+                                 photocal=LinearPhotoCal(1., band=self.band),
+                                 sky=ConstantSky(0.), name=self.tim.name)
+          pos = self.tim.getWcs().pixelToPosition(cx, cy)
+          if objtype in ['star','qso']:
+              src = self.make_source(pos, 1., objtype)
+          else:
+              n,rhalf,e1,e2 = morph
+              src = self.make_source(pos, 1., objtype, n=n,
+                                     rhalf=max(rhalf, cache.rhalf_quantum),
+                                     e1=e1, e2=e2)
+          stamp = Tractor([subtim], [src]).getModelImage(0).astype(np.float32)
+          cache.put(key, stamp)
+          return stamp
+
 
 
 
@@ -777,6 +1226,34 @@ def get_parser():
                         help='Location of survey-ccds*.fits.gz')
     parser.add_argument('--add_sim_noise', action="store_true", help="set to add noise to simulated sources")
     parser.add_argument('-testA','--image_eq_model', action="store_true", help="set to set image,inverr by model only (ignore real image,invvar)")
+    parser.add_argument('--stamp_cache_size', type=int, default=0,
+                        help='number of unit-flux PSF-convolved stamps to cache and reuse across CCDs and chunks, 0 to render every source')
+    parser.add_argument('--rhalf_quantum', type=float, default=0.01, help='rhalf [arcsec] quantization of the stamp cache')
+    parser.add_argument('--e_quantum', type=float, default=0.01, help='e1,e2 quantization of the stamp cache')
+    parser.add_argument('--psf_quantum', type=float, default=1e-3,
+                        help='PSF pixel quantization of the stamp cache, in units of the PSF peak (0 for exact)')
+    parser.add_argument('--cd_quantum', type=float, default=1e-3,
+                        help='local CD matrix [arcsec/pixel] quantization of the stamp cache')
+    parser.add_argument('--tim_cache_dir', default=None,
+                        help='cache the tims before injection under this dir so later rs-chunks of a brick skip reading them (e.g. /dev/shm/tims for node-local)')
+    parser.add_argument('--tim_cache_gb', type=float, default=8.,
+                        help='size limit of --tim_cache_dir in GB, the least recently used tims are deleted first')
+    parser.add_argument('--detmap_cache_dir', default=None,
+                        help='cache the detection maps without injected sources under this dir so later rs-chunks of a brick only add their own sources (ignored with --image_eq_model)')
+    parser.add_argument('--baseline_catalog', default=None,
+                        help='tractor catalog of a run of the brick without injected sources, e.g. .../tractor-{brick}.fits; the real sources in it are warm-started from that fit instead of refit from scratch')
+    parser.add_argument('--warm_start_radius', type=float, default=5.,
+                        help='with --baseline_catalog, sources within this many arcsec of an injected source still get full model selection')
+    parser.add_argument('--wise_incremental', action='store_true', default=False,
+                        help='with --baseline_catalog, keep the WISE fluxes of its sources and only fit those near injected sources (and new ones)')
+    parser.add_argument('--wise_refit_radius', type=float, default=30.,
+                        help='with --wise_incremental, sources within this many arcsec of an injected source get their WISE fluxes refit')
+    parser.add_argument('--unwise_cache_dir', default=None,
+                        help='cache the prepared unWISE cutouts of a brick under this dir so later rs-chunks of the brick skip reading them')
+    parser.add_argument('--unwise_tile_cache_dir', default=None,
+                        help='node-local dir (e.g. /dev/shm/unwise) caching decompressed unWISE mask and model-sky tiles across bricks')
+    parser.add_argument('--unwise_tile_cache_gb', type=float, default=4.,
+                        help='size limit of --unwise_tile_cache_dir in GB')
     parser.add_argument('--all-blobs', action='store_true',
                         help='Process all the blobs, not just those that contain simulated sources.')
     parser.add_argument('--stage', choices=['tims', 'image_coadds', 'srcs', 'fitblobs', 'coadds'],
@@ -997,13 +1474,24 @@ def do_one_chunk(d=None):
              metacat=d['metacat'], simcat=d['simcat'], \
              output_dir=d['simcat_dir'], \
              add_sim_noise=d['args'].add_sim_noise, seed=d['seed'],\
-             image_eq_model=d['args'].image_eq_model)
+             image_eq_model=d['args'].image_eq_model,
+             stamp_cache=get_stamp_cache(maxsize=d['args'].stamp_cache_size,
+                                         rhalf_quantum=d['args'].rhalf_quantum,
+                                         e_quantum=d['args'].e_quantum,
+                                         psf_quantum=d['args'].psf_quantum,
+                                         cd_quantum=d['args'].cd_quantum))
+    if d['args'].tim_cache_dir is not None:
+        kw.update(tim_cache=TimCache(os.path.join(d['args'].tim_cache_dir,
+                                                  d['brickname'][:3], d['brickname']),
+                                     max_bytes=d['args'].tim_cache_gb * 1e9,
+                                     root=d['args'].tim_cache_dir))
     
     if d['args'].dataset == 'cosmos':
         kw.update(subset=d['args'].subset)
         simdecals= SimDecalsCosmos(**kw)
     else:
         simdecals = SimDecals(**kw)
+    warm_survey(simdecals)
     # Use Tractor to just process the blobs containing the simulated sources.
     if d['args'].all_blobs:
         blobxy = None
@@ -1015,6 +1503,24 @@ def do_one_chunk(d=None):
     runbrick_kwargs= get_runbrick_setup(**obiwan_kwargs)
     # Obiwan modifications
     runbrick_kwargs.update(blobxy=blobxy)
+    if d['args'].detmap_cache_dir is not None and not d['args'].image_eq_model:
+        runbrick_kwargs.update(detmap_cache_dir=d['args'].detmap_cache_dir)
+    if d['args'].baseline_catalog is not None:
+        runbrick_kwargs.update(
+            warm_start_catalog=d['args'].baseline_catalog.format(brick=d['brickname']),
+            warm_start_avoid=list(zip(d['simcat'].get('ra'), d['simcat'].get('dec'))),
+            warm_start_radius=d['args'].warm_start_radius)
+        if d['args'].wise_incremental:
+            runbrick_kwargs.update(
+                wise_baseline_catalog=d['args'].baseline_catalog.format(brick=d['brickname']),
+                wise_refit_radec=list(zip(d['simcat'].get('ra'), d['simcat'].get('dec'))),
+                wise_refit_radius=d['args'].wise_refit_radius)
+    if d['args'].unwise_cache_dir is not None:
+        runbrick_kwargs.update(unwise_cache_dir=os.path.join(
+            d['args'].unwise_cache_dir, d['brickname']))
+    if d['args'].unwise_tile_cache_dir is not None:
+        runbrick_kwargs.update(unwise_tile_cache_dir=d['args'].unwise_tile_cache_dir,
+                               unwise_tile_cache_gb=d['args'].unwise_tile_cache_gb)
     #plotbase='obiwan')
     log.info('Calling run_brick with: ')
     log.info('brickname= %s' % d['brickname'])
@@ -1024,6 +1530,9 @@ def do_one_chunk(d=None):
     np.random.seed(d['seed'])
     log.info(runbrick_kwargs)
     run_brick(d['brickname'], simdecals, **runbrick_kwargs)
+    if simdecals.stamp_cache is not None:
+        # lookups of this process so far; pool workers count their own
+        log.info(simdecals.stamp_cache.stats())
     log.info('HUI-TEST::: checkpoint3h')
 
 def dobash(cmd):
@@ -1095,6 +1604,32 @@ def do_ith_cleanup(d=None):
                         (base,bri,brick,rsdir,name))
 
 
+PACKED_INDEX_SUFFIX = '.index.fits'
+
+def read_packed_randoms(index_fn,brick):
+    """Randoms of one brick from the packed store written by random_division
+
+    Args:
+        index_fn: packed_randoms.index.fits, brickname,start,stop rows of each
+            brick in the brick-sorted packed_randoms.npy next to it
+        brick: brickname
+
+    Returns:
+        fits_table of the brick's randoms, only that slice is read from the
+            memory-mapped .npy
+    """
+    index= fits_table(index_fn)
+    i= np.flatnonzero(np.char.strip(index.brickname) == brick)
+    if len(i) == 0:
+        raise ValueError('brick %s not in %s' % (brick,index_fn))
+    i= i[0]
+    packed= np.load(index_fn[:-len(PACKED_INDEX_SUFFIX)] + '.npy', mmap_mode='r')
+    rows= packed[index.start[i]:index.stop[i]]
+    Samp= fits_table()
+    for name in rows.dtype.names:
+        Samp.set(name, np.array(rows[name]))
+    return Samp
+
 def get_sample(objtype,brick,randoms_db,
                minid=None,randoms_from_fits='',
                do_skipids='no',outdir=None,
@@ -1106,7 +1641,8 @@ def get_sample(objtype,brick,randoms_db,
         brick:
         randoms_db: name of PSQL db for randoms, e.g. obiwan_elg_ra175
         minid: None, unless do_more == yes then it is an integer for the randoms id to start from
-        randoms_from_fits: None or filename of fits_table to use for randoms
+        randoms_from_fits: None or filename of fits_table to use for randoms,
+            or the packed_randoms.index.fits of a packed randoms store
         do_skipids: yes or no, rerunning on all skipped randoms?
         outdir: None if do_skipids='no'; otherwise path like $CSCRATCH/obiwan_out/elg_9deg2_ra175
         dont_sort_sampleid: False to sort sample by id
@@ -1118,7 +1654,9 @@ def get_sample(objtype,brick,randoms_db,
     assert(do_skipids in ['yes','no'])
     if do_skipids == 'yes':
         assert(not outdir is None)
-    if randoms_from_fits:
+    if randoms_from_fits and randoms_from_fits.endswith(PACKED_INDEX_SUFFIX):
+        Samp,seed= read_packed_randoms(randoms_from_fits, brick),1
+    elif randoms_from_fits:
         Samp,seed= fits_table(randoms_from_fits),1
     else:
       if do_skipids == 'no':
@@ -1209,8 +1747,9 @@ def main(args=None):
     #log.info('Number of objects = {}'.format(nobj))
     #log.info('Number of chunks = {}'.format(nchunk))
     # Optionally zoom into a portion of the brick
-    survey = LegacySurveyData(survey_dir=args.survey_dir)
+    survey = warm_survey(LegacySurveyData(survey_dir=args.survey_dir))
     brickinfo= get_brickinfo_hack(survey,brickname)
+    remember_survey(survey)
     #brickinfo = survey.get_brick_by_name(brickname)
     #print(brickname)
     brickwcs = wcs_for_brick(brickinfo)
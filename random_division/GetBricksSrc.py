@@ -1,5 +1,15 @@
 '''
 generate a fits file for randoms of a brick (#TODO more bricks within one fits file)
+
+The randoms are read once, each one is assigned the index of the survey brick
+containing it (brick grid lookup from RA/Dec), they are sorted by that index,
+and all the per-brick files of this node's brick range are written in a single
+sweep over the sorted table.
+
+With RANDOMS_STORAGE=packed, instead of one small fits file per brick, node 0
+writes all the bricks to a single brick-sorted numpy file plus an index of the
+[start, stop) rows of each brick, which kenobi.get_sample() memory-maps
+(--randoms_from_fits $obiwan_out/divided_randoms/packed_randoms.index.fits).
 '''
 import astropy.io.fits as fits
 import numpy as np
@@ -8,19 +18,18 @@ import sys
 import multiprocessing
 import sys
 import os
+from brick_grid import brick_index
 NUM=int(sys.argv[1])
 print(NUM)
 node_tot = int(os.environ['NODE_NUM'])
 bricklist = os.environ['obiwan_out']+'/bricklist.txt'
-bricks = np.loadtxt(bricklist, dtype = np.str)
+bricks = np.loadtxt(bricklist, dtype = str)
 randoms_chunk = os.environ['obiwan_out']+'/randoms_chunk/stacked_randoms.fits'
 outdir = os.environ['obiwan_out']+'/divided_randoms/'
+storage = os.environ.get('RANDOMS_STORAGE', 'files')
+assert(storage in ['files','packed'])
 surveybricks = fits.getdata(os.environ['obiwan_data']+'/survey-bricks.fits.gz')
-sel = np.zeros(len(surveybricks),dtype=bool)
-
-for i in range(len(surveybricks)):
-    if surveybricks['BRICKNAME'][i] in bricks:
-        sel[i]=True
+sel = np.isin(np.char.strip(surveybricks['BRICKNAME'].astype(str)), bricks)
 
 sub_surveybricks = surveybricks[sel]
 
@@ -29,98 +38,116 @@ unit = int(N_tot/node_tot)
 
 
 
-if NUM<node_tot-1:
+if storage == 'packed':
+    # one file holds every brick: node 0 does it all in one sweep
+    if NUM > 0:
+        print('RANDOMS_STORAGE=packed, nothing to do on node %d' % NUM)
+        sys.exit(0)
+elif NUM<node_tot-1:
     sub_surveybricks = sub_surveybricks[NUM*unit:(NUM+1)*unit]
 else:
     sub_surveybricks = sub_surveybricks[NUM*unit:]
 
 
+def PartitionRandoms():
+    '''Read the randoms once and sort the ones in this node's bricks by brick
+
+    Returns:
+        tuple: randoms sorted by brick, and per entry of sub_surveybricks the
+            start, stop row offsets of its randoms in the sorted table
+    '''
+    log = logging.getLogger('brick_stats')
+    hdu = fits.open(randoms_chunk, memmap=True)
+    dat = hdu[1].data
+    log.info('Total points here are: %d total number of bricks: %d' % (len(dat), len(sub_surveybricks)))
+    ibrick = brick_index(dat['ra'], dat['dec'], sub_surveybricks)
+    keep = np.flatnonzero(ibrick >= 0)
+    order = keep[np.argsort(ibrick[keep], kind='stable')]
+    dat_sorted = dat[order]
+    hdu.close()
+    ibrick_sorted = ibrick[order]
+    tasks = np.arange(len(sub_surveybricks))
+    starts = np.searchsorted(ibrick_sorted, tasks, side='left')
+    stops = np.searchsorted(ibrick_sorted, tasks, side='right')
+    return dat_sorted, starts, stops
+
+# set by GetBrickStats() before the pool forks, shared with the workers
+dat_sorted, starts, stops = None, None, None
+
 def GetBrickSrcs(index, write=True):
-    from os.path import isfile
-    #if isfile(outdir+'brick_%s.fits' % (sub_surveybricks['BRICKNAME'][index])):
-    #    print('file exists for index %d' % index)
-    #    return True
     log = logging.getLogger('brick_stats')
     log.info('sub_surveybricks[%d] brickname:%s ra1 %f ra2 %f dec1 %f dec2 %f' %(index, sub_surveybricks['BRICKNAME'][index], sub_surveybricks['RA1'][index], sub_surveybricks['RA2'][index], sub_surveybricks['DEC1'][index], sub_surveybricks['DEC2'][index]))
-    
-    ra1 = sub_surveybricks['RA1'][index]
-    ra2 = sub_surveybricks['RA2'][index]
-    dec1 = sub_surveybricks['DEC1'][index]
-    dec2 = sub_surveybricks['DEC2'][index]
-    flag = True
-    TOTAL_COUNT=0
-    if True:
-        hdu = fits.open(randoms_chunk)
-        dat_i = hdu[1].data
-        hdu.close()
-        TOTAL_COUNT+=len(dat_i)
-        dat_ra = dat_i['ra']
-        dat_dec = dat_i['dec']
-        dat_sel = (dat_ra>ra1)&(dat_ra<ra2)&(dat_dec>dec1)&(dat_dec<dec2)
-        dat_i_brick = dat_i[dat_sel]
-        if flag:
-           dat_brick = dat_i_brick
-           if len(dat_brick)>0:
-               flag=False
-               log.debug(len(dat_brick))
-        else:
-           dat_brick = np.hstack((dat_brick, dat_i_brick))
-           log.debug(len(dat_i_brick))
-           log.debug(len(dat_brick))
-    #log.info('Total points here are: %d total number of bricks: %d' % (TOTAL_COUNT, len(sub_surveybricks)))
-    if write is True and len(np.array(dat_brick))>0:
+    dat_brick = dat_sorted[starts[index]:stops[index]]
+    if write is True and len(dat_brick)>0:
         log.info('brick %s length %d' %(sub_surveybricks['BRICKNAME'][index], len(dat_brick)))
-        cols = fits.ColDefs(np.array(dat_brick))
-        HDU = fits.BinTableHDU.from_columns(cols)
+        HDU = fits.BinTableHDU(data=dat_brick)
         HDU.writeto(outdir+'brick_%s.fits' % (sub_surveybricks['BRICKNAME'][index]), overwrite = True)
     return np.array(dat_brick)
 
 #main
 def GetBrickStats():
+    global dat_sorted, starts, stops
     logging.basicConfig(level=logging.INFO, stream=sys.stdout)
     log = logging.getLogger('brick_stats')
     log.info('entering GetBrickStats...')
+    dat_sorted, starts, stops = PartitionRandoms()
+    if storage == 'packed':
+        WritePackedRandoms()
+        GetBrickInfoFile()
+        log.info('exiting GetBrickStats...')
+        return
     CPU_COUNT = 32 #multiprocessing.cpu_count()
     log.info('CPU_COUNT %d' %(CPU_COUNT))
-    
+
     p = multiprocessing.Pool(CPU_COUNT)
-    tasks=range(len(sub_surveybricks))
-    outputs = p.map(GetBrickSrcs, tasks)
-    
-    #output_len = [len(outputs[i]) for i in range(len(outputs))]
-    #bricknames = sub_surveybricks['BRICKNAME']
-    #bricks_len_list = np.array(zip(bricknames, output_len))
-    #FAILED: #np.savetxt(outdir+'brick_list.out',bricks_len_list)
+    tasks=np.flatnonzero(stops > starts)
+    p.map(GetBrickSrcs, tasks)
+    p.close()
+
     GetBrickInfoFile()
     log.info('exiting GetBrickStats...')
 
+def WritePackedRandoms():
+    '''One brick-sorted .npy of all the randoms + a fits index of each brick's rows'''
+    log = logging.getLogger('brick_stats')
+    names = dat_sorted.columns.names
+    cols = [np.asarray(dat_sorted[name]) for name in names]
+    packed = np.empty(len(dat_sorted),
+                      dtype=[(name.lower(), col.dtype.newbyteorder('='), col.shape[1:])
+                             for name,col in zip(names, cols)])
+    for name,col in zip(names, cols):
+        packed[name.lower()] = col
+    fn = outdir+'packed_randoms.npy'
+    tmpfn = outdir+'packed_randoms.tmp.npy'
+    np.save(tmpfn, packed)
+    os.rename(tmpfn, fn)
+    log.info('Wrote %s, %d randoms' % (fn, len(packed)))
+    has = stops > starts
+    index = fits.BinTableHDU.from_columns([
+        fits.Column(name='brickname', format='8A', array=sub_surveybricks['BRICKNAME'][has]),
+        fits.Column(name='start', format='K', array=starts[has]),
+        fits.Column(name='stop', format='K', array=stops[has])])
+    index.writeto(outdir+'packed_randoms.index.fits', overwrite=True)
+    log.info('Wrote %s, %d bricks' % (outdir+'packed_randoms.index.fits', has.sum()))
+
 def GetBrickInfoFile():
+    '''brick_list.out from the partition offsets, without re-opening the brick files'''
     f = open(outdir+'brick_list.out',"w")
     logging.basicConfig(level=logging.INFO, stream=sys.stdout)
     log = logging.getLogger('bgrick_stats')
-    for brick_i in sub_surveybricks['BRICKNAME']:
-        log.info("writing %s" % brick_i)
-        try:
-        	hdu = fits.open(outdir+'brick_%s.fits' % brick_i)
-        	dat = hdu[1].data
-        	hdu.close()
-        	f.write("%s %d\n" % (brick_i, len(dat)))
-        except:
-               pass
+    for brick_i,start,stop in zip(sub_surveybricks['BRICKNAME'], starts, stops):
+        if stop > start:
+            log.info("writing %s" % brick_i)
+            f.write("%s %d\n" % (brick_i, stop - start))
     f.close()
 
 def run_one_brick():
+    global dat_sorted, starts, stops
     print('test run')
+    dat_sorted, starts, stops = PartitionRandoms()
     for i in range(1):
         final_array = GetBrickSrcs(i)
         print('brick:%s length:%d' % (sub_surveybricks['BRICKNAME'][i], len(final_array)))
-    #    brickname_array = np.array([sub_surveybricks['BRICKNAME'][i] for k in range(len(final_array))])
-    #    brickname_cols = fits.Column(name='brickname',array=brickname_array,format='20A')
-        cols = fits.ColDefs(final_array)
-        print(type(cols))
-    #    cols.add_col(brickname_cols)
-        HDU = fits.BinTableHDU.from_columns(cols)
-        HDU.writeto(outdir+'brick_%s.fits' % (sub_surveybricks['BRICKNAME'][i]), overwrite=True)
 
 if __name__ == '__main__':
     GetBrickStats()
@@ -0,0 +1,25 @@
+'''
+Lookup of the survey brick containing RA,Dec points
+'''
+import numpy as np
+
+def brick_index(ra, dec, surveybricks):
+    '''index into surveybricks of the brick containing each ra,dec, -1 if none
+
+    Bricks are rows of constant DEC1,DEC2; within a row they tile RA1,RA2. Sorting
+    the bricks by (row, RA1) gives one monotonic key, so the lookup is a single
+    searchsorted for all the points.
+    '''
+    dec_edges = np.unique(surveybricks['DEC1'])
+    brow = np.searchsorted(dec_edges, surveybricks['DEC1'])
+    bkey = brow * 1000. + surveybricks['RA1']
+    order = np.argsort(bkey)
+    row = np.searchsorted(dec_edges, dec, side='right') - 1
+    key = row * 1000. + ra
+    j = np.searchsorted(bkey[order], key, side='right') - 1
+    j = np.clip(j, 0, len(order)-1)
+    I = order[j]
+    inside = ((row >= 0) & (brow[I] == row) &
+              (ra > surveybricks['RA1'][I]) & (ra < surveybricks['RA2'][I]) &
+              (dec > surveybricks['DEC1'][I]) & (dec < surveybricks['DEC2'][I]))
+    return np.where(inside, I, -1)
@@ -0,0 +1,30 @@
+import unittest
+
+import numpy as np
+
+class TestBrickIndex(unittest.TestCase):
+
+    def test_brick_index(self):
+        from brick_grid import brick_index
+        # two rows of bricks, of different widths
+        rows = [(0., 0.25, 0.25), (0.25, 0.5, 0.5)]
+        B = []
+        for dec1,dec2,dra in rows:
+            for ra1 in np.arange(0., 2., dra):
+                B.append((ra1, ra1+dra, dec1, dec2))
+        B = np.array(B, dtype=[('RA1',float), ('RA2',float),
+                               ('DEC1',float), ('DEC2',float)])
+        # shuffled, as the survey bricks of a node
+        B = B[np.random.RandomState(42).permutation(len(B))]
+        rng = np.random.RandomState(1)
+        ra = rng.uniform(-0.2, 2.2, size=1000)
+        dec = rng.uniform(-0.1, 0.6, size=1000)
+        I = brick_index(ra, dec, B)
+        for r,d,i in zip(ra, dec, I):
+            J = np.flatnonzero((r > B['RA1']) * (r < B['RA2']) *
+                               (d > B['DEC1']) * (d < B['DEC2']))
+            self.assertEqual(i, J[0] if len(J) else -1)
+
+
+if __name__ == '__main__':
+    unittest.main()